@@ -0,0 +1,326 @@
+# benchmark for the practice track pipeline, using synthetic stems (sine waves, one per voice)
+# every stage (decoding and analysis, decoding with a cached analysis, mixing/encoding, the end-to-end create task) is measured separately:
+# wall time, CPU time (including ffmpeg subprocesses), peak RSS and bytes moved
+#
+# usage (from the src directory, requires ffmpeg and the packages in requirements-benchmark.txt):
+#   python benchmark.py run --voices 2 4 8 --durations 30 180 --bitrates 128k 320k -o results.json
+#   python benchmark.py compare baseline.json results.json
+#
+# by default, S3 is replaced by moto; use --s3 configured to run against the bucket from the settings (e.g. MinIO) instead
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import ffmpeg
+
+# ru_maxrss is reported in kilobytes on Linux, but in bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def generate_stems(directory, voices, duration, bitrate):
+    """
+    Creates one mp3 file per voice: sine waves a major third apart, each one a bit quieter than the previous one
+    :return: the paths of the files
+    """
+    paths = []
+    for i in range(voices):
+        path = os.path.join(directory, f"voice_{i + 1}.mp3")
+        frequency = 220 * 2 ** (4 * i / 12)
+        (
+            ffmpeg.input(
+                f"sine=frequency={frequency:.2f}:sample_rate=44100:duration={duration}",
+                format="lavfi",
+            )
+            .output(path, af=f"volume={-2 * i}dB", ac=2, audio_bitrate=bitrate)
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        paths.append(path)
+    return paths
+
+
+def _read_proc_io():
+    # bytes read/written through system calls by this process (files, pipes to ffmpeg, sockets); Linux only
+    try:
+        with open("/proc/self/io") as f:
+            values = dict(line.split(": ") for line in f.read().splitlines())
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _cpu_time():
+    # only includes child processes that have terminated and were waited for, which is the case for all ffmpeg processes
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN),
+        )
+    )
+
+
+@contextmanager
+def measure(results, stage):
+    """
+    Measures the code in the with block and stores the metrics in results[stage].
+    Yields a dict that can be used to add further metrics (e.g. bytes transferred from/to S3).
+
+    Note: peak RSS is the peak of the process (and the largest child process) so far, i.e. it never decreases between stages
+    """
+    metrics = {}
+    io_before = _read_proc_io()
+    cpu_before = _cpu_time()
+    start = time.perf_counter()
+    yield metrics
+    wall_time = time.perf_counter() - start
+    cpu_time = _cpu_time() - cpu_before
+    io_after = _read_proc_io()
+
+    results[stage] = {
+        "wall_time_s": round(wall_time, 4),
+        "cpu_time_s": round(cpu_time, 4),
+        "peak_rss_mb": round(
+            max(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            )
+            * MAXRSS_UNIT
+            / 1024**2,
+            1,
+        ),
+        **metrics,
+    }
+    if io_before is not None and io_after is not None:
+        results[stage]["bytes_read"] = io_after[0] - io_before[0]
+        results[stage]["bytes_written"] = io_after[1] - io_before[1]
+
+
+def benchmark_scenario(work_dir, voices, duration, bitrate):
+    # imported here, as S3 has to be mocked before the S3 clients are created
+    from celery_worker import analysis
+    from celery_worker.tasks import practice_tracks
+    from shared.s3 import upload_file_to_s3, upload_json_to_s3, get_s3_file_info
+    from shared.uploads import (
+        create_manifest,
+        get_input_object_name,
+        get_manifest_object_name,
+    )
+    from shared.utils import hash_file
+
+    stems_dir = os.path.join(work_dir, "stems")
+    output_dir = os.path.join(work_dir, "output")
+    pcm_dir = os.path.join(work_dir, "pcm")
+    for directory in (stems_dir, output_dir, pcm_dir):
+        os.makedirs(directory, exist_ok=True)
+    stems = generate_stems(stems_dir, voices, duration, bitrate)
+    input_bytes = sum(os.path.getsize(path) for path in stems)
+    results = {}
+
+    # start with an empty analysis cache: the first time, the inputs are analyzed while they are decoded (like in the create task),
+    # the second time, they are decoded with their cached analysis
+    analysis.ANALYSIS_CACHE_DIR = os.path.join(work_dir, "analysis_cache")
+    analysis.ANALYSIS_CACHE_S3_MIRROR = False
+    for stage in ("decoding", "decoding_cached"):
+        tracks = None
+        with measure(results, stage) as metrics:
+            tracks = [practice_tracks.load_track(path, pcm_dir) for path in stems]
+            metrics["input_bytes"] = input_bytes
+
+    with measure(results, "practice_track") as metrics:
+        practice_tracks.create_practice_track(tracks[0], tracks[1:], output_dir)
+        metrics["output_bytes"] = os.path.getsize(
+            os.path.join(output_dir, os.path.basename(tracks[0].path))
+        )
+
+    with measure(results, "balanced_mix") as metrics:
+        practice_tracks.create_balanced_mix(tracks, output_dir)
+        metrics["output_bytes"] = os.path.getsize(os.path.join(output_dir, "all.mp3"))
+    del tracks
+
+    # end-to-end: inputs are stored in S3 the way the API stores them, the create task runs in this process
+    upload_id = str(uuid.uuid4())
+    for path in stems:
+        upload_file_to_s3(
+            path, get_input_object_name(upload_id, os.path.basename(path))
+        )
+    upload_json_to_s3(
+        create_manifest({os.path.basename(path): hash_file(path) for path in stems}),
+        get_manifest_object_name(upload_id),
+    )
+    analysis.ANALYSIS_CACHE_DIR = os.path.join(work_dir, "analysis_cache_create")
+    with measure(results, "create") as metrics:
+        result = practice_tracks.create.apply(kwargs={"upload_id": upload_id})
+        result.get()
+        metrics["s3_bytes_downloaded"] = input_bytes
+        metrics["s3_bytes_uploaded"] = get_s3_file_info(
+            f"{upload_id}/practice_tracks.zip"
+        )["ContentLength"]
+
+    return results
+
+
+def _get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _start_s3_mock():
+    try:
+        from moto import mock_s3
+    except ImportError:
+        sys.exit("moto is not installed (see requirements-benchmark.txt)")
+    from decouple import config
+
+    # moto only intercepts requests to AWS endpoints
+    region = config("S3_REGION")
+    os.environ["S3_ENDPOINT"] = f"https://s3.{region}.amazonaws.com"
+    mock = mock_s3()
+    mock.start()
+
+    from shared.s3 import remote_s3
+    from shared.settings import S3_BUCKET
+
+    remote_s3.create_bucket(
+        Bucket=S3_BUCKET,
+        **(
+            {"CreateBucketConfiguration": {"LocationConstraint": region}}
+            if region != "us-east-1"
+            else {}
+        ),
+    )
+    return mock
+
+
+def run(args):
+    mock = _start_s3_mock() if args.s3 == "moto" else None
+
+    from celery_worker import app
+
+    # the tasks run in this process, so results don't have to be stored in the actual result backend
+    app.conf.result_backend = "cache+memory://"
+
+    report = {
+        "commit": _get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "s3": args.s3,
+        "scenarios": [],
+    }
+    try:
+        for voices in args.voices:
+            for duration in args.durations:
+                for bitrate in args.bitrates:
+                    for repetition in range(args.repeat):
+                        print(
+                            f"{voices} voices, {duration}s, {bitrate} (run {repetition + 1}/{args.repeat})",
+                            file=sys.stderr,
+                        )
+                        work_dir = tempfile.mkdtemp(prefix="benchmark-")
+                        try:
+                            stages = benchmark_scenario(
+                                work_dir, voices, duration, bitrate
+                            )
+                        finally:
+                            shutil.rmtree(work_dir, ignore_errors=True)
+                        report["scenarios"].append(
+                            {
+                                "voices": voices,
+                                "duration": duration,
+                                "bitrate": bitrate,
+                                "repetition": repetition,
+                                "stages": stages,
+                            }
+                        )
+    finally:
+        if mock is not None:
+            mock.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+def _aggregate(report):
+    # median wall time per (scenario, stage), as scenarios may have been run several times
+    times = {}
+    for scenario in report["scenarios"]:
+        key = (scenario["voices"], scenario["duration"], scenario["bitrate"])
+        for stage, metrics in scenario["stages"].items():
+            times.setdefault((*key, stage), []).append(metrics["wall_time_s"])
+    return {key: sorted(values)[len(values) // 2] for key, values in times.items()}
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = _aggregate(json.load(f))
+    with open(args.results) as f:
+        results = _aggregate(json.load(f))
+
+    regressions = 0
+    for key in sorted(baseline.keys() & results.keys()):
+        voices, duration, bitrate, stage = key
+        ratio = results[key] / baseline[key] if baseline[key] else float("inf")
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "  <-- slower"
+            regressions += 1
+        print(
+            f"{voices:>2} voices {duration:>5}s {bitrate:>5} {stage:<16} "
+            f"{baseline[key]:>9.3f}s -> {results[key]:>9.3f}s ({ratio:.2f}x){flag}"
+        )
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark for the practice track pipeline"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark")
+    run_parser.add_argument("--voices", type=int, nargs="+", default=[2, 4, 8])
+    run_parser.add_argument(
+        "--durations", type=float, nargs="+", default=[30], help="in seconds"
+    )
+    run_parser.add_argument("--bitrates", nargs="+", default=["128k"])
+    run_parser.add_argument("--repeat", type=int, default=1)
+    run_parser.add_argument("--s3", choices=["moto", "configured"], default="moto")
+    run_parser.add_argument("-o", "--output", help="JSON file (default: stdout)")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser(
+        "compare", help="compare the wall times of two benchmark runs"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown that counts as regression",
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
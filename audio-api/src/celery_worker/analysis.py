@@ -0,0 +1,105 @@
+import os
+import json
+import uuid
+import logging
+from typing import Optional
+
+from shared.settings import (
+    ANALYSIS_CACHE_DIR,
+    ANALYSIS_CACHE_MAX_BYTES,
+    ANALYSIS_CACHE_S3_MIRROR,
+)
+from shared.s3 import download_json_from_s3, upload_file_to_s3
+
+# prefix of the analysis results in the S3 bucket (if mirroring is enabled)
+S3_ANALYSIS_PREFIX = "analysis"
+# part of the name of every cache entry, incremented whenever the analysis changes (e.g. when new measurements are added),
+# so that outdated entries aren't used anymore (they are evicted eventually)
+ANALYSIS_VERSION = 2
+
+
+def _get_cache_path(file_hash):
+    return os.path.join(os.path.abspath(ANALYSIS_CACHE_DIR), _get_entry_name(file_hash))
+
+
+def _get_entry_name(file_hash):
+    return f"{file_hash}.v{ANALYSIS_VERSION}.json"
+
+
+def load_cached_analysis(file_hash: str) -> Optional[dict]:
+    """
+    Returns the cached analysis of a file (see celery_worker.audio.decode_track), or None if the file wasn't analyzed before
+    """
+    cache_path = _get_cache_path(file_hash)
+    try:
+        with open(cache_path, "r") as f:
+            analysis = json.load(f)
+        # the modification time is used to find the least recently used entries when evicting
+        os.utime(cache_path)
+        return analysis
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Could not read cached analysis from {cache_path}")
+        logging.exception(e)
+
+    if ANALYSIS_CACHE_S3_MIRROR:
+        analysis = download_json_from_s3(
+            f"{S3_ANALYSIS_PREFIX}/{_get_entry_name(file_hash)}"
+        )
+        if analysis is not None:
+            # like any new entry, it may push the local cache beyond its size limit
+            _store_locally(cache_path, analysis)
+            return analysis
+    return None
+
+
+def store_analysis(file_hash: str, analysis: dict):
+    """
+    Stores the analysis of a file in the cache, e.g. if it was analyzed while decoding it (see celery_worker.audio.decode_track)
+    """
+    cache_path = _get_cache_path(file_hash)
+    _store_locally(cache_path, analysis)
+
+    if ANALYSIS_CACHE_S3_MIRROR:
+        upload_file_to_s3(
+            cache_path, f"{S3_ANALYSIS_PREFIX}/{_get_entry_name(file_hash)}"
+        )
+
+
+def _store_locally(cache_path, analysis):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    # write to a temporary file first, so that concurrent readers never see partially written entries
+    temp_path = f"{cache_path}.{uuid.uuid4()}"
+    with open(temp_path, "w") as f:
+        json.dump(analysis, f)
+    os.replace(temp_path, cache_path)
+
+    _evict_least_recently_used(os.path.dirname(cache_path))
+
+
+def _evict_least_recently_used(cache_dir):
+    entries = []
+    total_size = 0
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    if total_size <= ANALYSIS_CACHE_MAX_BYTES:
+        return
+
+    # evict a bit more than necessary, so that we don't have to do this again for every new entry
+    target_size = ANALYSIS_CACHE_MAX_BYTES * 0.9
+    for _, size, path in sorted(entries):
+        if total_size <= target_size:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except FileNotFoundError:
+            # already evicted by another worker
+            pass
+    logging.debug(f"Evicted analysis cache entries, size is now {total_size} bytes")
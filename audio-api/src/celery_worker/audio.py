@@ -0,0 +1,487 @@
+import os
+import re
+import queue
+import logging
+import threading
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import ffmpeg
+import numpy as np
+
+from celery_worker.execution import get_memory_budget
+from celery_worker.instrumentation import stage, wait_for_process
+from celery_worker.loudness import LoudnessMeter, SILENCE_DB, to_db
+from shared.settings import FFMPEG_THREADS
+from shared.encoding import DEFAULT_ENCODING_PROFILE, get_encoding_options
+
+# every input is decoded to the same PCM layout, so that decoded tracks can be mixed sample by sample
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_FORMAT = "f32le"
+DTYPE = np.float32
+FRAME_BYTES = CHANNELS * np.dtype(DTYPE).itemsize
+
+# number of frames processed at once when mixing, encoding or measuring PCM samples
+CHUNK_FRAMES = 64 * 1024
+
+
+class DecodedTrack(NamedTuple):
+    path: str
+    # PCM samples with shape (frames, CHANNELS)
+    samples: np.ndarray
+    # analysis results of the original file (see celery_worker.analysis)
+    analysis: Optional[dict] = None
+
+
+def decode_track(
+    path: str,
+    pcm_dir: str,
+    duration: Optional[float] = None,
+    on_progress: Optional[Callable[[float], None]] = None,
+    analyze: bool = False,
+    input_format: Optional[str] = None,
+) -> DecodedTrack:
+    """
+    Decodes an audio file (any format ffmpeg can decode, e.g. mp3, WAV or FLAC) into PCM samples. This should happen exactly once per input file;
+    all mixes are then created from the returned samples.
+
+    The samples are read from ffmpeg's stdout right into memory, as long as they fit into the memory budget of the task
+    (see celery_worker.execution.memory_budget). Otherwise, they are written to pcm_dir (and memory-mapped from there).
+
+    :param path: path to the audio file
+    :param pcm_dir: directory where the raw PCM data of large tracks is written to
+    :param duration: duration of the audio file in seconds, if known (otherwise, it is taken from ffmpeg's output)
+    :param on_progress: called with the fraction of the file that was decoded so far
+    :param analyze: if True, the track is analyzed while it is decoded, saving a separate decoding pass: the analysis is a dict
+        with the keys mean_volume and max_volume (in dB, as defined by ffmpeg's volumedetect filter), integrated_loudness
+        (in LUFS, see EBU R128), true_peak (in dBTP), duration (in seconds), sample_rate, channel_layout and format
+        (as detected by ffmpeg, e.g. "mp3" or "flac")
+    :param input_format: the (ffmpeg) format of the file, if known from a previous analysis (otherwise, ffmpeg probes the file)
+    :return: the decoded track (including the analysis results, if analyze is True)
+    """
+    pcm_path = os.path.join(pcm_dir, f"{os.path.basename(path)}.pcm")
+    logging.debug(f"Decoding {path}")
+    with stage("decoding"):
+        samples, analysis = _decode(
+            _get_decoder(path, input_format),
+            _SampleBuffer(pcm_path, get_memory_budget()),
+            duration,
+            on_progress,
+            analyze,
+        )
+    return DecodedTrack(path, samples, analysis)
+
+
+def _get_decoder(path, input_format=None):
+    input_options = {"format": input_format} if input_format else {}
+    return ffmpeg.input(path, threads=FFMPEG_THREADS, **input_options).output(
+        "pipe:",
+        format=SAMPLE_FORMAT,
+        ac=CHANNELS,
+        ar=SAMPLE_RATE,
+        threads=FFMPEG_THREADS,
+    )
+
+
+def _decode(stream, buffer, duration, on_progress, analyze):
+    process = stream.global_args("-hide_banner", "-nostats").run_async(
+        pipe_stdout=True, pipe_stderr=True
+    )
+    # ffmpeg describes the input on stderr (which is needed for the analysis, and for the progress if the duration isn't known),
+    # and it may log a lot more (e.g. for every broken frame), so stderr is read in the background while the samples are read
+    input_info = _InputInfoReader(process.stderr)
+    meter = LoudnessMeter(SAMPLE_RATE, CHANNELS) if analyze else None
+    frames = 0
+    try:
+        while True:
+            if duration is None and input_info.duration is not None:
+                duration = input_info.duration
+            if duration:
+                buffer.expect(_get_frame_count(duration))
+
+            data = process.stdout.read(CHUNK_FRAMES * FRAME_BYTES)
+            if not data:
+                break
+            chunk = np.frombuffer(
+                data, dtype=DTYPE, count=len(data) // FRAME_BYTES * CHANNELS
+            ).reshape(-1, CHANNELS)
+            if meter is not None:
+                # analyzing the chunk while it is in the CPU cache is much cheaper than a separate pass over the samples (or the file)
+                meter.add(chunk)
+            buffer.append(chunk)
+            frames += len(chunk)
+            if on_progress is not None and duration:
+                on_progress(min(1.0, frames / (duration * SAMPLE_RATE)))
+    except BaseException:
+        buffer.discard()
+        process.kill()
+        input_info.join()
+        wait_for_process(process)
+        raise
+
+    input_info.join()
+    wait_for_process(process)
+    if process.returncode != 0:
+        buffer.discard()
+        raise ffmpeg.Error("ffmpeg", None, input_info.output)
+    samples = buffer.finish()
+
+    if meter is None:
+        return samples, None
+    return samples, {
+        **meter.result(),
+        "duration": input_info.duration or frames / SAMPLE_RATE,
+        "sample_rate": input_info.sample_rate,
+        "channel_layout": input_info.channel_layout,
+        "format": input_info.format,
+    }
+
+
+def _get_frame_count(duration):
+    # decoders may output a few more frames than the duration suggests (e.g. the padding of mp3 files)
+    return int(duration * SAMPLE_RATE) + SAMPLE_RATE // 10
+
+
+class _SampleBuffer:
+    """
+    Growable buffer for decoded samples. Samples are kept in memory as long as they fit into the given memory budget:
+    otherwise, they are written to a file that is memory-mapped once decoding is done.
+    """
+
+    def __init__(self, pcm_path, budget):
+        self._pcm_path = pcm_path
+        self._budget = budget
+        # memory reserved for self._samples
+        self._reserved_bytes = 0
+        self._file = None
+        self._samples = np.empty((0, CHANNELS), dtype=DTYPE)
+        self.frames = 0
+
+    def expect(self, frames):
+        """Makes room for the given (total) number of frames, if it is known in advance"""
+        if self._file is None and frames > len(self._samples):
+            self._reserve(frames)
+
+    def append(self, chunk):
+        frames = self.frames + len(chunk)
+        if self._file is None and frames > len(self._samples):
+            # grow geometrically, so that tracks of unknown length aren't copied over and over again
+            self._reserve(max(frames, len(self._samples) * 3 // 2))
+        if self._file is not None:
+            chunk.tofile(self._file)
+        else:
+            self._samples[self.frames : frames] = chunk
+        self.frames = frames
+
+    def finish(self) -> np.ndarray:
+        if self._file is not None:
+            self._file.close()
+            # keep the file around, the OS pages the samples in (and out) as needed
+            return np.memmap(self._pcm_path, dtype=DTYPE, mode="r").reshape(
+                -1, CHANNELS
+            )
+        samples = self._samples[: self.frames]
+        # don't keep a lot of unused memory around for the lifetime of the track
+        if self.frames < len(self._samples) * 7 // 8:
+            samples = samples.copy()
+            self._budget.release(self._reserved_bytes - samples.nbytes)
+        # the memory stays reserved for as long as the task runs
+        return samples
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._pcm_path)
+        self._budget.release(self._reserved_bytes)
+        self._reserved_bytes = 0
+        self._samples = None
+
+    def _reserve(self, frames):
+        size = frames * FRAME_BYTES
+        if self._budget.try_reserve(size - self._reserved_bytes):
+            samples = np.empty((frames, CHANNELS), dtype=DTYPE)
+            samples[: self.frames] = self._samples[: self.frames]
+            self._samples = samples
+            self._reserved_bytes = size
+        else:
+            self._file = open(self._pcm_path, "wb")
+            self._samples[: self.frames].tofile(self._file)
+            self._samples = None
+            self._budget.release(self._reserved_bytes)
+            self._reserved_bytes = 0
+
+
+class _InputInfoReader(threading.Thread):
+    """
+    Reads ffmpeg's (info level) output in the background, parsing the description of the input as soon as it is logged
+    """
+
+    def __init__(self, stderr):
+        super().__init__(daemon=True)
+        self._stderr = stderr
+        self._lines = []
+        self.duration = None
+        self.sample_rate = None
+        self.channel_layout = None
+        self.format = None
+        self.start()
+
+    @property
+    def output(self) -> bytes:
+        return b"".join(self._lines)
+
+    def run(self):
+        for line in self._stderr:
+            self._lines.append(line)
+            if self.duration is None or self.sample_rate is None:
+                duration, sample_rate, channel_layout, input_format = parse_input_info(
+                    line.decode("utf-8", errors="replace")
+                )
+                self.duration = self.duration or duration
+                self.format = self.format or input_format
+                if self.sample_rate is None and sample_rate is not None:
+                    self.sample_rate = sample_rate
+                    self.channel_layout = channel_layout
+
+
+def parse_input_info(
+    output: str,
+) -> Tuple[Optional[float], Optional[int], Optional[str], Optional[str]]:
+    """
+    Parses the description of the (first) input that ffmpeg logs (at info level)
+    :return: the duration (in seconds), the sample rate, the channel layout and the format of the input (each one None if not found)
+    """
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    stream = re.search(r"Stream #0:\d+.*?: Audio: [^,]+, (\d+) Hz, ([^,\n]+)", output)
+    # e.g. "Input #0, wav, from ..." or "Input #0, mov,mp4,m4a,3gp,3g2,mj2, from ..." (any of the names selects the demuxer)
+    input_format = re.search(r"Input #0, ([\w-]+)[^\n]*?, from ", output)
+    return (
+        (
+            int(duration.group(1)) * 3600
+            + int(duration.group(2)) * 60
+            + float(duration.group(3))
+            if duration
+            else None
+        ),
+        int(stream.group(1)) if stream else None,
+        stream.group(2).strip() if stream else None,
+        input_format.group(1) if input_format else None,
+    )
+
+
+def iter_mixes(
+    tracks: List[DecodedTrack], gain_matrix, block_frames: int = CHUNK_FRAMES
+) -> Iterator[np.ndarray]:
+    """
+    Mixes decoded tracks (i.e. audio from all tracks 'playing' at once) into several mixes at once, block by block, so that mixing
+    never needs more memory than a few blocks, no matter how long the tracks are. Shorter tracks are padded with silence at the end.
+
+    Every mix is a linear combination of the same tracks, so a block of all mixes is a single matrix product (gain matrix times
+    the samples of the tracks), which BLAS computes much faster than scaling and adding up the tracks for every mix separately.
+    If the gains differ between the channels (e.g. for panned tracks), it is one matrix product per channel.
+
+    Note: the same buffer is reused for all blocks, so every block has to be consumed before the next one is requested
+
+    :param tracks: the decoded tracks
+    :param gain_matrix: linear gain factors with shape (mixes, tracks), i.e. row i holds the gain of every track in mix i,
+        or with shape (mixes, tracks, CHANNELS) for gains that differ between the channels
+    :param block_frames: (maximum) number of frames of each block
+    :return: iterator over the blocks of mixed PCM samples, each one with shape (mixes, frames, CHANNELS)
+    """
+    gain_matrix = np.asarray(gain_matrix, dtype=DTYPE)
+    if gain_matrix.ndim == 3 and (gain_matrix == gain_matrix[:, :, :1]).all():
+        gain_matrix = gain_matrix[:, :, 0]
+    if gain_matrix.ndim == 2:
+        mixes = np.empty((len(gain_matrix), block_frames * CHANNELS), dtype=DTYPE)
+        for inputs in _iter_blocks(tracks, block_frames):
+            block = mixes[:, : inputs.shape[1]]
+            np.matmul(gain_matrix, inputs, out=block)
+            yield block.reshape(len(gain_matrix), -1, CHANNELS)
+        return
+
+    mixes = np.empty((len(gain_matrix), block_frames, CHANNELS), dtype=DTYPE)
+    for inputs in _iter_blocks(tracks, block_frames):
+        channels = inputs.reshape(len(tracks), -1, CHANNELS)
+        block = mixes[:, : channels.shape[1]]
+        for channel in range(CHANNELS):
+            block[:, :, channel] = gain_matrix[:, :, channel] @ channels[:, :, channel]
+        yield block
+
+
+def _iter_blocks(tracks, block_frames):
+    # the samples of all tracks in a block, one (contiguous) row of interleaved samples per track
+    inputs = np.empty((len(tracks), block_frames * CHANNELS), dtype=DTYPE)
+    length = get_mix_length(tracks)
+    for start in range(0, length, block_frames):
+        size = min(block_frames, length - start) * CHANNELS
+        for row, track in zip(inputs, tracks):
+            samples = track.samples[start : start + block_frames].reshape(-1)
+            row[: len(samples)] = samples
+            row[len(samples) : size] = 0
+        yield inputs[:, :size]
+
+
+def get_mix_length(tracks: List[DecodedTrack]) -> int:
+    """
+    :return: the number of frames of a mix of the given tracks, i.e. the one of the longest track
+    """
+    return max(len(track.samples) for track in tracks)
+
+
+def mix_mean_volumes(tracks: List[DecodedTrack], gain_matrix) -> List[float]:
+    """
+    Computes the mean volume of mixes of decoded tracks (see iter_mixes) without mixing them, the same way as ffmpeg's
+    volumedetect filter, i.e. the mean power over all samples of all channels (in dB relative to full scale, so 0dB is the maximum)
+
+    :param gain_matrix: linear gain factors with shape (mixes, tracks) or (mixes, tracks, CHANNELS)
+    :return: the mean volume of every mix in dB
+    """
+    gain_matrix = np.asarray(gain_matrix, dtype=np.float64)
+    if gain_matrix.ndim == 2:
+        gain_matrix = np.repeat(gain_matrix[:, :, None], CHANNELS, axis=2)
+    # the sum of squares of a linear combination of the tracks follows from the inner products of all pairs of tracks
+    # (their Gram matrix, per channel), so the mean volume of any number of mixes is known after a single pass over the tracks
+    gram = np.zeros((CHANNELS, len(tracks), len(tracks)))
+    for inputs in _iter_blocks(tracks, CHUNK_FRAMES):
+        channels = inputs.reshape(len(tracks), -1, CHANNELS)
+        for channel in range(CHANNELS):
+            samples = np.ascontiguousarray(channels[:, :, channel])
+            gram[channel] += samples @ samples.T
+    sums_of_squares = np.einsum("ijc,cjk,ikc->i", gain_matrix, gram, gain_matrix)
+    length = get_mix_length(tracks)
+    return [
+        (
+            to_db(max(float(sum_of_squares), 0.0) / (length * CHANNELS))
+            if length
+            else SILENCE_DB
+        )
+        for sum_of_squares in sums_of_squares
+    ]
+
+
+def encode_mixes(
+    tracks: List[DecodedTrack],
+    gain_matrix,
+    out_paths: List[str],
+    on_progress: Optional[Callable[[float], None]] = None,
+    profile: str = DEFAULT_ENCODING_PROFILE,
+    on_encoded: Optional[Callable[[int], None]] = None,
+):
+    """
+    Mixes decoded tracks into several mixes at once (see iter_mixes) and encodes every mix into an mp3 file.
+    The mixes are streamed into the encoders (one ffmpeg process per mix, all running in parallel) block by block,
+    so they are never held in memory as a whole, and every block of the tracks is only read once for all mixes.
+    Once all blocks are passed on, the encoders are waited for one after the other, and every finished mix is reported
+    through on_encoded right away, so that it can be processed further while the remaining encoders finish.
+
+    :param tracks: the decoded tracks
+    :param gain_matrix: linear gain factors with shape (mixes, tracks), i.e. row i holds the gain of every track in mix i,
+        or with shape (mixes, tracks, CHANNELS) for gains that differ between the channels (see iter_mixes)
+    :param out_paths: path of the output file of every mix
+    :param on_progress: called with the fraction of the mixes that was passed to ffmpeg so far
+    :param profile: the encoding profile (bitrate, sample rate, channels etc., see shared.encoding)
+    :param on_encoded: called with the index of every mix as soon as its file is complete
+    """
+    options = get_encoding_options(profile)
+    # mixing a block is much cheaper than encoding it, and it happens while ffmpeg encodes the previous blocks
+    with stage("encoding"):
+        _encode(
+            iter_mixes(tracks, gain_matrix),
+            get_mix_length(tracks),
+            out_paths,
+            on_progress,
+            options,
+            on_encoded,
+        )
+
+
+def _encode(
+    blocks: Iterable[np.ndarray], frames, out_paths, on_progress, options, on_encoded
+):
+    processes = [
+        ffmpeg.input("pipe:", format=SAMPLE_FORMAT, ac=CHANNELS, ar=SAMPLE_RATE)
+        .output(out_path, threads=FFMPEG_THREADS, **options)
+        .global_args("-loglevel", "error", "-nostats")
+        .overwrite_output()
+        .run_async(pipe_stdin=True, pipe_stderr=True)
+        for out_path in out_paths
+    ]
+    # the pipes only buffer a fraction of a block, so writing to them blocks until ffmpeg has encoded (most of) the previous ones:
+    # every encoder is fed by a separate thread, so that all encoders keep running while the others are fed
+    writers = [_PipeWriter(process.stdin) for process in processes]
+    # number of encoders that were waited for
+    done = 0
+    try:
+        written = 0
+        for block in blocks:
+            for writer, samples in zip(writers, block):
+                # (tobytes copies the samples, so the block's buffer can be reused right away)
+                writer.write(samples.astype(DTYPE, copy=False).tobytes())
+            written += block.shape[1]
+            if on_progress is not None:
+                on_progress(written / frames)
+
+        for writer, process in zip(writers, processes):
+            writer.close()
+            _, stderr = wait_for_process(process)
+            done += 1
+            if process.returncode != 0:
+                raise ffmpeg.Error("ffmpeg", None, stderr)
+            if on_encoded is not None:
+                on_encoded(done - 1)
+    except BaseException:
+        for process in processes[done:]:
+            process.kill()
+        raise
+    finally:
+        for writer, process in zip(writers[done:], processes[done:]):
+            writer.close()
+            wait_for_process(process)
+
+
+class _PipeWriter(threading.Thread):
+    """
+    Writes data to a pipe in the background, buffering at most a few writes
+    """
+
+    def __init__(self, pipe, max_pending_writes=2):
+        super().__init__(daemon=True)
+        self._pipe = pipe
+        self._queue = queue.Queue(max_pending_writes)
+        self.start()
+
+    def write(self, data: bytes):
+        self._queue.put(data)
+
+    def close(self):
+        """Waits for all pending writes and closes the pipe"""
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        broken = False
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if not broken:
+                try:
+                    self._pipe.write(data)
+                except BrokenPipeError:
+                    # the process exited early (the actual error is reported when it is reaped), the remaining data is dropped
+                    broken = True
+        try:
+            self._pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def get_pan_gains(positions: List[float]) -> np.ndarray:
+    """
+    Computes the gains of the (stereo) channels of tracks at the given positions in the panorama, from -1 (left) to 1 (right).
+    Like a balance control, panning a track attenuates the opposite channel, so a track in the center stays as it is.
+
+    :return: the gains with shape (tracks, CHANNELS)
+    """
+    positions = np.asarray(positions, dtype=np.float64)[:, None]
+    return np.clip(np.hstack([1 - positions, 1 + positions]), 0, 1)
@@ -0,0 +1,256 @@
+import os
+import time
+import logging
+import threading
+import functools
+import contextvars
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from celery_worker.instrumentation import stage
+from shared.settings import WORKER_CPU_BUDGET, FFMPEG_THREADS, JOB_MEMORY_LIMIT_BYTES
+
+# every CPU-bound job (decoding, mixing and encoding a track etc.) runs one ffmpeg process with FFMPEG_THREADS threads at a time
+CPU_SLOTS = max(1, (WORKER_CPU_BUDGET or os.cpu_count()) // FFMPEG_THREADS)
+
+# process ID of the owner of every CPU slot (0: free), created when the worker's main process imports the tasks,
+# i.e. before Celery forks its pool processes. Hence, the slots are shared by all pool processes:
+# no matter how many tasks run concurrently, at most CPU_SLOTS CPU-bound jobs run at once.
+# Slots are leased to processes rather than counted by a semaphore, so that the slots of a pool process that was killed
+# while holding them (e.g. by the OOM killer or because of a hard time limit) can be reclaimed by the other processes
+_cpu_slot_owners = multiprocessing.Array("i", CPU_SLOTS)
+# jobs that need several slots lease them one by one; only one of them may do so at a time (this is the process ID of
+# the one that currently does, 0 if there is none), otherwise two of them could end up waiting for the slots the other one holds.
+# Like the slots, it is guarded by the lock of _cpu_slot_owners
+_multi_slot_owner = multiprocessing.Value("i", 0, lock=False)
+# threads of the same process have the same process ID, so they take turns leasing several slots using this lock
+_multi_slot_thread_lock = threading.Lock()
+# how often jobs that wait for CPU slots check whether there are free ones (in seconds)
+CPU_SLOT_POLL_INTERVAL = 0.05
+# the lock of _cpu_slot_owners is only held for a few microseconds at a time: if it can't be acquired within this time
+# (e.g. because the process that held it was killed, in which case it is never released), jobs run without a CPU slot
+CPU_SLOT_LOCK_TIMEOUT = 5
+
+# threads can't be shared across processes, so every (pool) process lazily creates its own thread pool and reuses it for all of its tasks
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# memory budget of the task that is currently running (JobGroup passes the context on to the jobs of a task)
+_current_memory_budget = contextvars.ContextVar("current_memory_budget", default=None)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Returns the thread pool of the current process. Its threads mostly wait for I/O (S3, pipes to ffmpeg) or for CPU slots,
+    so it is larger than the number of CPU slots.
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=2 * CPU_SLOTS + 4, thread_name_prefix="worker"
+            )
+            _executor_pid = os.getpid()
+            logging.debug(
+                f"Created thread pool for process {_executor_pid} ({CPU_SLOTS} CPU slots)"
+            )
+        return _executor
+
+
+def cpu_bound(fn):
+    """
+    Decorator for CPU-bound functions: waits for a free CPU slot before running the function
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with cpu_slots():
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def cpu_slots(count: int = 1):
+    """
+    Waits for the given number of free CPU slots (at most CPU_SLOTS) and holds them in the with block,
+    e.g. for jobs that run several ffmpeg processes at once
+    """
+    count = max(1, min(count, CPU_SLOTS))
+    try:
+        with stage("waiting_for_cpu"):
+            if count == 1:
+                slots = _lease_cpu_slots(1)
+            else:
+                with _multi_slot_lease():
+                    slots = _lease_cpu_slots(count)
+    except CPUSlotLockTimeout as e:
+        # running without slots is better than not running at all
+        logging.warning(f"{e}, running without CPU slots")
+        slots = []
+    try:
+        yield
+    finally:
+        _release_cpu_slots(slots)
+
+
+def _lease_cpu_slots(count):
+    pid = os.getpid()
+    slots = []
+    try:
+        while True:
+            with _slot_owners_lock() as owners:
+                for slot, owner in enumerate(owners):
+                    if len(slots) == count:
+                        break
+                    if owner == 0 or (owner != pid and not _is_alive(owner)):
+                        if owner != 0:
+                            logging.warning(
+                                f"Reclaiming CPU slot of process {owner}, which is gone"
+                            )
+                        owners[slot] = pid
+                        slots.append(slot)
+            if len(slots) == count:
+                return slots
+            time.sleep(CPU_SLOT_POLL_INTERVAL)
+    except BaseException:
+        # e.g. a soft time limit while waiting
+        _release_cpu_slots(slots)
+        raise
+
+
+def _release_cpu_slots(slots):
+    if not slots:
+        return
+    try:
+        with _slot_owners_lock() as owners:
+            for slot in slots:
+                owners[slot] = 0
+    except CPUSlotLockTimeout as e:
+        logging.error(f"{e}, CPU slots {slots} remain leased until this process exits")
+
+
+@contextmanager
+def _multi_slot_lease():
+    pid = os.getpid()
+    with _multi_slot_thread_lock:
+        while True:
+            with _slot_owners_lock():
+                owner = _multi_slot_owner.value
+                if owner == 0 or (owner != pid and not _is_alive(owner)):
+                    _multi_slot_owner.value = pid
+                    break
+            time.sleep(CPU_SLOT_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            try:
+                with _slot_owners_lock():
+                    _multi_slot_owner.value = 0
+            except CPUSlotLockTimeout as e:
+                logging.error(
+                    f"{e}, leasing several CPU slots remains blocked until this process exits"
+                )
+
+
+class CPUSlotLockTimeout(Exception):
+    """Raised if the lock of the CPU slots can't be acquired in time (see CPU_SLOT_LOCK_TIMEOUT)"""
+
+
+@contextmanager
+def _slot_owners_lock():
+    lock = _cpu_slot_owners.get_lock()
+    if not lock.acquire(timeout=CPU_SLOT_LOCK_TIMEOUT):
+        raise CPUSlotLockTimeout("Could not acquire the lock of the CPU slots")
+    try:
+        yield _cpu_slot_owners.get_obj()
+    finally:
+        lock.release()
+
+
+def _is_alive(pid):
+    # note: if the process ID was reused in the meantime, the slot is only reclaimed once the new process is gone, too
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobGroup:
+    """
+    Submits jobs to the thread pool of the current process. Can be used like a ThreadPoolExecutor as context manager,
+    i.e. when exiting the with block, it waits for all jobs that were submitted through it to finish
+    (pending jobs are cancelled if an exception was raised).
+    """
+
+    def __init__(self):
+        self._futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        # jobs run in the context of the code that submitted them (e.g. to account their metrics to the right task)
+        context = contextvars.copy_context()
+        future = get_executor().submit(context.run, fn, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def map(self, fn, *iterables):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return (future.result() for future in futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            for future in self._futures:
+                future.cancel()
+        wait(self._futures)
+
+
+class MemoryBudget:
+    """
+    Limits the memory a task uses for decoded samples: jobs reserve memory before allocating it and fall back to
+    something that needs less memory (e.g. writing samples to disk) if the reservation fails
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit_bytes = limit_bytes
+        self.reserved_bytes = 0
+        self._lock = threading.Lock()
+
+    def try_reserve(self, size: int) -> bool:
+        with self._lock:
+            if self.reserved_bytes + size > self.limit_bytes:
+                return False
+            self.reserved_bytes += size
+            return True
+
+    def release(self, size: int):
+        with self._lock:
+            self.reserved_bytes -= size
+
+
+@contextmanager
+def memory_budget(limit_bytes: int = JOB_MEMORY_LIMIT_BYTES):
+    """
+    Sets the memory budget of the current task (and of all jobs it submits through a JobGroup inside the with block)
+    """
+    budget = MemoryBudget(limit_bytes)
+    token = _current_memory_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_memory_budget.reset(token)
+
+
+def get_memory_budget() -> MemoryBudget:
+    """
+    Returns the memory budget of the current task; outside of tasks (e.g. in scripts), every call returns a new budget
+    """
+    budget = _current_memory_budget.get()
+    return budget if budget is not None else MemoryBudget(JOB_MEMORY_LIMIT_BYTES)
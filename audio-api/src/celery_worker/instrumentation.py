@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from subprocess import Popen
+from typing import Optional, Tuple
+
+from celery_worker.statsd import send_metrics
+
+# metrics of the task that is currently running (JobGroup passes the context on to the jobs of a task)
+_current_metrics = contextvars.ContextVar("current_metrics", default=None)
+# stage that is currently running in this job, ffmpeg processes are accounted to it
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+# ru_maxrss is reported in kilobytes on Linux
+RSS_UNIT = 1024
+
+
+class TaskMetrics:
+    """
+    Collects per-stage metrics of a task: how often each stage ran, the time spent in it (summed over all jobs, which may run in parallel)
+    and the CPU time and peak memory usage of the ffmpeg processes that ran as part of it
+    """
+
+    def __init__(self, task_name: str):
+        self.task_name = task_name
+        # number of input files, set as soon as it is known
+        self.voices = None
+        self.failed = False
+        self._start = time.perf_counter()
+        self._end = None
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, wall_time: float):
+        with self._lock:
+            metrics = self._get_stage(stage)
+            metrics["count"] += 1
+            metrics["wall_time_s"] += wall_time
+
+    def record_process_usage(self, stage: str, usage):
+        with self._lock:
+            metrics = self._get_stage(stage)
+            metrics["processes"] += 1
+            metrics["process_cpu_time_s"] += usage.ru_utime + usage.ru_stime
+            metrics["process_max_rss_bytes"] = max(
+                metrics["process_max_rss_bytes"], usage.ru_maxrss * RSS_UNIT
+            )
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            end = self._end if self._end is not None else time.perf_counter()
+            return {
+                "task": self.task_name,
+                "voices": self.voices,
+                "failed": self.failed,
+                "wall_time_s": round(end - self._start, 4),
+                "stages": {
+                    stage: {
+                        key: round(value, 4) if isinstance(value, float) else value
+                        for key, value in metrics.items()
+                    }
+                    for stage, metrics in self._stages.items()
+                },
+            }
+
+    def finish(self):
+        with self._lock:
+            self._end = time.perf_counter()
+        metrics = self.as_dict()
+        logging.info(f"Task metrics: {json.dumps(metrics)}")
+        send_metrics(_to_statsd(metrics))
+
+    def _get_stage(self, stage):
+        if stage not in self._stages:
+            self._stages[stage] = {
+                "count": 0,
+                "wall_time_s": 0.0,
+                "processes": 0,
+                "process_cpu_time_s": 0.0,
+                "process_max_rss_bytes": 0,
+            }
+        return self._stages[stage]
+
+
+@contextmanager
+def collect_metrics(task_name: str):
+    """
+    Collects the metrics of all stages that run in the with block (or in jobs submitted from it).
+    When the block is left, the metrics are logged and sent to StatsD (if configured).
+    """
+    metrics = TaskMetrics(task_name)
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    except BaseException:
+        metrics.failed = True
+        raise
+    finally:
+        _current_metrics.reset(token)
+        metrics.finish()
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Marks the code in the with block as a stage of the current task (a no-op outside of collect_metrics)
+    """
+    metrics = _current_metrics.get()
+    token = _current_stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+        if metrics is not None:
+            metrics.record(name, time.perf_counter() - start)
+
+
+def wait_for_process(process: Popen) -> Tuple[Optional[bytes], Optional[bytes]]:
+    """
+    Like Popen.communicate(), but reaps the process with os.wait4 to get its resource usage, which is accounted to the current stage.
+
+    Note: stdout is read completely before stderr, so a process must not write a lot to both of them
+    """
+    if process.stdin is not None:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    stdout = process.stdout.read() if process.stdout is not None else None
+    stderr = process.stderr.read() if process.stderr is not None else None
+
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.record_process_usage(_current_stage.get() or "other", usage)
+    return stdout, stderr
+
+
+def _to_statsd(metrics):
+    # stage timings both across all tasks and per voice count, so that latency histograms can be built for either
+    prefixes = [metrics["task"]]
+    if metrics["voices"] is not None:
+        prefixes.append(f"{metrics['task']}.voices_{metrics['voices']}")
+
+    lines = []
+    for prefix in prefixes:
+        result = "failed" if metrics["failed"] else "succeeded"
+        lines.append(f"{prefix}.{result}:1|c")
+        lines.append(f"{prefix}.wall_time:{metrics['wall_time_s'] * 1000:.1f}|ms")
+        for stage_name, stage_metrics in metrics["stages"].items():
+            stage_prefix = f"{prefix}.stage.{stage_name}"
+            lines.append(
+                f"{stage_prefix}.wall_time:{stage_metrics['wall_time_s'] * 1000:.1f}|ms"
+            )
+            if stage_metrics["processes"]:
+                lines.append(
+                    f"{stage_prefix}.process_cpu_time:{stage_metrics['process_cpu_time_s'] * 1000:.1f}|ms"
+                )
+                lines.append(
+                    f"{stage_prefix}.process_max_rss:{stage_metrics['process_max_rss_bytes']}|g"
+                )
+    return lines
@@ -0,0 +1,258 @@
+# loudness measurement of PCM samples, in-process with numpy (instead of running ffmpeg's volumedetect/ebur128 filters in another decoding pass)
+# samples are passed in blocks while they are decoded, so measuring a track never needs more memory than a block
+# - mean volume and max volume as defined by ffmpeg's volumedetect filter
+# - integrated loudness (in LUFS) as defined by EBU R128 / ITU-R BS.1770-4: K-weighting, 400ms blocks overlapping by 75%,
+#   an absolute gate at -70 LUFS and a relative gate 10 LU below the loudness of the blocks above the absolute gate
+# - true peak (in dBTP, i.e. the peak of the samples oversampled by 4, see ITU-R BS.1770-4, Annex 2)
+from functools import lru_cache
+from math import pi, tan
+from typing import List
+
+import numpy as np
+
+# the mean/max volume ffmpeg's volumedetect filter reports for digital silence (used as lower bound for all levels in dB)
+SILENCE_DB = -91.0
+# integrated loudness of tracks without any block above the absolute gate (what ffmpeg's ebur128 filter reports for silence)
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+
+# the K-weighting filters (IIR) are applied as FIR filters with their impulse response truncated to this many samples
+# (the response has decayed to ~1e-7 by then, e.g. DC leaks through the truncated high-pass filter at less than -90dB)
+K_WEIGHTING_TAPS = 2048
+# size of the FFTs used to apply the K-weighting (blocks of FFT_SIZE - K_WEIGHTING_TAPS + 1 frames are filtered at once)
+FFT_SIZE = 16384
+# oversampling factor and number of taps of the interpolation filter used to find the true peak
+TRUE_PEAK_OVERSAMPLING = 4
+TRUE_PEAK_TAPS = 48
+
+
+class LoudnessMeter:
+    """
+    Measures the loudness of PCM samples that are passed block by block (see add)
+    """
+
+    def __init__(self, sample_rate: int, channels: int):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._k_weighting = _FirFilter(_get_k_weighting_response(sample_rate), channels)
+        self._true_peak_matrix = _get_true_peak_matrix()
+        # interpolated values exceed the largest input frame they are computed from by at most this factor
+        self._true_peak_gain = float(np.abs(self._true_peak_matrix).sum(axis=0).max())
+        # the last input frames of the previous block, needed to interpolate the first frames of the next one
+        self._true_peak_history = np.zeros(
+            (len(self._true_peak_matrix) - 1, channels), dtype=np.float32
+        )
+        # gating blocks consist of 4 segments of 100ms each, overlapping blocks share 3 of them
+        self._segment_frames = sample_rate // 10
+        self._segment_energies = []
+        # K-weighted samples that don't fill a segment yet
+        self._remainder = np.empty((0, channels))
+        self._sum_of_squares = 0.0
+        self._sample_count = 0
+        self._peak = 0.0
+        self._true_peak = 0.0
+
+    def add(self, samples: np.ndarray):
+        """
+        Measures the next block of samples
+
+        :param samples: PCM samples with shape (frames, channels)
+        """
+        if len(samples) == 0:
+            return
+        flat = samples.ravel()
+        self._sum_of_squares += float(np.dot(flat, flat))
+        self._sample_count += flat.size
+        self._peak = max(self._peak, float(np.abs(flat).max()))
+        self._add_to_true_peak(samples)
+        for start in range(0, len(samples), self._k_weighting.block_frames):
+            self._add_to_gating_blocks(
+                samples[start : start + self._k_weighting.block_frames]
+            )
+
+    def result(self) -> dict:
+        """
+        :return: dict with the keys mean_volume and max_volume (in dB relative to full scale), integrated_loudness (in LUFS) and true_peak (in dBTP)
+        """
+        return {
+            "mean_volume": to_db(
+                self._sum_of_squares / self._sample_count if self._sample_count else 0.0
+            ),
+            "max_volume": to_db(self._peak**2),
+            "integrated_loudness": self._get_integrated_loudness(),
+            "true_peak": to_db(self._true_peak**2),
+        }
+
+    def _add_to_true_peak(self, samples):
+        taps = len(self._true_peak_matrix)
+        extended = np.concatenate((self._true_peak_history, samples))
+        self._true_peak_history = extended[len(extended) - (taps - 1) :]
+        self._true_peak = max(self._true_peak, self._peak)
+
+        # only the values interpolated from frames close to the peak can exceed it, which are usually very few
+        threshold = self._true_peak / self._true_peak_gain
+        candidates = np.cumsum((np.abs(extended) > threshold).any(axis=1))
+        # the window of interpolated frame i consists of the input frames i to i + taps - 1
+        frames = np.flatnonzero(
+            candidates[taps - 1 :] - np.concatenate(([0], candidates[:-taps])) > 0
+        )
+        if len(frames) == 0:
+            return
+        # (frames, channels, taps)
+        windows = np.lib.stride_tricks.sliding_window_view(extended, taps, axis=0)
+        if len(frames) < len(windows) // 2:
+            windows = windows[frames]
+        # a single matrix product interpolates all phases of all frames (the windows have to be contiguous for BLAS)
+        interpolated = (
+            np.ascontiguousarray(windows).reshape(-1, taps) @ self._true_peak_matrix
+        )
+        self._true_peak = max(self._true_peak, float(np.abs(interpolated).max()))
+
+    def _add_to_gating_blocks(self, samples):
+        weighted = np.concatenate((self._remainder, self._k_weighting.process(samples)))
+        segments = len(weighted) // self._segment_frames
+        used_frames = segments * self._segment_frames
+        if segments:
+            segment_samples = weighted[:used_frames].reshape(
+                segments, self._segment_frames, self.channels
+            )
+            # sum of squares of every segment and channel
+            self._segment_energies.append(
+                np.einsum("ijk,ijk->ik", segment_samples, segment_samples)
+            )
+        self._remainder = weighted[used_frames:]
+
+    def _get_integrated_loudness(self):
+        if not self._segment_energies:
+            return ABSOLUTE_GATE_LUFS
+        # all channels have a weight of 1 (surround channels, which are weighted differently, aren't supported)
+        segment_energies = np.concatenate(self._segment_energies).sum(axis=1)
+        if len(segment_energies) < 4:
+            return ABSOLUTE_GATE_LUFS
+        cumulative = np.concatenate(([0.0], np.cumsum(segment_energies)))
+        # mean square of the K-weighted samples in each 400ms block
+        block_energies = (cumulative[4:] - cumulative[:-4]) / (4 * self._segment_frames)
+        block_loudness = _energy_to_lufs(block_energies)
+
+        gated = block_energies[block_loudness > ABSOLUTE_GATE_LUFS]
+        if len(gated) == 0:
+            return ABSOLUTE_GATE_LUFS
+        relative_gate = _energy_to_lufs(gated.mean()) + RELATIVE_GATE_LU
+        gated = block_energies[
+            (block_loudness > ABSOLUTE_GATE_LUFS) & (block_loudness > relative_gate)
+        ]
+        return float(max(_energy_to_lufs(gated.mean()), ABSOLUTE_GATE_LUFS))
+
+
+def get_normalization_gains(
+    loudness: List[float], gains: List[float], target_loudness: float
+) -> List[float]:
+    """
+    Computes the gains for mixing tracks such that every track is as loud as the others (times its relative gain),
+    and the mix has the target loudness. This assumes that the tracks are uncorrelated (i.e. that their energies add up),
+    which holds well enough for different voices or instruments.
+
+    :param loudness: integrated loudness of every track (in LUFS)
+    :param gains: linear gain of every track, relative to the others
+    :param target_loudness: integrated loudness of the mix (in LUFS)
+    :return: linear gain to apply to every track when mixing
+    """
+    # silent tracks can't be brought to any loudness, they are mixed as they are
+    audible = [track_loudness > ABSOLUTE_GATE_LUFS for track_loudness in loudness]
+    energy = sum(gain**2 for gain, is_audible in zip(gains, audible) if is_audible)
+    if energy == 0:
+        return list(gains)
+    scale = 1 / np.sqrt(energy)
+    return [
+        (
+            float(gain * scale * (10 ** ((target_loudness - track_loudness) / 20)))
+            if is_audible
+            else float(gain * scale)
+        )
+        for track_loudness, gain, is_audible in zip(loudness, gains, audible)
+    ]
+
+
+def to_db(mean_square: float) -> float:
+    """
+    Converts a mean square (or a squared peak) of samples to dB relative to full scale, with SILENCE_DB as lower bound
+    """
+    if mean_square == 0:
+        return SILENCE_DB
+    return max(float(10 * np.log10(mean_square)), SILENCE_DB)
+
+
+def _energy_to_lufs(energy):
+    with np.errstate(divide="ignore"):
+        return -0.691 + 10 * np.log10(energy)
+
+
+class _FirFilter:
+    """
+    Applies an FIR filter to blocks of samples via FFT convolution (overlap-add), carrying the tail of each block over to the next one
+    """
+
+    def __init__(self, response, channels, fft_size=FFT_SIZE):
+        self._fft_size = fft_size
+        self._response_spectrum = np.fft.rfft(response, fft_size)[:, None]
+        self._tail = np.zeros((len(response) - 1, channels))
+        # maximum number of frames that can be passed to process at once
+        self.block_frames = fft_size - len(self._tail)
+
+    def process(self, samples):
+        frames = len(samples)
+        spectrum = np.fft.rfft(samples.astype(np.float64), self._fft_size, axis=0)
+        filtered = np.fft.irfft(
+            spectrum * self._response_spectrum, self._fft_size, axis=0
+        )
+        filtered = filtered[: frames + len(self._tail)]
+        filtered[: len(self._tail)] += self._tail
+        self._tail = filtered[frames:]
+        return filtered[:frames]
+
+
+@lru_cache
+def _get_k_weighting_response(sample_rate):
+    # coefficients of the two K-weighting filters for any sample rate (as in libebur128), see ITU-R BS.1770-4
+    # stage 1: high-shelf filter modeling the acoustic effects of the head
+    k = tan(pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh**0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf_b = [
+        (vh + vb * k / q + k * k) / a0,
+        2 * (k * k - vh) / a0,
+        (vh - vb * k / q + k * k) / a0,
+    ]
+    shelf_a = [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    # stage 2: high-pass filter ("revised low-frequency B-curve")
+    k = tan(pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass_b = [1, -2, 1]
+    high_pass_a = [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    # the impulse response of the cascade, computed from its frequency response
+    # (the response is periodic with K_WEIGHTING_TAPS, but decays long before that)
+    frequency_response = (
+        np.fft.rfft(shelf_b, K_WEIGHTING_TAPS)
+        / np.fft.rfft(shelf_a, K_WEIGHTING_TAPS)
+        * np.fft.rfft(high_pass_b, K_WEIGHTING_TAPS)
+        / np.fft.rfft(high_pass_a, K_WEIGHTING_TAPS)
+    )
+    return np.fft.irfft(frequency_response, K_WEIGHTING_TAPS)
+
+
+@lru_cache
+def _get_true_peak_matrix():
+    # windowed sinc low-pass filter at the original Nyquist frequency, as interpolation filter after inserting
+    # TRUE_PEAK_OVERSAMPLING - 1 zeros between the input samples; it is applied in polyphase form (see _add_to_true_peak):
+    # tap p + TRUE_PEAK_OVERSAMPLING * k belongs to the interpolated value at phase p and the k-th last input frame
+    n = np.arange(TRUE_PEAK_TAPS) - (TRUE_PEAK_TAPS - 1) / 2
+    response = np.sinc(n / TRUE_PEAK_OVERSAMPLING) * np.kaiser(TRUE_PEAK_TAPS, 5)
+    # (input frames, phases), with the input frames in chronological order (i.e. the last one in the last row)
+    matrix = response.reshape(-1, TRUE_PEAK_OVERSAMPLING)[::-1]
+    # every phase passes DC unchanged
+    matrix = matrix / matrix.sum(axis=0)
+    return np.ascontiguousarray(matrix, dtype=np.float32)
@@ -0,0 +1,128 @@
+import time
+import threading
+import logging
+from typing import Callable
+
+from shared.settings import PROGRESS_REPORT_INTERVAL
+
+# changes smaller than this are not reported
+MIN_PROGRESS_DELTA = 0.01
+
+
+class ProgressTracker:
+    """
+    Aggregates the progress of the jobs of a task (which may run in parallel) into a single value between 0 and 1.
+
+    The work of a task is split into stages (e.g. decoding, mixing), each of which has a fixed weight and consists of one or more jobs
+    (e.g. one per track). Jobs report the fraction of their work that is done (e.g. the time of the audio that ffmpeg encoded so far
+    relative to the track's duration) whenever it changes.
+
+    Reports are coalesced: the report function (which usually writes to the result backend) is called at most once per interval,
+    no matter how many jobs report their progress, and only if the progress changed noticeably.
+    It is called outside of the tracker's lock, so that jobs don't wait for the result backend whenever they report their progress.
+    """
+
+    def __init__(
+        self,
+        report: Callable[[float], None],
+        interval: float = PROGRESS_REPORT_INTERVAL,
+    ):
+        """
+        :param report: called with the overall progress; may be called from any thread
+        :param interval: minimum time between two reports (in seconds)
+        """
+        self._report = report
+        self._interval = interval
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._reported_progress = 0.0
+        self._reported_at = None
+        # reports are sent one at a time, in case sending one takes longer than the interval
+        self._report_lock = threading.Lock()
+        self._sent_progress = 0.0
+
+    def add_stage(self, name: str, weight: float, job_count: int = 1):
+        """
+        Adds a stage to the task. The weights of all stages should add up to 1.
+        """
+        with self._lock:
+            self._stages[name] = (weight, [0.0] * max(1, job_count))
+
+    def update(self, name: str, fraction: float, job: int = 0):
+        """
+        Sets the fraction of the work of a job that is done (jobs can't go backwards, smaller values are ignored)
+        """
+        with self._lock:
+            _, fractions = self._stages[name]
+            fractions[job] = max(fractions[job], min(1.0, fraction))
+            progress = self._take_due_report()
+        if progress is not None:
+            self._send_report(progress)
+
+    def complete(self, name: str, job: int = 0):
+        self.update(name, 1.0, job)
+
+    def job_callback(self, name: str, job: int = 0) -> Callable[[float], None]:
+        """
+        Returns a function that updates the progress of a job (to be passed to long-running functions as on_progress callback)
+        """
+        return lambda fraction: self.update(name, fraction, job)
+
+    @property
+    def progress(self) -> float:
+        with self._lock:
+            return self._get_progress()
+
+    def _get_progress(self):
+        return min(
+            1.0,
+            sum(
+                weight * sum(fractions) / len(fractions)
+                for weight, fractions in self._stages.values()
+            ),
+        )
+
+    def _take_due_report(self):
+        # returns the progress to report if a report is due (None otherwise); to be called while holding the lock
+        progress = self._get_progress()
+        now = time.monotonic()
+        if progress - self._reported_progress < MIN_PROGRESS_DELTA:
+            return None
+        if self._reported_at is not None and now - self._reported_at < self._interval:
+            return None
+        self._reported_progress = progress
+        self._reported_at = now
+        return progress
+
+    def _send_report(self, progress):
+        with self._report_lock:
+            # reports that were taken one after the other may get here in any order, but progress never goes backwards
+            if progress <= self._sent_progress:
+                return
+            self._sent_progress = progress
+            try:
+                self._report(progress)
+            except Exception as e:
+                # progress is informational only, it must never break the task
+                logging.error("Could not report progress")
+                logging.exception(e)
+
+
+def bytes_callback(
+    on_progress: Callable[[float], None], total_bytes: int
+) -> Callable[[int], None]:
+    """
+    Turns a progress callback into a callback for boto3 transfers, which report the number of bytes transferred since the last call
+    (possibly from several threads at once)
+    """
+    lock = threading.Lock()
+    transferred = 0
+
+    def callback(bytes_amount):
+        nonlocal transferred
+        with lock:
+            transferred += bytes_amount
+            fraction = transferred / total_bytes if total_bytes else 1.0
+        on_progress(fraction)
+
+    return callback
@@ -0,0 +1,40 @@
+import socket
+import logging
+from typing import List
+
+from shared.settings import STATSD_HOST, STATSD_PORT, STATSD_PREFIX
+
+# keep datagrams below the typical MTU, so that they aren't fragmented (and possibly dropped)
+MAX_DATAGRAM_SIZE = 1432
+
+_socket = None
+
+
+def send_metrics(lines: List[str]):
+    """
+    Sends metrics in the StatsD line format (e.g. "stage.decoding.wall_time:12.3|ms") to STATSD_HOST via UDP.
+    Does nothing if STATSD_HOST is not configured. Errors are logged, but never raised, as metrics are not essential.
+    """
+    global _socket
+    if not STATSD_HOST or not lines:
+        return
+
+    try:
+        if _socket is None:
+            _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for datagram in _batch(f"{STATSD_PREFIX}.{line}" for line in lines):
+            _socket.sendto(datagram.encode("utf-8"), (STATSD_HOST, STATSD_PORT))
+    except Exception as e:
+        logging.error(f"Could not send metrics to StatsD ({STATSD_HOST}:{STATSD_PORT})")
+        logging.exception(e)
+
+
+def _batch(lines):
+    batch = ""
+    for line in lines:
+        if batch and len(batch) + 1 + len(line) > MAX_DATAGRAM_SIZE:
+            yield batch
+            batch = ""
+        batch = f"{batch}\n{line}" if batch else line
+    if batch:
+        yield batch
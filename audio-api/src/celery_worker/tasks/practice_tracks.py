@@ -1,269 +1,987 @@
-import ffmpeg
-from typing import List
+from typing import Callable, List, NamedTuple, Optional
 import os
+import queue
 import logging
 import uuid
 import shutil
+from contextlib import ExitStack, contextmanager
 from zipfile import ZipFile
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import Future, as_completed
+from celery import chord, group
+import numpy as np
 
 from celery_worker import app
-from shared.utils import unzip_file
-from shared.s3 import download_file_from_s3, upload_file_to_s3, create_presigned_s3_url
+from celery_worker.audio import (
+    DecodedTrack,
+    decode_track,
+    encode_mixes,
+    get_pan_gains,
+    mix_mean_volumes,
+)
+from celery_worker.analysis import load_cached_analysis, store_analysis
+from celery_worker.loudness import get_normalization_gains
+from celery_worker.execution import (
+    CPU_SLOTS,
+    JobGroup,
+    cpu_bound,
+    cpu_slots,
+    memory_budget,
+)
+from celery_worker.progress import ProgressTracker, bytes_callback
+from celery_worker.instrumentation import collect_metrics, stage
+from shared.utils import unzip_file, hash_file
+from shared.s3 import (
+    download_file_from_s3,
+    download_json_from_s3,
+    upload_file_to_s3,
+    upload_json_to_s3,
+    get_s3_file_info,
+    remove_file_from_s3,
+    S3MultipartWriter,
+)
+from shared.uploads import (
+    INPUT_EXTENSIONS,
+    get_input_zip_object_name,
+    get_input_object_name,
+    get_manifest_object_name,
+    get_track_name,
+)
+
+from shared.outputs import (
+    create_output,
+    create_tracks_manifest,
+    get_output_zip_object_name,
+    get_track_object_name,
+    get_tracks_manifest_object_name,
+    get_tracks_prefix,
+    get_upload_output_object_name,
+)
+from shared.mixing import (
+    BALANCED_MIX_NAME,
+    DEFAULT_OTHER_TRACKS_VOLUME,
+    DEFAULT_NORMALIZATION,
+    SPLIT_PAN,
+    TARGET_LOUDNESS,
+    db_to_gain,
+    get_mix_track_names,
+    parse_volume,
+)
+from shared.encoding import DEFAULT_ENCODING_PROFILE
+from shared.result_cache import get_output_prefix
+from shared.settings import DISTRIBUTED_MIXING, OUTPUT_LAYOUT
+
+# prefix (below the upload's prefix) of the practice tracks created by distributed tasks, before they are bundled
+DISTRIBUTED_OUTPUTS_PREFIX = "practice_tracks"
+
+
+class Mix(NamedTuple):
+    # file name of the mix
+    filename: str
+    # linear gain of every track, relative to the others
+    gains: List[float]
+    # index of the track whose mean volume the mix gets in the "mean_volume" normalization mode
+    reference: int
+    # position of every track in the stereo panorama, from -1 (left) to 1 (right) (default: all in the center)
+    pan: Optional[List[float]] = None
 
 
 @app.task(bind=True, serializer="json")
-def create(self, upload_id: str):
+def create(
+    self,
+    upload_id: str,
+    other_tracks_volume: str = DEFAULT_OTHER_TRACKS_VOLUME,
+    result_key: str = None,
+    output_layout: str = OUTPUT_LAYOUT,
+    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+    normalization: str = DEFAULT_NORMALIZATION,
+    custom_mixes: List[dict] = None,
+):
     """
     Downloads practice tracks for a given upload_id
     :param upload_id: the id of the upload for which to create practice tracks
-    :return: A signature that when called will create the practice tracks
+    :param other_tracks_volume: volume of the other tracks in each practice track (relative to the main track)
+    :param result_key: if given, the result is stored in the result cache under this key (see shared.result_cache)
+    :param output_layout: how the practice tracks are stored in S3 (see shared.outputs)
+    :param encoding_profile: how the practice tracks are encoded (see shared.encoding)
+    :param normalization: how the volume of the practice tracks is normalized (see shared.mixing)
+    :param custom_mixes: specs of mixes that are created in addition to the practice tracks (see shared.mixing.parse_mixes)
+    :return: where the practice tracks are stored (see shared.outputs.create_output), which the API creates presigned URLs for
     """
     logging.info(f"Creating practice tracks for upload {upload_id}")
 
-    progress = 0
+    if DISTRIBUTED_MIXING:
+        manifest = download_json_from_s3(get_manifest_object_name(upload_id))
+        if manifest is not None:
+            input_names = [file["name"] for file in manifest["files"]]
+            check_input_count(input_names)
+            logging.info(
+                f"Distributing creation of {len(input_names) + 1} tracks across workers"
+            )
+            # the result of the workflow becomes the result of this task (i.e. it is stored under this task's ID)
+            return self.replace(
+                create_distributed_workflow(
+                    upload_id,
+                    input_names,
+                    other_tracks_volume,
+                    result_key,
+                    output_layout,
+                    encoding_profile,
+                    normalization,
+                    custom_mixes,
+                )
+            )
+
+    # progress is reported from the threads that run the jobs, where the task's request context isn't available
+    task_id = self.request.id
+
+    metrics = None
 
     def report_progress(progress):
-        self.update_state(state="PROGRESS", meta={"progress": progress})
+        meta = {"progress": progress}
+        if metrics is not None:
+            meta["metrics"] = metrics.as_dict()
+        self.update_state(task_id=task_id, state="PROGRESS", meta=meta)
+
+    progress = ProgressTracker(report_progress)
+    output_prefix = get_output_prefix(upload_id, result_key)
 
-    # download the zip file from S3 to a temporary file
     tmp_root = os.path.abspath("tmp")
     tmp_dir = os.path.join(tmp_root, f"{uuid.uuid4()}")
     os.makedirs(tmp_dir, exist_ok=True)
 
     try:
-        relative_s3_zip_path = f"{upload_id}/input_files.zip"
-        file_path = os.path.join(tmp_dir, os.path.basename(relative_s3_zip_path))
-
-        logging.info(
-            f"Downloading zip file from S3 (path: {relative_s3_zip_path}) to '{file_path}'"
-        )
-        download_file_from_s3(relative_s3_zip_path, file_path)
-        progress += 0.1
-        report_progress(progress)
-
-        logging.info(f"Extracting zip file to {tmp_dir}")
-        unzip_file(file_path, tmp_dir)
-        progress += 0.1
-        report_progress(progress)
-
-        input_files = [
-            os.path.join(tmp_dir, file)
-            for file in os.listdir(tmp_dir)
-            if file.endswith(".mp3")
-        ]
-
-        if len(input_files) < 2:
-            logging.info(
-                f"Cancelling task as there are not enough mp3 files {len(input_files)} instead of at least 2)"
-            )
-            raise Exception(
-                f"Input directory must contain at least 2 mp3 files (found only {len(input_files)}"
-            )
-
-        logging.info(
-            f"Found the following files: {[os.path.basename(f) for f in input_files]}"
-        )
-
-        practice_tracks_dir = os.path.join(tmp_dir, "practice_tracks")
-        os.makedirs(practice_tracks_dir, exist_ok=True)
+        # the decoded tracks of this task are kept in memory as long as they fit into its budget (see celery_worker.audio.decode_track)
+        with collect_metrics("create") as metrics, memory_budget():
+            inputs_dir = os.path.join(tmp_dir, "inputs")
+            os.makedirs(inputs_dir, exist_ok=True)
+            practice_tracks_dir = os.path.join(tmp_dir, "practice_tracks")
+            os.makedirs(practice_tracks_dir, exist_ok=True)
+            pcm_dir = os.path.join(tmp_dir, "pcm")
+            os.makedirs(pcm_dir, exist_ok=True)
+
+            # threads are sufficient here: the heavy lifting happens in ffmpeg subprocesses and in numpy (which releases the GIL)
+            # as a bonus, all mixes can share the decoded tracks without copying them between processes
+            # the threads are shared by all tasks of this worker process, and CPU-bound jobs are limited by the worker's CPU budget
+            with JobGroup() as executor:
+
+                manifest = download_json_from_s3(get_manifest_object_name(upload_id))
+                if manifest is not None:
+                    # every input file is a separate object in S3: download them concurrently and decode each one as soon as it is available
+                    input_names = [file["name"] for file in manifest["files"]]
+                    input_hashes = get_input_hashes(manifest)
+                    check_input_count(input_names)
+                    metrics.voices = len(input_names)
+                    logging.info(f"Downloading and decoding input files {input_names}")
+
+                    progress.add_stage("loading", 0.3, len(input_names))
+                    track_futures = [
+                        executor.submit(
+                            download_and_load_track,
+                            upload_id,
+                            name,
+                            inputs_dir,
+                            pcm_dir,
+                            progress.job_callback("loading", i),
+                            input_hashes.get(name),
+                        )
+                        for i, name in enumerate(input_names)
+                    ]
+                else:
+                    # all input files are in a single zip file in S3
+                    progress.add_stage("download", 0.2)
+                    input_files = download_input_zip(upload_id, tmp_dir, inputs_dir)
+                    progress.complete("download")
+                    check_input_count(input_files)
+                    metrics.voices = len(input_files)
+                    logging.info(
+                        f"Found the following files: {[os.path.basename(f) for f in input_files]}"
+                    )
 
-        with ProcessPoolExecutor() as executor:
-            futures = []
-            for i in range(len(input_files)):
-                main_track = input_files[i]
-                other_tracks = input_files[:i] + input_files[i + 1 :]
-                futures.append(
+                    progress.add_stage("loading", 0.1, len(input_files))
+                    track_futures = [
+                        executor.submit(
+                            load_track,
+                            path,
+                            pcm_dir,
+                            progress.job_callback("loading", i),
+                        )
+                        for i, path in enumerate(input_files)
+                    ]
+
+                for future in as_completed(track_futures):
+                    # re-raises any exception that occurred while downloading/decoding the track
+                    future.result()
+                tracks = [future.result() for future in track_futures]
+
+                # every practice track (and the balanced mix) is a row of the gain matrix, i.e. a linear combination of the tracks
+                mixes = [
+                    get_practice_track_mix(tracks, i, other_tracks_volume)
+                    for i in range(len(tracks))
+                ]
+                mixes.append(get_balanced_mix(tracks))
+                # custom mixes are just more rows, they are created from the same decoded tracks
+                mixes.extend(
+                    get_custom_mix(tracks, spec, other_tracks_volume)
+                    for spec in custom_mixes or []
+                )
+                gain_matrix = get_gain_matrix(tracks, mixes, normalization)
+
+                # every job mixes and encodes a batch of mixes at once (with one ffmpeg process, i.e. CPU slot, per mix),
+                # reading the decoded tracks only once for all of them.
+                # Every mix is passed on through this queue as soon as it is encoded (followed by its job, once that is done)
+                encoded = queue.Queue()
+                batches = get_mix_batches(len(mixes))
+                progress.add_stage("mixing", 0.5, len(batches))
+                futures = [
                     executor.submit(
-                        create_practice_track,
-                        main_track,
-                        other_tracks,
+                        create_mixes,
+                        tracks,
+                        [mixes[j] for j in batch],
+                        gain_matrix[batch],
                         practice_tracks_dir,
+                        progress.job_callback("mixing", i),
+                        encoding_profile,
+                        encoded.put,
                     )
-                )
-            futures.append(
-                executor.submit(create_balanced_mix, input_files, practice_tracks_dir)
-            )
-            # estimate: file processing takes 50% of the total processing time
-            file_processing_progress_share = 0.5
-            progress_per_task = file_processing_progress_share / len(futures)
-
-            # wait for all futures to complete
-            for future in as_completed(futures):
-                # not interested in result (which we would get with future.result()) as it is None
-                # but, we want to update the progress
-                progress += progress_per_task
-                report_progress(progress)
-                # if we were interested, we could get it with future.result() and store it in a variable like so:
-                # result = future.result()
-                # print(result)
-
-        # upload the practice tracks to S3
-        logging.info(f"Uploading practice tracks to S3")
-
-        # create zip file
-        zip_name = "practice_tracks.zip"
-        zip_path = os.path.join(tmp_dir, zip_name)
-        with ZipFile(zip_path, "w") as zip_file:
-            for file in os.listdir(practice_tracks_dir):
-                zip_file.write(
-                    os.path.join(practice_tracks_dir, file),
-                    os.path.basename(file),
-                )
-        progress += 0.1
-
-        # upload zip file to S3
-        s3_relative_path = f"{upload_id}/{zip_name}"
-        upload_file_to_s3(zip_path, s3_relative_path)
-        progress += 0.2
-        report_progress(progress)
-
-        # create presigned url for the zip file
-        presigned_url = create_presigned_s3_url(s3_relative_path)
-        progress = 1
-
-        return presigned_url
-
-        # TODO: figure out how to chain tasks so that multiprocessing is actually handled by celery
-        # possible roadblock: submitting tasks across different workers would mean that the files would not be available locally on the worker
-        # subtasks = [
-        #     create_practice_track.s(
-        #         main_track_path=input_files[i],
-        #         other_track_paths=input_files[:i] + input_files[i + 1 :],
-        #         output_dir=practice_tracks_dir,
-        #     )
-        #     for i in range(len(input_files))
-        # ]
-        # subtasks.append(
-        #     create_balanced_mix.s(
-        #         track_paths=input_files, output_dir=practice_tracks_dir
-        #     )
-        # )
-
-        # job = chain(group(subtasks), remove_temporary_files)
-
-        # return job
+                    for i, batch in enumerate(batches)
+                ]
+                for future in futures:
+                    future.add_done_callback(encoded.put)
+
+                progress.add_stage("upload", 0.2, len(mixes))
+                upload_futures = []
+                uploaded = 0
+                with ExitStack() as outputs:
+                    if output_layout == "zip":
+                        zip_file = outputs.enter_context(
+                            open_output_zip(get_output_zip_object_name(output_prefix))
+                        )
+                    # wait for all jobs to complete
+                    pending = len(futures)
+                    while pending:
+                        track_path = encoded.get()
+                        if isinstance(track_path, Future):
+                            # re-raises any exception that occurred while creating the tracks
+                            track_path.result()
+                            pending -= 1
+                            continue
+                        # every track is uploaded as soon as it's done, while the remaining ones are still being encoded
+                        if output_layout == "tracks":
+                            upload_futures.append(
+                                executor.submit(
+                                    upload_track,
+                                    track_path,
+                                    output_prefix,
+                                    progress.job_callback("upload", uploaded),
+                                )
+                            )
+                        else:
+                            add_to_output_zip(zip_file, track_path)
+                            progress.complete("upload", uploaded)
+                        uploaded += 1
+                    for future in upload_futures:
+                        future.result()
+
+            if output_layout == "tracks":
+                output = publish_tracks(output_prefix, [mix.filename for mix in mixes])
+            else:
+                output = create_output(output_prefix)
+            return store_upload_output(upload_id, output)
 
     except Exception as e:
         logging.error("Error while creating practice tracks")
         logging.exception(e)
         raise e
     finally:
-        remove_temporary_files(upload_id)
+        remove_temporary_files(upload_id, tmp_dir)
+
+
+def create_distributed_workflow(
+    upload_id,
+    input_names,
+    other_tracks_volume,
+    result_key=None,
+    output_layout=OUTPUT_LAYOUT,
+    encoding_profile=DEFAULT_ENCODING_PROFILE,
+    normalization=DEFAULT_NORMALIZATION,
+    custom_mixes=None,
+):
+    """
+    Creates a workflow that renders every practice track (and the balanced mix, and every custom mix) in a separate task, so that they can run on different workers.
+    Once all of them are done, the practice tracks are bundled in a zip file (or, in the "tracks" layout, listed in a manifest).
+
+    Note: every task has to download and decode all input files, so this only pays off if there are enough workers (and voices)
+    """
+    output_prefix = get_output_prefix(upload_id, result_key)
+    # in the "tracks" layout, the render tasks upload the tracks to their final location right away
+    object_prefix = (
+        get_tracks_prefix(output_prefix)
+        if output_layout == "tracks"
+        else f"{upload_id}/{DISTRIBUTED_OUTPUTS_PREFIX}"
+    )
+    render_tasks = [
+        render_practice_track.s(
+            upload_id,
+            input_names,
+            name,
+            other_tracks_volume,
+            object_prefix,
+            encoding_profile,
+            normalization,
+        )
+        for name in input_names
+    ]
+    render_tasks.append(
+        render_balanced_mix.s(
+            upload_id, input_names, object_prefix, encoding_profile, normalization
+        )
+    )
+    render_tasks.extend(
+        render_custom_mix.s(
+            upload_id,
+            input_names,
+            spec,
+            other_tracks_volume,
+            object_prefix,
+            encoding_profile,
+            normalization,
+        )
+        for spec in custom_mixes or []
+    )
+    if output_layout == "tracks":
+        return chord(
+            group(render_tasks),
+            publish_distributed_tracks.s(
+                upload_id=upload_id, output_prefix=output_prefix
+            ),
+        )
+    return chord(
+        group(render_tasks),
+        bundle_practice_tracks.s(upload_id=upload_id, result_key=result_key),
+    )
 
 
-# @app.task
-def create_balanced_mix(
-    track_paths: List[str],
-    output_dir: str,
+@app.task(serializer="json")
+def render_practice_track(
+    upload_id: str,
+    input_names: List[str],
+    main_track_name: str,
+    other_tracks_volume: str = DEFAULT_OTHER_TRACKS_VOLUME,
+    object_prefix: str = None,
+    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+    normalization: str = DEFAULT_NORMALIZATION,
 ):
-    filename = "all.mp3"
-    logging.debug(f"Creating balanced mix of {len(track_paths)} tracks")
-    # get the first track's mean volume (measured in negative dB; volume of 0dB is the maximum volume, so -10dB is quieter than -5)
-    # assumption: all tracks have the same mean volume - if this is not the case, results might be unexpected!
-    original_mean_volume = get_volume(track_paths[0])
+    """
+    Creates the practice track for one of the input files of an upload and uploads it to S3 (part of the distributed workflow)
+    :param object_prefix: prefix of the practice track in S3 (see render_from_s3)
+    :return: the name of the practice track in S3
+    """
+
+    def render(tracks, output_dir):
+        i = input_names.index(main_track_name)
+        create_practice_track(
+            tracks[i],
+            tracks[:i] + tracks[i + 1 :],
+            output_dir,
+            other_tracks_volume,
+            encoding_profile=encoding_profile,
+            normalization=normalization,
+        )
+
+    return render_from_s3(upload_id, input_names, render, object_prefix)
+
+
+@app.task(serializer="json")
+def render_balanced_mix(
+    upload_id: str,
+    input_names: List[str],
+    object_prefix: str = None,
+    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+    normalization: str = DEFAULT_NORMALIZATION,
+):
+    """
+    Creates the balanced mix of all input files of an upload and uploads it to S3 (part of the distributed workflow)
+    :param object_prefix: prefix of the balanced mix in S3 (see render_from_s3)
+    :return: the name of the balanced mix in S3
+    """
+
+    def render(tracks, output_dir):
+        create_balanced_mix(
+            tracks,
+            output_dir,
+            encoding_profile=encoding_profile,
+            normalization=normalization,
+        )
+
+    return render_from_s3(upload_id, input_names, render, object_prefix)
+
+
+@app.task(serializer="json")
+def render_custom_mix(
+    upload_id: str,
+    input_names: List[str],
+    spec: dict,
+    other_tracks_volume: str = DEFAULT_OTHER_TRACKS_VOLUME,
+    object_prefix: str = None,
+    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+    normalization: str = DEFAULT_NORMALIZATION,
+):
+    """
+    Creates a custom mix of the input files of an upload and uploads it to S3 (part of the distributed workflow)
+    :param spec: the spec of the mix (see shared.mixing.parse_mixes)
+    :param object_prefix: prefix of the mix in S3 (see render_from_s3)
+    :return: the name of the mix in S3
+    """
+
+    def render(tracks, output_dir):
+        create_mix(
+            tracks,
+            get_custom_mix(tracks, spec, other_tracks_volume),
+            output_dir,
+            encoding_profile=encoding_profile,
+            normalization=normalization,
+        )
+
+    return render_from_s3(upload_id, input_names, render, object_prefix)
+
+
+@app.task(bind=True, serializer="json")
+def bundle_practice_tracks(
+    self, object_names: List[str], upload_id: str, result_key: str = None
+):
+    """
+    Downloads the practice tracks created by the distributed workflow, zips them and uploads the zip file to S3
+    :param object_names: names of the practice tracks in S3 (results of the render tasks)
+    :return: where the zip file is stored (see shared.outputs.create_output)
+    """
+    # this task runs under the ID of the original create task, so progress is reported to the client
+    # (from boto3's transfer threads while uploading, hence the task ID is passed explicitly)
+    task_id = self.request.id
+    progress = ProgressTracker(
+        lambda progress: self.update_state(
+            task_id=task_id, state="PROGRESS", meta={"progress": progress}
+        )
+    )
+    progress.add_stage("rendering", 0.8)
+    progress.add_stage("upload", 0.2)
+    progress.complete("rendering")
+
+    output_prefix = get_output_prefix(upload_id, result_key)
+    with collect_metrics("bundle") as metrics:
+        metrics.voices = len(object_names) - 1
+        bundle_objects(
+            object_names,
+            get_output_zip_object_name(output_prefix),
+            progress.job_callback("upload"),
+        )
+    for object_name in object_names:
+        remove_file_from_s3(object_name)
+    return store_upload_output(upload_id, create_output(output_prefix))
+
+
+@app.task(serializer="json")
+def publish_distributed_tracks(
+    object_names: List[str], upload_id: str, output_prefix: str
+):
+    """
+    Publishes the practice tracks created by the distributed workflow in the "tracks" layout (see publish_tracks)
+    :param object_names: names of the practice tracks in S3 (results of the render tasks)
+    """
+    output = publish_tracks(
+        output_prefix, [os.path.basename(object_name) for object_name in object_names]
+    )
+    return store_upload_output(upload_id, output)
+
+
+@app.task(serializer="json")
+def zip_tracks(output_prefix: str):
+    """
+    Bundles practice tracks stored in the "tracks" layout (see shared.outputs) in a zip file, unless that was done before
+    :param output_prefix: the output prefix of the practice tracks
+    :return: where the zip file is stored (see shared.outputs.create_output)
+    """
+    output = create_output(output_prefix)
+    if get_s3_file_info(output["zip"]) is not None:
+        return output
+
+    manifest = download_json_from_s3(get_tracks_manifest_object_name(output_prefix))
+    if manifest is None:
+        raise Exception(f"No practice tracks found in {output_prefix}")
+    with collect_metrics("zip") as metrics:
+        metrics.voices = len(manifest["tracks"]) - 1
+        bundle_objects([track["object"] for track in manifest["tracks"]], output["zip"])
+    return output
+
+
+def publish_tracks(output_prefix, filenames):
+    """
+    Stores the manifest of practice tracks that were uploaded in the "tracks" layout (see shared.outputs)
+    :param filenames: file names of the practice tracks
+    :return: where the practice tracks are stored (see shared.outputs.create_output)
+    """
+    manifest = create_tracks_manifest(output_prefix, filenames)
+    # the manifest is written last: once it exists, all tracks are available (which is what the result cache relies on)
+    if not upload_json_to_s3(manifest, get_tracks_manifest_object_name(output_prefix)):
+        raise Exception(f"Could not upload manifest of {output_prefix}")
+    return create_output(output_prefix, manifest)
+
+
+def store_upload_output(upload_id, output):
+    """
+    Stores where the practice tracks of an upload are (see shared.outputs.get_upload_output_object_name),
+    so that the API still finds them once the result of the task expired
+    :return: the output (which is the result of the task)
+    """
+    # clients can still get the tracks from the task's result if this fails, so it doesn't fail the task
+    upload_json_to_s3(output, get_upload_output_object_name(upload_id))
+    return output
 
-    input_streams = [ffmpeg.input(path, format="mp3") for path in track_paths]
 
-    # Combine the input streams into a single output stream (i.e. audio from all files 'playing' at once)
-    # amix is a filter that mixes multiple audio streams into one. however, it only accepts two inputs at a time
-    # hence, we need to add the streams one by one
-    combined_audio = ffmpeg.filter(
-        input_streams, "amix", inputs=len(input_streams), dropout_transition=0
+def upload_track(path, output_prefix, on_progress=None):
+    """
+    Uploads a practice track in the "tracks" layout (see shared.outputs)
+    """
+    object_name = get_track_object_name(output_prefix, os.path.basename(path))
+    callback = (
+        bytes_callback(on_progress, os.path.getsize(path))
+        if on_progress is not None
+        else None
+    )
+    with stage("upload"):
+        if not upload_file_to_s3(path, object_name, callback=callback):
+            raise Exception(f"Could not upload {object_name}")
+
+
+def bundle_objects(object_names, zip_object_name, on_progress=None):
+    """
+    Downloads objects from S3 concurrently and streams them into a zip file in S3 as soon as they are downloaded
+    :param on_progress: called with the fraction of the objects that were added to the zip file so far
+    """
+    tmp_dir = os.path.join(os.path.abspath("tmp"), f"{uuid.uuid4()}")
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        with JobGroup() as executor, open_output_zip(zip_object_name) as zip_file:
+            futures = [
+                executor.submit(download_object, object_name, tmp_dir)
+                for object_name in object_names
+            ]
+            for i, future in enumerate(as_completed(futures)):
+                path = future.result()
+                add_to_output_zip(zip_file, path)
+                # the local copy isn't needed anymore
+                os.remove(path)
+                if on_progress is not None:
+                    on_progress((i + 1) / len(futures))
+    finally:
+        remove_temporary_files(zip_object_name, tmp_dir)
+
+
+def download_object(object_name, directory):
+    """
+    Downloads an object from S3 into a directory (keeping its base name)
+    :return: the path of the downloaded file
+    """
+    path = os.path.join(directory, os.path.basename(object_name))
+    with stage("download"):
+        if not download_file_from_s3(object_name, path):
+            raise Exception(f"Could not download {object_name}")
+    return path
+
+
+def render_from_s3(upload_id, input_names, render, object_prefix=None):
+    """
+    Downloads and decodes the input files of an upload, renders a track from them and uploads it to S3
+    :param render: function that writes the track to a directory, given the decoded tracks (in the order of input_names) and the directory
+    :param object_prefix: prefix of the rendered track in S3 (default: a temporary location below the upload's prefix)
+    :return: the name of the rendered track in S3
+    """
+    tmp_dir = os.path.join(os.path.abspath("tmp"), f"{uuid.uuid4()}")
+    inputs_dir = os.path.join(tmp_dir, "inputs")
+    output_dir = os.path.join(tmp_dir, "practice_tracks")
+    pcm_dir = os.path.join(tmp_dir, "pcm")
+    for directory in (inputs_dir, output_dir, pcm_dir):
+        os.makedirs(directory, exist_ok=True)
+
+    try:
+        with collect_metrics("render") as metrics, memory_budget():
+            metrics.voices = len(input_names)
+            input_hashes = get_input_hashes(
+                download_json_from_s3(get_manifest_object_name(upload_id))
+            )
+            with JobGroup() as executor:
+                tracks = list(
+                    executor.map(
+                        lambda name: download_and_load_track(
+                            upload_id,
+                            name,
+                            inputs_dir,
+                            pcm_dir,
+                            sha256=input_hashes.get(name),
+                        ),
+                        input_names,
+                    )
+                )
+            render(tracks, output_dir)
+
+            (filename,) = os.listdir(output_dir)
+            if object_prefix is None:
+                object_prefix = f"{upload_id}/{DISTRIBUTED_OUTPUTS_PREFIX}"
+            object_name = f"{object_prefix}/{filename}"
+            with stage("upload"):
+                if not upload_file_to_s3(
+                    os.path.join(output_dir, filename), object_name
+                ):
+                    raise Exception(f"Could not upload {object_name}")
+            return object_name
+    finally:
+        remove_temporary_files(upload_id, tmp_dir)
+
+
+@cpu_bound
+def load_track(path, pcm_dir, on_progress=None, file_hash=None):
+    # decode (and analyze) every input file exactly once; all mixes are created from the decoded samples
+    # files that weren't analyzed before are analyzed while they are decoded, instead of decoding them twice
+    # (for files that were, the cached analysis includes the format, so ffmpeg doesn't have to probe them again)
+    if file_hash is None:
+        file_hash = hash_file(path)
+    analysis = load_cached_analysis(file_hash)
+    if analysis is not None:
+        return decode_track(
+            path,
+            pcm_dir,
+            analysis.get("duration"),
+            on_progress,
+            input_format=analysis.get("format"),
+        )._replace(analysis=analysis)
+    track = decode_track(path, pcm_dir, on_progress=on_progress, analyze=True)
+    store_analysis(file_hash, track.analysis)
+    return track
+
+
+def download_and_load_track(
+    upload_id, name, inputs_dir, pcm_dir, on_progress=None, sha256=None
+):
+    """
+    Downloads an input file of an upload (stored as separate object, see shared.uploads) from S3 and decodes it
+    :param on_progress: called with the fraction of the work that is done (downloading counts as half of it)
+    :param sha256: SHA-256 of the file from the upload's manifest; the file is rejected if it doesn't match
+    """
+    path = os.path.join(inputs_dir, name)
+    with stage("download"):
+        if not download_file_from_s3(get_input_object_name(upload_id, name), path):
+            raise Exception(f"Could not download input file {name}")
+    if sha256 is not None:
+        # the hashes of files that clients uploaded directly to S3 are the ones the clients declared,
+        # they must not end up in the result cache for files with different content
+        with stage("verification"):
+            if hash_file(path) != sha256:
+                raise Exception(f"Input file {name} does not match its SHA-256")
+    if on_progress is None:
+        return load_track(path, pcm_dir, file_hash=sha256)
+    on_progress(0.5)
+    return load_track(
+        path, pcm_dir, lambda fraction: on_progress(0.5 + fraction / 2), sha256
     )
 
-    # Define a temporary output stream and write it to a temporary file
-    temp_out_path = os.path.join(output_dir, f"temp_all.mp3")
-    temp_out = ffmpeg.output(combined_audio, temp_out_path)
-    ffmpeg.run(temp_out, quiet=True)
 
-    # get the mean volume of the temporary output file
-    temp_mean_volume = get_volume(temp_out_path)
-    # can delete the temporary output file now
-    os.remove(temp_out_path)
+def get_input_hashes(manifest):
+    """
+    :return: the SHA-256 of every input file by name (empty if there is no manifest)
+    """
+    if manifest is None:
+        return {}
+    return {file["name"]: file.get("sha256") for file in manifest["files"]}
+
+
+@contextmanager
+def open_output_zip(zip_object_name):
+    """
+    Opens a zip file for the practice tracks that is streamed into S3 while it is written (see shared.s3.S3MultipartWriter),
+    so that tracks can be added as soon as they are done instead of zipping and uploading all of them at the end.
+    The zip file only appears in S3 once the with block is left without an exception.
+    :param zip_object_name: name of the zip file in S3 (see shared.outputs)
+    """
+    logging.info(f"Streaming practice tracks to S3 ({zip_object_name})")
+    with S3MultipartWriter(zip_object_name) as s3_file:
+        # S3MultipartWriter is not seekable, so ZipFile writes the sizes and CRCs after each file's data
+        with ZipFile(s3_file, "w") as zip_file:
+            yield zip_file
+        with stage("upload"):
+            s3_file.close()
+
+
+def add_to_output_zip(zip_file, path):
+    # full parts of the multipart upload are uploaded while writing
+    with stage("upload"):
+        zip_file.write(path, os.path.basename(path))
+
 
-    volume_diff = original_mean_volume - temp_mean_volume
+def download_input_zip(upload_id, tmp_dir, inputs_dir):
+    """
+    Downloads the zip file with the input files of an upload from S3 and extracts it
+    :return: the paths of the extracted audio files
+    """
+    relative_s3_zip_path = get_input_zip_object_name(upload_id)
+    file_path = os.path.join(tmp_dir, os.path.basename(relative_s3_zip_path))
 
-    # apply the volume difference to the combined audio stream
-    combined_audio = ffmpeg.filter(combined_audio, "volume", f"{volume_diff}dB")
+    logging.info(
+        f"Downloading zip file from S3 (path: {relative_s3_zip_path}) to '{file_path}'"
+    )
+    with stage("download"):
+        if not download_file_from_s3(relative_s3_zip_path, file_path):
+            raise Exception(f"Could not download {relative_s3_zip_path}")
 
-    # write the output stream with the volume adjustment to the output file
-    out_path = os.path.join(output_dir, filename)
-    out = ffmpeg.output(combined_audio, out_path)
-    ffmpeg.run(out, quiet=True)
+    logging.info(f"Extracting zip file to {inputs_dir}")
+    with stage("unzip"):
+        unzip_file(file_path, inputs_dir)
+
+    return [
+        os.path.join(inputs_dir, file)
+        for file in os.listdir(inputs_dir)
+        if file.lower().endswith(INPUT_EXTENSIONS)
+    ]
+
+
+def check_input_count(input_files):
+    if len(input_files) < 2:
+        logging.info(
+            f"Cancelling task as there are not enough audio files {len(input_files)} instead of at least 2)"
+        )
+        raise Exception(
+            f"Input directory must contain at least 2 audio files (found only {len(input_files)}"
+        )
+
+
+def create_balanced_mix(
+    tracks: List[DecodedTrack],
+    output_dir: str,
+    on_progress=None,
+    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+    normalization: str = DEFAULT_NORMALIZATION,
+):
+    logging.debug(f"Creating balanced mix of {len(tracks)} tracks")
+    return create_mix(
+        tracks,
+        get_balanced_mix(tracks),
+        output_dir,
+        on_progress,
+        encoding_profile,
+        normalization,
+    )
 
 
-# @app.task
 def create_practice_track(
-    main_track_path: str,
-    other_track_paths: List[str],
+    main_track: DecodedTrack,
+    other_tracks: List[DecodedTrack],
     output_dir: str,
-    other_tracks_volume: str = "-10dB",
+    other_tracks_volume: str = DEFAULT_OTHER_TRACKS_VOLUME,
+    on_progress=None,
+    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+    normalization: str = DEFAULT_NORMALIZATION,
 ):
-    main_filename = os.path.basename(main_track_path)
     logging.debug(
-        f"Creating practice track for {main_filename} with {len(other_track_paths)} other tracks"
+        f"Creating practice track for {main_track.path} with {len(other_tracks)} other tracks"
+    )
+    tracks = [main_track] + other_tracks
+    return create_mix(
+        tracks,
+        get_practice_track_mix(tracks, 0, other_tracks_volume),
+        output_dir,
+        on_progress,
+        encoding_profile,
+        normalization,
+    )
+
+
+def create_mix(
+    tracks: List[DecodedTrack],
+    mix: Mix,
+    output_dir: str,
+    on_progress=None,
+    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+    normalization: str = DEFAULT_NORMALIZATION,
+):
+    """
+    Creates a single mix of decoded tracks (see create_mixes)
+    :return: the path of the mix
+    """
+    (out_path,) = create_mixes(
+        tracks,
+        [mix],
+        get_gain_matrix(tracks, [mix], normalization),
+        output_dir,
+        on_progress,
+        encoding_profile,
     )
+    return out_path
 
-    # create input streams for each file
-    main_stream = ffmpeg.input(main_track_path, format="mp3")
-    # get the main track's mean volume (measured in negative dB; volume of 0dB is the maximum volume, so -10dB is quieter than -5)
-    original_mean_volume = get_volume(main_track_path)
 
-    input_streams = [main_stream]
-    # other tracks should be quieter than the main track => apply volume filter
-    for path in other_track_paths:
-        input_stream = ffmpeg.input(path, format="mp3").filter(
-            "volume", other_tracks_volume
+def get_practice_track_mix(
+    tracks: List[DecodedTrack], main_index: int, other_tracks_volume: str
+) -> Mix:
+    """
+    :return: the practice track for one of the tracks (the main track), i.e. a mix in which the other tracks are quieter
+    """
+    # the practice tracks are mp3 files, no matter the format of the input files
+    filename = f"{os.path.splitext(os.path.basename(tracks[main_index].path))[0]}.mp3"
+    # other tracks should be quieter than the main track
+    other_gain = parse_volume(other_tracks_volume)
+    gains = [1.0 if i == main_index else other_gain for i in range(len(tracks))]
+    # in the "mean_volume" mode, the practice track gets the main track's mean volume
+    return Mix(filename, gains, main_index)
+
+
+def get_balanced_mix(tracks: List[DecodedTrack]) -> Mix:
+    """
+    :return: the mix of all tracks at the same volume
+    """
+    # in the "mean_volume" mode, the mix gets the first track's mean volume
+    # assumption: all tracks have the same mean volume - if this is not the case, results might be unexpected!
+    return Mix(f"{BALANCED_MIX_NAME}.mp3", [1.0] * len(tracks), 0)
+
+
+def get_custom_mix(
+    tracks: List[DecodedTrack], spec: dict, other_tracks_volume: str
+) -> Mix:
+    """
+    :param spec: the spec of the mix, as validated by the API (see shared.mixing.parse_mixes)
+    :param other_tracks_volume: the default volume of the tracks other than the mix's main track (if it has one)
+    :return: the custom mix
+    """
+    track_names = [get_track_name(os.path.basename(track.path)) for track in tracks]
+    for track_name in get_mix_track_names(spec):
+        # the API only checks this if it knows the input files when the upload is received
+        if track_name not in track_names:
+            raise ValueError(f"Unknown track '{track_name}' in mix '{spec['name']}'")
+    main = track_names.index(spec["main"]) if spec["main"] is not None else None
+
+    default_gain = spec["default_volume"]
+    if default_gain is None:
+        default_gain = parse_volume(other_tracks_volume) if main is not None else 1.0
+    gains = [
+        (
+            0.0
+            if name in spec["mute"]
+            else spec["volumes"].get(name, 1.0 if i == main else default_gain)
         )
-        input_streams.append(input_stream)
+        for i, name in enumerate(track_names)
+    ]
+    if spec["pan"] == SPLIT_PAN:
+        pan = [-1.0 if i == main else 1.0 for i in range(len(tracks))]
+    else:
+        pan = [spec["pan"].get(name, 0.0) for name in track_names]
+    # in the "mean_volume" mode, the mix gets the main track's mean volume, or the one of its loudest track
+    # (the first one if several are equally loud, like in the balanced mix), which is never a muted one
+    reference = main if main is not None else gains.index(max(gains))
+    return Mix(f"{spec['name']}.mp3", gains, reference, pan)
+
+
+def get_gain_matrix(
+    tracks: List[DecodedTrack],
+    mixes: List[Mix],
+    normalization: str = DEFAULT_NORMALIZATION,
+) -> np.ndarray:
+    """
+    Computes the gains for mixing decoded tracks (i.e. audio from all tracks 'playing' at once) such that the volume of every mix
+    is normalized (see shared.mixing)
 
-    # Combine the input streams into a single output stream (i.e. audio from all files 'playing' at once)
-    # amix is a filter that mixes multiple audio streams into one. however, it only accepts two inputs at a time
-    # hence, we need to add the streams one by one
-    combined_audio = ffmpeg.filter(
-        input_streams, "amix", inputs=len(input_streams), dropout_transition=0
+    :return: the linear gain of every channel of every track in every mix, with shape (mixes, tracks, CHANNELS)
+        (see celery_worker.audio.iter_mixes)
+    """
+    gains = np.array([mix.gains for mix in mixes])
+    pan_gains = np.array(
+        [get_pan_gains(mix.pan or [0.0] * len(tracks)) for mix in mixes]
+    )
+    if normalization == "loudness":
+        # the gains are known before mixing, so the mixes don't have to be measured
+        # (panning a track changes its energy, which is accounted for by the RMS of the gains of its channels)
+        pan_rms = np.sqrt(np.mean(pan_gains**2, axis=2))
+        loudness = [track.analysis["integrated_loudness"] for track in tracks]
+        normalized_gains = np.array(
+            [
+                get_normalization_gains(loudness, list(mix_gains), TARGET_LOUDNESS)
+                for mix_gains in gains * pan_rms
+            ]
+        )
+        return (
+            np.divide(
+                normalized_gains,
+                pan_rms,
+                out=np.zeros_like(normalized_gains),
+                where=pan_rms > 0,
+            )[:, :, None]
+            * pan_gains
+        )
+    if normalization != "mean_volume":
+        raise ValueError(f"Invalid normalization '{normalization}'")
+
+    gain_matrix = gains[:, :, None] * pan_gains
+    # mean volumes are measured in negative dB; volume of 0dB is the maximum volume, so -10dB is quieter than -5
+    with cpu_slots(), stage("mixing"):
+        # the mean volume of all mixes is computed in a single pass over the tracks (without mixing them),
+        # so that every mix only has to be mixed and encoded once
+        volumes = mix_mean_volumes(tracks, gain_matrix)
+    volume_diffs = [
+        tracks[mix.reference].analysis["mean_volume"] - volume
+        for mix, volume in zip(mixes, volumes)
+    ]
+    return (
+        gain_matrix
+        * np.array([db_to_gain(diff) for diff in volume_diffs])[:, None, None]
     )
 
-    # Define a temporary output stream and write it to a temporary file
-    temp_out_path = os.path.join(output_dir, f"temp_{main_filename}")
-    temp_out = ffmpeg.output(combined_audio, temp_out_path)
-    ffmpeg.run(temp_out, quiet=True)
 
-    # get the mean volume of the temporary output file
-    temp_mean_volume = get_volume(temp_out_path)
-    # can delete the temporary output file now
-    os.remove(temp_out_path)
+def get_mix_batches(mix_count: int) -> List[List[int]]:
+    """
+    Splits mixes into as few batches as possible that can be created at once (see create_mixes), all of about the same size.
+    Typically, all mixes of an upload fit into a single batch: they still don't have to wait for each other
+    to be uploaded, as create_mixes hands on every mix as soon as it is encoded.
+    :return: the indices of the mixes in every batch
+    """
+    batch_count = -(-mix_count // CPU_SLOTS)
+    return [list(range(i, mix_count, batch_count)) for i in range(batch_count)]
 
-    volume_diff = original_mean_volume - temp_mean_volume
 
-    # apply the volume difference to the combined audio stream
-    combined_audio = ffmpeg.filter(combined_audio, "volume", f"{volume_diff}dB")
+def create_mixes(
+    tracks: List[DecodedTrack],
+    mixes: List[Mix],
+    gain_matrix: np.ndarray,
+    output_dir: str,
+    on_progress=None,
+    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+    on_encoded: Optional[Callable[[str], None]] = None,
+) -> List[str]:
+    """
+    Mixes decoded tracks into several mixes at once and encodes them (see celery_worker.audio.encode_mixes),
+    using one CPU slot per mix
 
-    # write the output stream with the volume adjustment to the output file
-    out_path = os.path.join(output_dir, os.path.basename(main_track_path))
-    out = ffmpeg.output(combined_audio, out_path)
-    ffmpeg.run(out, quiet=True)
+    :param gain_matrix: the (normalized) gain of every channel of every track in every mix, with shape (mixes, tracks, CHANNELS)
+        (see get_gain_matrix)
+    :param on_encoded: called with the path of every mix as soon as it is encoded (before the others are)
+    :return: the paths of the mixes
+    """
+    out_paths = [os.path.join(output_dir, mix.filename) for mix in mixes]
+    logging.debug(
+        f"Creating {[mix.filename for mix in mixes]} from {len(tracks)} tracks"
+    )
+    with cpu_slots(len(mixes)):
+        encode_mixes(
+            tracks,
+            gain_matrix,
+            out_paths,
+            on_progress=on_progress,
+            profile=encoding_profile,
+            on_encoded=(
+                None if on_encoded is None else lambda i: on_encoded(out_paths[i])
+            ),
+        )
+    return out_paths
 
 
-def remove_temporary_files(upload_id):
+def remove_temporary_files(upload_id, tmp_dir):
     logging.info(f"Removing temporary files for upload {upload_id}")
-    tmp_root = os.path.abspath("tmp")
-    tmp_dir = os.path.join(tmp_root, f"{upload_id}")
     if os.path.exists(tmp_dir):
         shutil.rmtree(tmp_dir)
         logging.info(f"Removed directory {tmp_dir}")
     else:
         logging.error(f"Directory {tmp_dir} does not exist")
-
-
-def get_volume(input_path):
-    if not os.path.isfile(input_path):
-        raise Exception(f"Input path {input_path} is not a file")
-    # ffmpeg command from https://superuser.com/a/323127/1185399 (slightly modified to pipe stderr to stdout and grep for the stuff we are interested in)
-    cmd = f'ffmpeg -i "{input_path}" -af "volumedetect" -vn -sn -dn -f null /dev/null 2>&1 | grep "mean_volume"'
-    # execute the command and get the output
-    output = os.popen(cmd).read()
-    # parse the output to get the volume (should be in negative dB)
-    volume = float(output.split("mean_volume: ")[1].split(" dB")[0])
-    return volume
@@ -0,0 +1,24 @@
+# quick utility script to let the S3 bucket expire cached results (see shared/result_cache.py) on its own
+# results that are looked up after RESULT_CACHE_TTL are removed by the API anyway, this takes care of the ones that are never looked up again
+from botocore.exceptions import ClientError
+from shared.s3 import remote_s3
+from shared.settings import S3_BUCKET
+from shared.result_cache import get_result_cache_lifecycle_rule
+
+rule = get_result_cache_lifecycle_rule()
+
+# putting a lifecycle configuration replaces the existing one, so keep any other rules
+try:
+    rules = remote_s3.get_bucket_lifecycle_configuration(Bucket=S3_BUCKET)["Rules"]
+except ClientError as e:
+    if e.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+        raise
+    rules = []
+rules = [r for r in rules if r.get("ID") != rule["ID"]] + [rule]
+
+remote_s3.put_bucket_lifecycle_configuration(
+    Bucket=S3_BUCKET, LifecycleConfiguration={"Rules": rules}
+)
+print(
+    f"Cached results in bucket {S3_BUCKET} now expire after {rule['Expiration']['Days']} day(s)"
+)
@@ -1,19 +1,66 @@
-from flask import Flask, request, jsonify, make_response
-import os
-from zipfile import ZipFile
+from flask import (
+    Flask,
+    Response,
+    request,
+    jsonify,
+    make_response,
+    stream_with_context,
+)
 import uuid
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
+from werkzeug.http import parse_options_header
 import logging
-import uuid
-import shutil
+import json
+import time
 from celery import Celery
 from celery.result import AsyncResult
 
 # note: the DEBUG setting from here only affects my 'business logic' (calls to logging.debug made by my code and any code I use, including s3 client stuff)
 # IIUC, it does not affect the logging level of Flask itself (e.g. the logging of request details); you need to pass the debug flag to flask run directly
-from shared.settings import DEBUG, BROKER_URL
-from shared.s3 import upload_file_to_s3, remove_file_from_s3
+from shared.settings import DEBUG, BROKER_URL, INPUT_LAYOUT, OUTPUT_LAYOUT
+from shared.s3 import (
+    remove_file_from_s3,
+    upload_json_to_s3,
+    download_json_from_s3,
+    get_s3_file_info,
+)
+from shared.uploads import (
+    get_input_zip_object_name,
+    get_input_object_name,
+    get_manifest_object_name,
+    create_manifest,
+    get_track_name,
+)
+from shared.outputs import (
+    OUTPUT_LAYOUTS,
+    create_output,
+    get_output_urls,
+    get_tracks_manifest_object_name,
+    get_upload_output_object_name,
+)
+from shared.mixing import (
+    DEFAULT_OTHER_TRACKS_VOLUME,
+    NORMALIZATION_MODES,
+    DEFAULT_NORMALIZATION,
+    is_panned,
+    parse_mixes,
+    parse_volume,
+)
+from shared.encoding import ENCODING_PROFILES, DEFAULT_ENCODING_PROFILE, is_mono
+from shared.result_cache import (
+    get_result_key,
+    get_cached_output,
+)
+from .streaming_upload import (
+    stream_files_to_s3_zip,
+    stream_files_to_s3_objects,
+    UploadError,
+)
+from .direct_upload import (
+    start_direct_upload,
+    commit_direct_upload,
+    get_direct_upload_filenames,
+)
 
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -37,105 +84,420 @@ app.config.from_mapping(
 CORS(app)
 celery_app = Celery(app.name, broker=BROKER_URL, backend=BROKER_URL)
 
+# how often (in seconds) the task status is checked for Server-Sent Events, and how long to wait before sending a keep-alive
+SSE_POLL_INTERVAL = 0.5
+SSE_KEEPALIVE_INTERVAL = 15
+
 
 @app.route("/practice_tracks", methods=["POST"])
 def practice_tracks():
     logging.info("Received request")
-    logging.debug(request.files)
-    # request.files is a dictionary of files sent in the request
-    # theoretically there could have been multiple file uploads with different keys
-    # (e.g. "audio_files", "other_files"), but in this case we only have one key: "file"
-    files_key = "files"
-    if files_key not in request.files:
+    # the files are not accessed via request.files, as Flask would then save them to temporary files first
+    # instead, the request body is parsed while it is received, and the files are streamed to S3 right away
+    content_type, options = parse_options_header(request.content_type)
+    if content_type != "multipart/form-data" or "boundary" not in options:
         return make_response(jsonify({"error": "No files included"}), 400)
 
-    files = request.files.getlist(files_key)
-    logging.info(f"Received {len(files)} files: {files}")
+    upload_id = uuid.uuid4()
+    # theoretically there could have been multiple file uploads with different keys
+    # (e.g. "audio_files", "other_files"), but in this case we only have one key: "files"
+    boundary = options["boundary"].encode("utf-8")
+    try:
+        if INPUT_LAYOUT == "zip":
+            fields, file_hashes = stream_files_to_s3_zip(
+                request.stream,
+                boundary,
+                get_input_zip_object_name(upload_id),
+                files_key="files",
+            )
+        else:
+            fields, file_hashes = stream_files_to_s3_objects(
+                request.stream,
+                boundary,
+                lambda filename: get_input_object_name(upload_id, filename),
+                files_key="files",
+            )
+    except Exception as e:
+        # (if the files can't be streamed, the streaming functions remove what they uploaded)
+        body, status = get_error_response(e)
+        return make_response(jsonify(body), status)
+
+    body, status = handle_upload(upload_id, fields, file_hashes)
+    return make_response(jsonify(body), status)
+
 
-    if len(files) == 0:
-        return make_response(jsonify({"error": "No files uploaded"}, 400))
+@app.route("/practice_tracks/uploads", methods=["POST"])
+def practice_tracks_uploads():
+    """
+    Starts an upload whose files the client uploads directly to S3, so that the audio data doesn't pass through the API.
 
+    Expects the name, size (in bytes) and SHA-256 (hex) of every file: {"files": [{"name": ..., "size": ..., "sha256": ...}]}
+    Returns the uploadId and, for every file, presigned URLs for its parts (see direct_upload.start_direct_upload).
+    Once all parts are uploaded, the upload has to be committed via POST /practice_tracks/<uploadId>/commit
+    """
+    data = request.get_json(silent=True) or {}
     upload_id = uuid.uuid4()
-    temp_dir_path = os.path.join(os.path.abspath("tmp"), f"{upload_id}")
-    os.makedirs(temp_dir_path, exist_ok=True)
+    try:
+        upload = start_direct_upload(upload_id, data.get("files"))
+    except UploadError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    except Exception as e:
+        logging.exception(e)
+        return make_response(jsonify({"error": "Something went wrong"}), 500)
+    return make_response(jsonify({"uploadId": upload_id, **upload}), 201)
 
-    zip_name = f"input_files.zip"
-    zip_path = os.path.join(temp_dir_path, zip_name)
 
+@app.route("/practice_tracks/<upload_id>/commit", methods=["POST"])
+def practice_tracks_commit(upload_id):
+    """
+    Commits an upload that was started via POST /practice_tracks/uploads and starts the practice track creation,
+    just like POST /practice_tracks does once it received the files. Optionally accepts the same (non-file) fields as JSON.
+    """
+    fields = request.get_json(silent=True) or {}
     try:
-        # save all mp3 files to the zip file
-        with ZipFile(zip_path, "w") as zip_file:
-            processed_mp3_count = 0
-            for file in files:
-                if file.filename.endswith(".mp3"):
-                    file.save(
-                        os.path.join(temp_dir_path, secure_filename(file.filename))
-                    )
-                    zip_file.write(
-                        os.path.join(temp_dir_path, secure_filename(file.filename)),
-                        secure_filename(file.filename),
-                    )
-                    processed_mp3_count += 1
-                else:
-                    return make_response(
-                        jsonify({"error": "Only mp3 files are supported"}), 400
-                    )
-
-            if processed_mp3_count < 2:
-                return make_response(
-                    jsonify({"error": "At least two mp3 files are required"}), 400
-                )
+        try:
+            output_layout, mixing_params = parse_upload_fields(
+                fields, get_direct_upload_filenames(upload_id)
+            )
+            file_hashes = commit_direct_upload(upload_id)
+        except UploadError as e:
+            return make_response(jsonify({"error": str(e)}), 400)
 
-        logging.info(f"Created zip file at {zip_path}")
-        s3_relative_path = f"{upload_id}/{zip_name}"
-        upload_file_to_s3(zip_path, s3_relative_path)
-
-        """
-        The Flask App doesn't import/access the task implementation from the Celery app directly, so we need to create the signature by hand.
-        
-        The signature wraps a task and its arguments. we can call it in the same way as we would call a task directly.
-        To create the signature, we need to specify the task name and the arguments.
-        
-        The task name follows the scheme
-          <task_module>.<task_name> where <task_module> is the name of a module file in the 'tasks' submodule of the celery_worker source code
-        
-        See also: https://celery.school/posts/how-to-call-a-celery-task-from-another-app/
-        """
-        create_practice_tracks = celery_app.signature(
-            "practice_tracks.create", kwargs={"upload_id": upload_id}
+        # the hashes are the ones the client declared, they are only checked by the worker once it downloads the files:
+        # hence, the result cache is not looked up (anyone who knows the hashes of some files could get their practice tracks),
+        # but the practice tracks are stored in it (if the hashes don't match, the worker fails before it creates them)
+        result_key = get_result_key(file_hashes, mixing_params)
+        start_practice_track_creation(
+            upload_id, result_key, output_layout, mixing_params
         )
-
-        def on_update(state):
-            logging.info(f"Task state: {state}")
-            status = state["status"]
-            if status == "PROGRESS":
-                logging.info(f"Task progress: {state['result']}")
-            elif status == "SUCCESS":
-                logging.info(f"Task result: {state['result']}")
-            elif status == "FAILURE":
-                logging.info(f"Task failed: {state['result']}")
-            else:
-                logging.info(f"Task status: {status}")
-
-        r = create_practice_tracks.apply_async()
-        logging.info(
-            f"Started worker for practice track creation (upload ID: {upload_id})"
+        return make_response(
+            jsonify({"message": "Received upload", "uploadId": upload_id}), 202
         )
-        result = r.get(on_message=on_update, propagate=False)
+    except Exception as e:
+        logging.exception(e)
+        return make_response(jsonify({"error": "Something went wrong"}), 500)
 
-        logging.info(f"Task result: {result}")
 
-        # inform client that the request was received and is being processed
+@app.route("/practice_tracks/<upload_id>", methods=["GET"])
+def practice_tracks_status(upload_id):
+    return make_response(jsonify(get_upload_status(upload_id)), 200)
+
+
+@app.route("/practice_tracks/<upload_id>/events", methods=["GET"])
+def practice_tracks_events(upload_id):
+    """
+    Streams the status of the practice track creation as Server-Sent Events until the task has finished.
+
+    Note: the stream occupies a worker for its whole duration; with the default (sync) gunicorn workers, prefer polling GET /practice_tracks/<upload_id>
+    """
+
+    def generate_events():
+        last_status = None
+        last_event_time = time.monotonic()
+        while True:
+            # (looking for the outputs of an expired task once is enough, they don't appear while it is pending)
+            status = get_upload_status(upload_id, find_output=last_status is None)
+            if status != last_status:
+                yield f"data: {json.dumps(status)}\n\n"
+                last_status = status
+                last_event_time = time.monotonic()
+            elif time.monotonic() - last_event_time > SSE_KEEPALIVE_INTERVAL:
+                # comment line that keeps proxies from closing the idle connection
+                yield ": keep-alive\n\n"
+                last_event_time = time.monotonic()
+            if status["state"] in ("SUCCESS", "FAILURE"):
+                return
+            time.sleep(SSE_POLL_INTERVAL)
+
+    return Response(
+        stream_with_context(generate_events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/practice_tracks/<upload_id>/zip", methods=["POST"])
+def practice_tracks_zip(upload_id):
+    """
+    Requests a zip file with all practice tracks of an upload that were stored in the "tracks" layout.
+    The zip file is created in the background; its status can be queried via GET /practice_tracks/<upload_id>/zip
+    """
+    output = get_upload_output(upload_id)
+    if output is None or "tracks" not in output:
         return make_response(
-            jsonify({"message": "Received upload", "uploadId": upload_id}), 200
+            jsonify({"error": "No practice tracks (in the 'tracks' layout) found"}),
+            404,
+        )
+
+    status = get_zip_status(upload_id)
+    if status["state"] == "SUCCESS":
+        return make_response(jsonify(status), 200)
+    if status["state"] in ("PENDING", "FAILURE"):
+        # if the zip file was created before (e.g. for an earlier upload of the same files), the task returns right away
+        celery_app.signature(
+            "practice_tracks.zip_tracks",
+            kwargs={"output_prefix": output["outputPrefix"]},
+        ).apply_async(task_id=get_zip_task_id(upload_id))
+    return make_response(
+        jsonify({"message": "Creating zip file", "uploadId": upload_id}), 202
+    )
+
+
+@app.route("/practice_tracks/<upload_id>/zip", methods=["GET"])
+def practice_tracks_zip_status(upload_id):
+    return make_response(jsonify(get_zip_status(upload_id)), 200)
+
+
+def parse_upload_fields(fields, filenames):
+    """
+    Validates the (non-file) form fields of an upload, raising an UploadError if they are invalid
+    :param filenames: the names of the uploaded files
+    :return: the output layout and the mixing parameters for the practice track creation
+    """
+    # optional form field: how the practice tracks should be stored (see shared/outputs.py)
+    output_layout = fields.get("output", OUTPUT_LAYOUT)
+    if output_layout not in OUTPUT_LAYOUTS:
+        raise UploadError(
+            f"Invalid output '{output_layout}' (must be one of {', '.join(OUTPUT_LAYOUTS)})"
+        )
+    # optional form field: how the practice tracks should be encoded (see shared/encoding.py)
+    encoding_profile = fields.get("encoding", DEFAULT_ENCODING_PROFILE)
+    if (
+        not isinstance(encoding_profile, str)
+        or encoding_profile not in ENCODING_PROFILES
+    ):
+        raise UploadError(
+            f"Invalid encoding '{encoding_profile}' (must be one of {', '.join(ENCODING_PROFILES)})"
+        )
+    # optional form field: how the volume of the practice tracks is normalized (see shared/mixing.py)
+    normalization = fields.get("normalization", DEFAULT_NORMALIZATION)
+    if normalization not in NORMALIZATION_MODES:
+        raise UploadError(
+            f"Invalid normalization '{normalization}' (must be one of {', '.join(NORMALIZATION_MODES)})"
         )
+    # optional form field: volume of the other tracks in each practice track, e.g. "-6dB" (see shared/mixing.py)
+    other_tracks_volume = fields.get("other_tracks_volume", DEFAULT_OTHER_TRACKS_VOLUME)
+    try:
+        parse_volume(other_tracks_volume)
+    except ValueError:
+        raise UploadError(
+            f"Invalid other_tracks_volume '{other_tracks_volume}' (must be e.g. '-10dB' or a factor like '0.3')"
+        )
+    # optional form field: specs of custom mixes (as JSON in multipart requests, see shared/mixing.py)
+    try:
+        custom_mixes = parse_mixes(
+            fields.get("mixes", []), [get_track_name(name) for name in filenames]
+        )
+    except ValueError as e:
+        raise UploadError(str(e))
+    if is_mono(encoding_profile):
+        for mix in custom_mixes:
+            if is_panned(mix):
+                raise UploadError(
+                    f"Mix '{mix['name']}' is panned, which requires a stereo encoding (not '{encoding_profile}')"
+                )
+    # all of these change the practice tracks, so they are part of the result's cache key
+    mixing_params = {
+        "other_tracks_volume": other_tracks_volume,
+        "encoding_profile": encoding_profile,
+        "normalization": normalization,
+    }
+    # (only if there are any, so that uploads without custom mixes keep their cache keys)
+    if custom_mixes:
+        mixing_params["custom_mixes"] = custom_mixes
+    return output_layout, mixing_params
+
+
+def handle_upload(upload_id, fields, file_hashes):
+    """
+    Handles an upload to POST /practice_tracks once its files are stored in S3 (this part is shared by the Flask app and the ASGI app,
+    see flask_app.asgi, which only differ in how they receive the files): validates the form fields, reuses the practice tracks
+    of an identical upload or starts their creation. If anything goes wrong, the files of the upload are removed again.
+
+    Blocks while accessing S3 and the broker.
+    :return: the response body and status
+    """
+    try:
+        output_layout, mixing_params = parse_upload_fields(fields, list(file_hashes))
+        logging.info(f"Received {len(file_hashes)} files: {list(file_hashes)}")
+        if INPUT_LAYOUT != "zip":
+            # the manifest tells the worker which input files to download
+            if not upload_json_to_s3(
+                create_manifest(file_hashes), get_manifest_object_name(upload_id)
+            ):
+                raise Exception("Could not upload manifest")
+
+        # identical uploads (same files, same mixing parameters) produce identical practice tracks, so reuse them if possible
+        result_key = get_result_key(file_hashes, mixing_params)
+        cached_result = get_cached_result(upload_id, result_key, output_layout)
+        if cached_result is not None:
+            remove_upload_files(upload_id, file_hashes)
+            return {"message": "Practice tracks already exist", **cached_result}, 200
+
+        start_practice_track_creation(
+            upload_id, result_key, output_layout, mixing_params
+        )
+        # inform client that the request was received and is being processed
+        # the progress and the result can be queried via GET /practice_tracks/<uploadId>
+        return {"message": "Received upload", "uploadId": str(upload_id)}, 202
     except Exception as e:
-        logging.exception(e)
-        remove_file_from_s3(s3_relative_path)
-        return make_response(jsonify({"error": "Something went wrong"}), 500)
-    finally:
-        shutil.rmtree(temp_dir_path)
-        logging.info(f"Deleted temporary directory at {temp_dir_path}")
+        remove_upload_files(upload_id, file_hashes)
+        return get_error_response(e)
+
+
+def get_error_response(e):
+    """
+    Returns the response body and status for an error while handling an upload
+    (the message of an UploadError is shown to the client, other errors are only logged)
+    """
+    if isinstance(e, UploadError):
+        return {"error": str(e)}, 400
+    logging.exception(e)
+    return {"error": "Something went wrong"}, 500
+
+
+def remove_upload_files(upload_id, filenames):
+    """
+    Removes the files of an upload (in the configured input layout) from S3, e.g. if it is invalid or if its practice tracks already exist
+    """
+    if INPUT_LAYOUT == "zip":
+        object_names = [get_input_zip_object_name(upload_id)]
+    else:
+        object_names = [
+            get_input_object_name(upload_id, filename) for filename in filenames
+        ]
+        object_names.append(get_manifest_object_name(upload_id))
+    for object_name in object_names:
+        remove_file_from_s3(object_name)
+
+
+def get_cached_result(upload_id, result_key, output_layout):
+    """
+    Returns the uploadId and the url (or tracks) of the practice tracks of a previous, identical upload, or None if there are none.
+    The upload gets the cached practice tracks as its outputs, so that they can be found via its ID (e.g. to request a zip file of them)
+    """
+    output = get_cached_output(result_key, output_layout)
+    if output is None:
+        return None
+    logging.info(f"Reusing practice tracks of previous upload ({result_key})")
+    if not upload_json_to_s3(output, get_upload_output_object_name(upload_id)):
+        raise Exception("Could not store outputs of upload")
+    return {"uploadId": str(upload_id), **get_output_urls(output)}
+
+
+def start_practice_track_creation(upload_id, result_key, output_layout, mixing_params):
+    """
+    The Flask App doesn't import/access the task implementation from the Celery app directly, so we need to create the signature by hand.
+
+    The signature wraps a task and its arguments. we can call it in the same way as we would call a task directly.
+    To create the signature, we need to specify the task name and the arguments.
+
+    The task name follows the scheme
+      <task_module>.<task_name> where <task_module> is the name of a module file in the 'tasks' submodule of the celery_worker source code
+
+    See also: https://celery.school/posts/how-to-call-a-celery-task-from-another-app/
+    """
+    create_practice_tracks = celery_app.signature(
+        "practice_tracks.create",
+        kwargs={
+            "upload_id": upload_id,
+            "result_key": result_key,
+            "output_layout": output_layout,
+            **mixing_params,
+        },
+    )
+
+    # the upload ID doubles as task ID, so that clients can query the task's status with it
+    create_practice_tracks.apply_async(task_id=str(upload_id))
+    logging.info(f"Started worker for practice track creation (upload ID: {upload_id})")
+
+
+def get_zip_task_id(upload_id):
+    return f"{upload_id}.zip"
+
+
+def get_task_status(task_id, upload_id=None, find_output=None):
+    """
+    Returns the status of the practice track creation (or of another task for an upload) as dict with the keys
+    - uploadId
+    - state: one of the Celery task states (PENDING, PROGRESS, SUCCESS, FAILURE etc.); unknown upload IDs are PENDING as well
+    - progress: between 0 and 1
+    - url: presigned URL of the zip file with the practice tracks (only if state is SUCCESS)
+    - tracks: instead of url, if the practice tracks are stored in the "tracks" layout: name and presigned URL of every track
+    - error: a generic error message (only if state is FAILURE; the details are logged by the worker, not shown to clients)
+
+    The URLs are presigned whenever the status is requested, as they are only valid for a while.
+    :param find_output: if given, called if the task is PENDING, as its result may have expired (or it may have run under another ID):
+        returns where the task's outputs are stored (see shared.outputs.create_output), or None if it didn't create them (yet)
+    """
+    result = AsyncResult(task_id, app=celery_app)
+    status = {"uploadId": upload_id or task_id, "state": result.state, "progress": 0}
+    if result.state == "PROGRESS":
+        status["progress"] = result.info.get("progress", 0)
+    elif result.state == "SUCCESS":
+        status["progress"] = 1
+        status.update(get_output_urls(result.result))
+    elif result.state == "FAILURE":
+        logging.error(f"Task {task_id} failed: {result.result!r}")
+        status["error"] = "Something went wrong"
+    elif result.state == "PENDING" and find_output is not None:
+        output = find_output()
+        if output is not None:
+            status.update(state="SUCCESS", progress=1, **get_output_urls(output))
+    return status
+
+
+def get_upload_status(upload_id, find_output=True):
+    """
+    Returns the status of the practice track creation for an upload (see get_task_status)
+    :param find_output: whether to look for the practice tracks in S3 if the task's result expired
+    """
+    return get_task_status(
+        upload_id,
+        find_output=(lambda: find_upload_output(upload_id)) if find_output else None,
+    )
+
+
+def get_zip_status(upload_id):
+    """
+    Returns the status of the zip file with the practice tracks of an upload in the "tracks" layout (see get_task_status)
+    """
+
+    def find_zip_output():
+        output = get_upload_output(upload_id)
+        if output is None:
+            return None
+        zip_output = create_output(output["outputPrefix"])
+        return zip_output if get_s3_file_info(zip_output["zip"]) is not None else None
+
+    return get_task_status(get_zip_task_id(upload_id), upload_id, find_zip_output)
+
+
+def get_upload_output(upload_id):
+    """
+    Returns where the practice tracks of an upload are stored (see shared.outputs.create_output), or None if they aren't done (yet)
+    """
+    result = AsyncResult(upload_id, app=celery_app)
+    if result.state == "SUCCESS":
+        return result.result
+    return find_upload_output(upload_id)
+
+
+def find_upload_output(upload_id):
+    """
+    Looks up where the practice tracks of an upload are stored in S3 (as stored by the worker when they were done),
+    for uploads whose task result expired. Returns None if there are none (anymore).
+    """
+    output = download_json_from_s3(get_upload_output_object_name(upload_id))
+    if output is None:
+        return None
+    # results in the result cache are removed once they are stale
+    object_name = (
+        get_tracks_manifest_object_name(output["outputPrefix"])
+        if "tracks" in output
+        else output["zip"]
+    )
+    return output if get_s3_file_info(object_name) is not None else None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+# ASGI entry point of the API (e.g. `uvicorn flask_app.asgi:app`, or gunicorn with the uvicorn worker class)
+#
+# Uploads (POST /practice_tracks) are handled with asyncio: the request body is parsed while it is received and streamed to S3
+# without blocking the event loop, so a single process can receive hundreds of uploads at once without a thread per upload.
+# All other requests are short and handled by the Flask app (in a thread pool, see asgiref's WsgiToAsgi).
+import uuid
+import json
+import logging
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_options_header
+
+from shared.settings import INPUT_LAYOUT
+from shared.s3_async import run_in_executor
+from shared.uploads import get_input_zip_object_name, get_input_object_name
+from . import app as flask_app, handle_upload, get_error_response
+from .streaming_upload import (
+    stream_files_to_s3_zip_async,
+    stream_files_to_s3_objects_async,
+    UploadError,
+)
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _handle_lifespan(receive, send)
+    elif (
+        scope["type"] == "http"
+        and scope["method"] == "POST"
+        and scope["path"].rstrip("/") == "/practice_tracks"
+    ):
+        body, status = await practice_tracks(scope, receive)
+        await _send_json(send, body, status)
+    else:
+        await wsgi_app(scope, receive, send)
+
+
+async def practice_tracks(scope, receive):
+    """
+    Async version of the POST /practice_tracks handler of the Flask app (see flask_app.practice_tracks)
+    :return: the response body and status
+    """
+    logging.info("Received request")
+    headers = dict(scope["headers"])
+    content_type, options = parse_options_header(
+        headers.get(b"content-type", b"").decode("latin-1")
+    )
+    if content_type != "multipart/form-data" or "boundary" not in options:
+        return {"error": "No files included"}, 400
+
+    upload_id = uuid.uuid4()
+    boundary = options["boundary"].encode("utf-8")
+    try:
+        if INPUT_LAYOUT == "zip":
+            fields, file_hashes = await stream_files_to_s3_zip_async(
+                _read_body(receive),
+                boundary,
+                get_input_zip_object_name(upload_id),
+                files_key="files",
+            )
+        else:
+            fields, file_hashes = await stream_files_to_s3_objects_async(
+                _read_body(receive),
+                boundary,
+                lambda filename: get_input_object_name(upload_id, filename),
+                files_key="files",
+            )
+    except Exception as e:
+        return get_error_response(e)
+
+    # the rest (S3 lookups, sending the task to the broker) is short, but blocking I/O
+    return await run_in_executor(handle_upload, upload_id, fields, file_hashes)
+
+
+async def _read_body(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise UploadError("Upload was interrupted")
+        yield message.get("body", b"")
+        if not message.get("more_body", False):
+            return
+
+
+async def _send_json(send, body, status):
+    data = json.dumps(body).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(data)).encode("latin-1")),
+                # the Flask app allows requests from all origins as well (see CORS(app))
+                (b"access-control-allow-origin", b"*"),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": data})
+
+
+async def _handle_lifespan(receive, send):
+    # nothing to set up or tear down, but servers expect the events to be acknowledged
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,181 @@
+import re
+import math
+import logging
+from typing import Dict, List
+
+from werkzeug.utils import secure_filename
+
+from shared.s3 import (
+    MULTIPART_PART_SIZE,
+    create_multipart_upload,
+    create_presigned_upload_part_url,
+    complete_multipart_upload,
+    abort_multipart_upload,
+    get_s3_file_info,
+    remove_file_from_s3,
+    upload_json_to_s3,
+    download_json_from_s3,
+)
+from shared.uploads import (
+    get_input_object_name,
+    get_manifest_object_name,
+    get_pending_upload_object_name,
+    create_manifest,
+    get_track_name,
+)
+from .streaming_upload import (
+    UploadError,
+    ALLOWED_EXTENSIONS,
+    MIN_FILE_COUNT,
+)
+
+# limit for the size of each file (S3 allows at most 10,000 parts per upload)
+MAX_FILE_SIZE = 1024 * 1024 * 1024
+# time in seconds for the presigned upload URLs to remain valid
+UPLOAD_URL_EXPIRATION = 3600
+
+
+def start_direct_upload(upload_id, files: List[dict]) -> dict:
+    """
+    Prepares an upload whose files are uploaded by the client directly to S3 (in the "objects" layout, see shared.uploads),
+    so that the audio data doesn't pass through the API: starts a multipart upload for every file and presigns the URLs of its parts.
+
+    The files that are expected are stored in S3 until the upload is committed (see commit_direct_upload).
+
+    :param files: name, size (in bytes) and SHA-256 (hex) of every file, as sent by the client
+    :return: the part size and, for every file, its (secured) name and the URLs its parts have to be uploaded to (with PUT requests, in order)
+    """
+    files = _validate_files(files)
+
+    pending_files = []
+    try:
+        for file in files:
+            object_name = get_input_object_name(upload_id, file["name"])
+            s3_upload_id = create_multipart_upload(object_name)
+            if s3_upload_id is None:
+                raise Exception(f"Could not start upload of {object_name}")
+            pending_files.append({**file, "uploadId": s3_upload_id})
+
+        # the commit only relies on this, not on anything the client sends later
+        if not upload_json_to_s3(
+            {"files": pending_files}, get_pending_upload_object_name(upload_id)
+        ):
+            raise Exception("Could not store pending upload")
+
+        response_files = []
+        for file in pending_files:
+            object_name = get_input_object_name(upload_id, file["name"])
+            part_count = math.ceil(file["size"] / MULTIPART_PART_SIZE)
+            urls = [
+                create_presigned_upload_part_url(
+                    object_name,
+                    file["uploadId"],
+                    part_number,
+                    expiration=UPLOAD_URL_EXPIRATION,
+                )
+                for part_number in range(1, part_count + 1)
+            ]
+            if None in urls:
+                raise Exception(f"Could not create upload URLs for {object_name}")
+            response_files.append({"name": file["name"], "parts": urls})
+    except Exception:
+        _remove_upload(upload_id, pending_files)
+        raise
+
+    logging.info(
+        f"Started direct upload of {len(files)} files: {[file['name'] for file in files]}"
+    )
+    return {"partSize": MULTIPART_PART_SIZE, "files": response_files}
+
+
+def get_direct_upload_filenames(upload_id) -> List[str]:
+    """
+    :return: the (secured) names of the files of a direct upload that wasn't committed yet (see start_direct_upload)
+    """
+    pending_upload = download_json_from_s3(get_pending_upload_object_name(upload_id))
+    if pending_upload is None:
+        raise UploadError("Unknown upload (or already committed)")
+    return [file["name"] for file in pending_upload["files"]]
+
+
+def commit_direct_upload(upload_id) -> Dict[str, str]:
+    """
+    Completes the multipart uploads of all files of a direct upload (see start_direct_upload), checks their sizes
+    and stores the manifest, after which the upload is like any other upload in the "objects" layout.
+
+    If the upload is incomplete or invalid, all of its files are removed and an UploadError is raised (i.e. the client has to start over).
+
+    :return: the SHA-256 of every file by file name
+    """
+    pending_upload = download_json_from_s3(get_pending_upload_object_name(upload_id))
+    if pending_upload is None:
+        raise UploadError("Unknown upload (or already committed)")
+    files = pending_upload["files"]
+
+    completed_files = []
+    try:
+        for file in files:
+            object_name = get_input_object_name(upload_id, file["name"])
+            if not complete_multipart_upload(object_name, file["uploadId"]):
+                raise UploadError(f"{file['name']} was not uploaded completely")
+            completed_files.append(file)
+            info = get_s3_file_info(object_name)
+            if info is None or info["ContentLength"] != file["size"]:
+                raise UploadError(
+                    f"Size of {file['name']} does not match (expected {file['size']} bytes)"
+                )
+
+        # the hashes are the ones the client declared; the worker checks them when it downloads the files
+        # (so they must not be used to look up the practice tracks of previous uploads, see flask_app.practice_tracks_commit)
+        file_hashes = {file["name"]: file["sha256"] for file in files}
+        if not upload_json_to_s3(
+            create_manifest(file_hashes), get_manifest_object_name(upload_id)
+        ):
+            raise Exception("Could not upload manifest")
+    except Exception:
+        _remove_upload(upload_id, files, completed_files)
+        raise
+
+    remove_file_from_s3(get_pending_upload_object_name(upload_id))
+    logging.info(f"Committed direct upload of {len(files)} files: {list(file_hashes)}")
+    return file_hashes
+
+
+def _validate_files(files):
+    if not isinstance(files, list) or len(files) == 0:
+        raise UploadError("No files included")
+
+    validated_files = {}
+    for file in files:
+        if not isinstance(file, dict):
+            raise UploadError("Invalid file description")
+        name = secure_filename(str(file.get("name", "")))
+        if not name.lower().endswith(ALLOWED_EXTENSIONS):
+            raise UploadError(
+                f"Only {', '.join(ALLOWED_EXTENSIONS)} files are supported"
+            )
+        if get_track_name(name) in map(get_track_name, validated_files):
+            raise UploadError(f"Duplicate file name '{name}'")
+        size = file.get("size")
+        if type(size) is not int or not 0 < size <= MAX_FILE_SIZE:
+            raise UploadError(
+                f"Invalid size of {name} (must be at most {MAX_FILE_SIZE} bytes)"
+            )
+        sha256 = str(file.get("sha256", "")).lower()
+        if not re.fullmatch(r"[0-9a-f]{64}", sha256):
+            raise UploadError(f"Invalid SHA-256 of {name}")
+        validated_files[name] = {"name": name, "size": size, "sha256": sha256}
+
+    if len(validated_files) < MIN_FILE_COUNT:
+        raise UploadError(f"At least {MIN_FILE_COUNT} files are required")
+    return list(validated_files.values())
+
+
+def _remove_upload(upload_id, files, completed_files=()):
+    for file in files:
+        object_name = get_input_object_name(upload_id, file["name"])
+        if file in completed_files:
+            remove_file_from_s3(object_name)
+        else:
+            abort_multipart_upload(object_name, file["uploadId"])
+    remove_file_from_s3(get_pending_upload_object_name(upload_id))
@@ -0,0 +1,354 @@
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Dict, IO, Optional, Tuple
+from zipfile import ZipFile
+from werkzeug.utils import secure_filename
+from werkzeug.sansio.multipart import (
+    MultipartDecoder,
+    Field,
+    File,
+    Data,
+    Epilogue,
+    NeedData,
+)
+
+from shared.s3 import S3MultipartWriter, remove_file_from_s3
+from shared.uploads import INPUT_EXTENSIONS, get_track_name
+from shared.s3_async import (
+    AsyncS3MultipartWriter,
+    remove_file_from_s3 as remove_file_from_s3_async,
+)
+
+# number of bytes read from the request body at once
+READ_CHUNK_SIZE = 64 * 1024
+# limit for the size of (non-file) form fields, which are kept in memory
+MAX_FORM_MEMORY_SIZE = 1024 * 1024
+# file extensions that are accepted, and the minimum number of files per upload
+ALLOWED_EXTENSIONS = INPUT_EXTENSIONS
+MIN_FILE_COUNT = 2
+
+
+class UploadError(Exception):
+    """Raised if the uploaded data is invalid; the message can be shown to the client"""
+
+
+def stream_files_to_s3_zip(
+    stream: IO[bytes],
+    boundary: bytes,
+    object_name: str,
+    files_key: str = "files",
+    allowed_extensions: Tuple[str, ...] = ALLOWED_EXTENSIONS,
+    min_file_count: int = MIN_FILE_COUNT,
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Parses a multipart/form-data request body and streams the uploaded files into a zip file in S3 while they are received.
+    Neither the files nor the zip file are written to local disk, and at most one part of the S3 multipart upload is kept in memory.
+
+    If the upload is invalid, the S3 upload is aborted and an UploadError is raised.
+
+    :param stream: the request body
+    :param boundary: the multipart boundary (from the Content-Type header of the request)
+    :param object_name: name of the zip file in S3
+    :param files_key: name of the form field that contains the files
+    :param allowed_extensions: file extensions that are accepted
+    :param min_file_count: minimum number of files that have to be uploaded
+    :return: the (non-file) form fields and the SHA-256 of every file by (secured) file name
+    """
+    with S3MultipartWriter(object_name) as s3_file, ZipFile(s3_file, "w") as zip_file:
+        fields, file_hashes = _stream_files(
+            stream,
+            boundary,
+            # the size of a file is only known once it is received, so every file may need the zip64 format (> 2GiB)
+            lambda filename: zip_file.open(filename, "w", force_zip64=True),
+            files_key,
+            allowed_extensions,
+            min_file_count,
+        )
+
+    logging.info(f"Streamed {len(file_hashes)} files to S3 ({object_name})")
+    return fields, file_hashes
+
+
+def stream_files_to_s3_objects(
+    stream: IO[bytes],
+    boundary: bytes,
+    get_object_name: Callable[[str], str],
+    files_key: str = "files",
+    allowed_extensions: Tuple[str, ...] = ALLOWED_EXTENSIONS,
+    min_file_count: int = MIN_FILE_COUNT,
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Like stream_files_to_s3_zip, but streams every uploaded file into a separate S3 object.
+
+    If the upload is invalid, all objects uploaded so far are removed again and an UploadError is raised.
+
+    :param get_object_name: returns the name of the S3 object for a (secured) file name
+    :return: the (non-file) form fields and the SHA-256 of every file by (secured) file name
+    """
+    object_names = []
+
+    def open_file(filename):
+        object_names.append(get_object_name(filename))
+        return S3MultipartWriter(object_names[-1])
+
+    try:
+        fields, file_hashes = _stream_files(
+            stream, boundary, open_file, files_key, allowed_extensions, min_file_count
+        )
+    except Exception:
+        for object_name in object_names:
+            remove_file_from_s3(object_name)
+        raise
+
+    logging.info(f"Streamed {len(file_hashes)} files to S3 ({object_names})")
+    return fields, file_hashes
+
+
+async def stream_files_to_s3_zip_async(
+    chunks: AsyncIterator[bytes],
+    boundary: bytes,
+    object_name: str,
+    files_key: str = "files",
+    allowed_extensions: Tuple[str, ...] = ALLOWED_EXTENSIONS,
+    min_file_count: int = MIN_FILE_COUNT,
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Like stream_files_to_s3_zip, but reads the request body from an async iterator of chunks (e.g. the body of an ASGI request),
+    and uploads the parts of the zip file without blocking the event loop.
+
+    :param chunks: the request body
+    :return: the (non-file) form fields and the SHA-256 of every file by (secured) file name
+    """
+    async with AsyncS3MultipartWriter(object_name) as s3_file:
+        with ZipFile(s3_file, "w") as zip_file:
+            fields, file_hashes = await _stream_files_async(
+                chunks,
+                boundary,
+                lambda filename: zip_file.open(filename, "w", force_zip64=True),
+                files_key,
+                allowed_extensions,
+                min_file_count,
+                after_chunk=s3_file.drain,
+            )
+
+    logging.info(f"Streamed {len(file_hashes)} files to S3 ({object_name})")
+    return fields, file_hashes
+
+
+async def stream_files_to_s3_objects_async(
+    chunks: AsyncIterator[bytes],
+    boundary: bytes,
+    get_object_name: Callable[[str], str],
+    files_key: str = "files",
+    allowed_extensions: Tuple[str, ...] = ALLOWED_EXTENSIONS,
+    min_file_count: int = MIN_FILE_COUNT,
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Like stream_files_to_s3_objects, but reads the request body from an async iterator of chunks (e.g. the body of an ASGI request),
+    and uploads the files without blocking the event loop.
+
+    :param chunks: the request body
+    :return: the (non-file) form fields and the SHA-256 of every file by (secured) file name
+    """
+    writers = []
+    # files that were received completely, but whose upload still has to be completed
+    received = []
+    uploaded_object_names = []
+
+    @contextmanager
+    def open_file(filename):
+        writers.append(AsyncS3MultipartWriter(get_object_name(filename)))
+        yield writers[-1]
+        # completing the upload can't be awaited here, this is done after the current chunk
+        received.append(writers[-1])
+
+    async def upload_files():
+        if writers and not writers[-1].closed:
+            await writers[-1].drain()
+        while received:
+            writer = received.pop(0)
+            await writer.close()
+            uploaded_object_names.append(writer.object_name)
+
+    try:
+        fields, file_hashes = await _stream_files_async(
+            chunks,
+            boundary,
+            open_file,
+            files_key,
+            allowed_extensions,
+            min_file_count,
+            after_chunk=upload_files,
+        )
+    except BaseException:
+        for writer in writers:
+            await writer.abort()
+        for object_name in uploaded_object_names:
+            await remove_file_from_s3_async(object_name)
+        raise
+
+    logging.info(
+        f"Streamed {len(file_hashes)} files to S3 ({[writer.object_name for writer in writers]})"
+    )
+    return fields, file_hashes
+
+
+def _stream_files(
+    stream, boundary, open_file, files_key, allowed_extensions, min_file_count
+):
+    """
+    Parses a multipart/form-data request body that is read from a (blocking) stream (see _FileStreamParser)
+    """
+    parser = _FileStreamParser(
+        boundary, open_file, files_key, allowed_extensions, min_file_count
+    )
+    try:
+        while not parser.receive_data(stream.read(READ_CHUNK_SIZE)):
+            pass
+    except BaseException as e:
+        parser.abort(e)
+        raise
+    return parser.get_result()
+
+
+async def _stream_files_async(
+    chunks,
+    boundary,
+    open_file,
+    files_key,
+    allowed_extensions,
+    min_file_count,
+    after_chunk,
+):
+    """
+    Like _stream_files, but reads the body from an async iterator; after_chunk is awaited after every chunk
+    (to upload the data that was written to the files in the meantime)
+    """
+    parser = _FileStreamParser(
+        boundary, open_file, files_key, allowed_extensions, min_file_count
+    )
+    try:
+        buffer = bytearray()
+        done = False
+        async for chunk in chunks:
+            # like _stream_files, the decoder gets blocks of READ_CHUNK_SIZE, no matter how the server splits up the body
+            # (it only accepts a limited amount of data at once, and Werkzeug 2.3's decoder mishandles some very small chunks)
+            buffer += chunk
+            while len(buffer) >= READ_CHUNK_SIZE and not done:
+                done = parser.receive_data(bytes(buffer[:READ_CHUNK_SIZE]))
+                del buffer[:READ_CHUNK_SIZE]
+                await after_chunk()
+            if done:
+                break
+        if not done:
+            if buffer:
+                done = parser.receive_data(bytes(buffer))
+            if not done:
+                parser.receive_data(None)
+            await after_chunk()
+    except BaseException as e:
+        parser.abort(e)
+        raise
+    return parser.get_result()
+
+
+class _FileStreamParser:
+    """
+    Parses a multipart/form-data request body that is passed in chunks, writing the content of each file into the writable file-like object
+    returned by open_file(filename) (which is used as context manager, i.e. it should clean up if an exception is raised).
+
+    The parser doesn't read the body itself, so that it can be used with both blocking and async streams.
+    """
+
+    def __init__(
+        self, boundary, open_file, files_key, allowed_extensions, min_file_count
+    ):
+        self._decoder = MultipartDecoder(
+            boundary, max_form_memory_size=MAX_FORM_MEMORY_SIZE
+        )
+        self._open_file = open_file
+        self._files_key = files_key
+        self._allowed_extensions = allowed_extensions
+        self._min_file_count = min_file_count
+        self._fields = {}
+        self._file_hashes = {}
+        self._current_part = None
+        # the file the data of the current file part is written to (None for regular form fields), and its context manager
+        self._current_file = None
+        self._current_file_context = None
+        self._field_data = bytearray()
+        self._sha256 = None
+
+    def receive_data(self, data: Optional[bytes]) -> bool:
+        """
+        Parses the next chunk of the body (None or an empty chunk marks the end of the body)
+
+        :return: True once the end of the multipart data was reached
+        """
+        # None signals the end of the data to the decoder
+        self._decoder.receive_data(data or None)
+        while True:
+            try:
+                event = self._decoder.next_event()
+            except ValueError:
+                # e.g. if the body ends in the middle of a part
+                raise UploadError("Invalid form data")
+            if isinstance(event, NeedData):
+                if not data:
+                    raise UploadError("Incomplete request body")
+                return False
+            elif isinstance(event, Epilogue):
+                return True
+            elif isinstance(event, File):
+                self._current_part = event
+                if event.name != self._files_key:
+                    raise UploadError(f"Unexpected file field '{event.name}'")
+                filename = secure_filename(event.filename)
+                if not filename.lower().endswith(self._allowed_extensions):
+                    raise UploadError(
+                        f"Only {', '.join(self._allowed_extensions)} files are supported"
+                    )
+                if get_track_name(filename) in map(get_track_name, self._file_hashes):
+                    raise UploadError(f"Duplicate file name '{filename}'")
+                logging.debug(f"Streaming {filename} to S3")
+                self._current_file_context = self._open_file(filename)
+                self._current_file = self._current_file_context.__enter__()
+                self._sha256 = hashlib.sha256()
+            elif isinstance(event, Field):
+                self._current_part = event
+                self._field_data.clear()
+            elif isinstance(event, Data):
+                if self._current_file is not None:
+                    self._current_file.write(event.data)
+                    self._sha256.update(event.data)
+                else:
+                    self._field_data += event.data
+                if not event.more_data:
+                    if self._current_file is not None:
+                        self._current_file = None
+                        self._current_file_context.__exit__(None, None, None)
+                        self._file_hashes[
+                            secure_filename(self._current_part.filename)
+                        ] = self._sha256.hexdigest()
+                    else:
+                        self._fields[self._current_part.name] = self._field_data.decode(
+                            "utf-8"
+                        )
+
+    def abort(self, e: BaseException):
+        """Lets the file that is currently written to clean up (e.g. abort its upload)"""
+        if self._current_file is not None:
+            self._current_file = None
+            self._current_file_context.__exit__(type(e), e, e.__traceback__)
+
+    def get_result(self) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """
+        :return: the (non-file) form fields and the SHA-256 of every file by (secured) file name
+        """
+        if len(self._file_hashes) == 0:
+            raise UploadError("No files included")
+        if len(self._file_hashes) < self._min_file_count:
+            raise UploadError(f"At least {self._min_file_count} files are required")
+
+        return self._fields, self._file_hashes
@@ -0,0 +1,31 @@
+# encoding profiles of the practice tracks, shared by the API (which validates them and caches results per profile) and the worker (which applies them)
+# every profile maps to the options of the ffmpeg output (the practice tracks are always mp3 files, encoded with LAME)
+# - "standard": ffmpeg's defaults (128 kbit/s CBR, stereo, 44.1 kHz)
+# - "rehearsal": mono, 22.05 kHz, low bitrate VBR (~40 kbit/s): good enough for listening on a phone, encodes several times faster
+#   and produces files that are about a third of the size
+# - "archival": 320 kbit/s CBR, stereo, 44.1 kHz
+ENCODING_PROFILES = {
+    "standard": {"acodec": "libmp3lame"},
+    "rehearsal": {"acodec": "libmp3lame", "ac": 1, "ar": 22050, "q:a": 7},
+    "archival": {"acodec": "libmp3lame", "b:a": "320k"},
+}
+
+DEFAULT_ENCODING_PROFILE = "standard"
+
+
+def get_encoding_options(profile: str) -> dict:
+    """
+    Returns the ffmpeg output options of an encoding profile, raising a ValueError if the profile doesn't exist
+    """
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(
+            f"Invalid encoding profile '{profile}' (must be one of {', '.join(ENCODING_PROFILES)})"
+        )
+    return ENCODING_PROFILES[profile]
+
+
+def is_mono(profile: str) -> bool:
+    """
+    Returns whether an encoding profile downmixes the practice tracks to mono (i.e. panning has no effect)
+    """
+    return get_encoding_options(profile).get("ac") == 1
@@ -0,0 +1,180 @@
+# mixing parameters shared by the API (which has to know them e.g. for caching) and the worker (which applies them)
+import re
+import json
+import math
+from typing import List, Optional
+
+# volume of the other tracks in a practice track (relative to the main track); any value accepted by parse_volume
+DEFAULT_OTHER_TRACKS_VOLUME = "-10dB"
+
+# how the volume of the mixes is normalized
+# - "mean_volume": every practice track gets the mean volume of its main track, the balanced mix the one of the first track
+#   (measured on the mixed samples; assumes that all tracks are about equally loud)
+# - "loudness": the tracks are brought to the same integrated loudness (EBU R128) before mixing, and every mix to TARGET_LOUDNESS
+#   (the gains are derived from the loudness of the tracks, which is measured once per input file)
+NORMALIZATION_MODES = ("mean_volume", "loudness")
+DEFAULT_NORMALIZATION = "mean_volume"
+
+# integrated loudness (in LUFS) of the mixes in the "loudness" mode, leaving some headroom for the peaks of mixes of many voices
+TARGET_LOUDNESS = -18.0
+
+# custom mixes that are created in addition to the practice tracks and the balanced mix, e.g.
+#   {"name": "low voices", "volumes": {"tenor": "0dB", "bass": "0dB"}, "default_volume": "-12dB"}
+#   {"name": "soprano left", "main": "soprano", "pan": "split", "mute": ["piano"]}
+# tracks are referred to by their file name without extension (in any case), every spec may contain the keys
+# - name (required): file name of the mix (without extension)
+# - main: the track that is highlighted like in a practice track, i.e. the other tracks are at the other tracks' volume by default;
+#   in the "mean_volume" mode, the mix gets the mean volume of this track (otherwise, the one of its loudest track)
+# - default_volume: volume of the tracks that aren't listed in volumes (default: 0dB, or the other tracks' volume if main is set)
+# - volumes: volume of individual tracks (any value accepted by parse_volume)
+# - mute: tracks that are left out of the mix
+# - pan: position of individual tracks in the stereo panorama, from -1 (left) to 1 (right), 0 being the center (the default),
+#   or "split": the main track on the left, all other tracks on the right
+MAX_CUSTOM_MIXES = 16
+SPLIT_PAN = "split"
+# mix names become file names, so they are restricted to a few characters
+_MIX_NAME_PATTERN = re.compile(r"[\w\- ]{1,64}")
+_MIX_SPEC_KEYS = {"name", "main", "default_volume", "volumes", "mute", "pan"}
+# name of the balanced mix (i.e. file name without extension), which custom mixes can't use
+BALANCED_MIX_NAME = "all"
+
+
+def parse_volume(volume) -> float:
+    """
+    Parses a volume as accepted by ffmpeg's volume filter (e.g. "-10dB" or "0.5") into a linear gain factor,
+    raising a ValueError if it is invalid
+    """
+    try:
+        if isinstance(volume, bool):
+            raise ValueError()
+        if isinstance(volume, str) and volume.strip().lower().endswith("db"):
+            gain = db_to_gain(float(volume.strip()[:-2]))
+        else:
+            gain = float(volume)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"Invalid volume '{volume}'")
+    if not math.isfinite(gain) or gain < 0:
+        raise ValueError(f"Invalid volume '{volume}'")
+    return gain
+
+
+def db_to_gain(db: float) -> float:
+    return 10 ** (db / 20)
+
+
+def parse_mixes(mixes, track_names: Optional[List[str]] = None) -> List[dict]:
+    """
+    Validates custom mix specs (see above), raising a ValueError if they are invalid
+
+    :param mixes: list of mix specs, or its JSON representation (as sent in form fields)
+    :param track_names: names of the tracks of the upload (see shared.uploads.get_track_name), if known: then, the specs may only
+        refer to these tracks, and the mixes must not be named like a practice track
+    :return: the specs in a canonical form (track names in lower case, volumes as linear gain factors, all keys present),
+        which is part of the result's cache key
+    """
+    if isinstance(mixes, str):
+        try:
+            mixes = json.loads(mixes)
+        except json.JSONDecodeError:
+            raise ValueError("Invalid mixes (must be a JSON list of mix specs)")
+    if not isinstance(mixes, list):
+        raise ValueError("Invalid mixes (must be a list of mix specs)")
+    if len(mixes) > MAX_CUSTOM_MIXES:
+        raise ValueError(f"Too many mixes (at most {MAX_CUSTOM_MIXES} are allowed)")
+
+    taken_names = {BALANCED_MIX_NAME, *(track_names or [])}
+    parsed_mixes = []
+    for spec in mixes:
+        mix = _parse_mix(spec)
+        if mix["name"].lower() in taken_names:
+            raise ValueError(f"Mix name '{mix['name']}' is already taken")
+        taken_names.add(mix["name"].lower())
+        if track_names is not None:
+            for track_name in get_mix_track_names(mix):
+                if track_name not in track_names:
+                    raise ValueError(
+                        f"Unknown track '{track_name}' in mix '{mix['name']}'"
+                    )
+        parsed_mixes.append(mix)
+    return parsed_mixes
+
+
+def get_mix_track_names(mix: dict) -> List[str]:
+    """
+    :return: the names of all tracks a (parsed) mix spec refers to
+    """
+    names = [mix["main"]] if mix["main"] is not None else []
+    names += list(mix["volumes"]) + mix["mute"]
+    if isinstance(mix["pan"], dict):
+        names += list(mix["pan"])
+    return names
+
+
+def is_panned(mix: dict) -> bool:
+    """
+    :return: whether any track of a (parsed) mix spec is moved out of the center of the stereo panorama
+    """
+    return mix["pan"] == SPLIT_PAN or any(mix["pan"].values())
+
+
+def _parse_mix(spec):
+    if not isinstance(spec, dict) or not isinstance(spec.get("name"), str):
+        raise ValueError("Invalid mix (must be an object with a name)")
+    name = spec["name"].strip()
+    if not _MIX_NAME_PATTERN.fullmatch(name):
+        raise ValueError(
+            f"Invalid mix name '{name}' (at most 64 letters, digits, spaces, '-' or '_')"
+        )
+    unknown_keys = set(spec) - _MIX_SPEC_KEYS
+    if unknown_keys:
+        raise ValueError(
+            f"Unknown keys in mix '{name}': {', '.join(sorted(unknown_keys))}"
+        )
+
+    main = spec.get("main")
+    if main is not None and not isinstance(main, str):
+        raise ValueError(f"Invalid main track in mix '{name}'")
+    volumes = spec.get("volumes", {})
+    mute = spec.get("mute", [])
+    pan = spec.get("pan", {})
+    if not isinstance(volumes, dict):
+        raise ValueError(f"Invalid volumes in mix '{name}'")
+    if not isinstance(mute, list) or not all(isinstance(track, str) for track in mute):
+        raise ValueError(f"Invalid mute list in mix '{name}'")
+    if pan == SPLIT_PAN:
+        if main is None:
+            raise ValueError(f"Mix '{name}' needs a main track for the split panning")
+    elif not isinstance(pan, dict) or not all(
+        isinstance(position, (int, float))
+        and not isinstance(position, bool)
+        and -1 <= position <= 1
+        for position in pan.values()
+    ):
+        raise ValueError(
+            f"Invalid panning in mix '{name}' (must be '{SPLIT_PAN}' or positions from -1 to 1)"
+        )
+    try:
+        default_volume = (
+            parse_volume(spec["default_volume"]) if "default_volume" in spec else None
+        )
+        volumes = {
+            track.lower(): parse_volume(volume) for track, volume in volumes.items()
+        }
+    except ValueError as e:
+        raise ValueError(f"{e} in mix '{name}'")
+
+    mute = sorted({track.lower() for track in mute})
+    if main is not None and main.lower() in mute:
+        raise ValueError(f"The main track of mix '{name}' is muted")
+    return {
+        "name": name,
+        "main": main.lower() if main is not None else None,
+        "default_volume": default_volume,
+        "volumes": volumes,
+        "mute": mute,
+        "pan": (
+            pan
+            if pan == SPLIT_PAN
+            else {track.lower(): float(position) for track, position in pan.items()}
+        ),
+    }
@@ -0,0 +1,101 @@
+# note: shared.settings imports OUTPUT_LAYOUTS from here, so this module can't import shared.s3 (which imports the settings) at the top
+
+# storage layout of the practice tracks of an upload in the S3 bucket (below the output prefix, see shared.result_cache.get_output_prefix)
+# - "zip": all practice tracks are bundled in {prefix}/practice_tracks.zip
+# - "tracks": every practice track is a separate object under {prefix}/tracks/, listed in {prefix}/tracks.json
+#   (every track is uploaded as soon as it is done, and clients can download only the tracks they need; the zip file is created on request)
+OUTPUT_LAYOUTS = ("zip", "tracks")
+
+OUTPUT_ZIP_NAME = "practice_tracks.zip"
+TRACKS_PREFIX = "tracks"
+TRACKS_MANIFEST_NAME = "tracks.json"
+
+# once the practice tracks of an upload are done, the worker stores where they are in {upload_id}/output.json (see create_output),
+# so that they can still be found after the result of the task expired
+UPLOAD_OUTPUT_NAME = "output.json"
+
+
+def get_output_zip_object_name(prefix):
+    return f"{prefix}/{OUTPUT_ZIP_NAME}"
+
+
+def get_tracks_prefix(prefix):
+    return f"{prefix}/{TRACKS_PREFIX}"
+
+
+def get_track_object_name(prefix, filename):
+    return f"{get_tracks_prefix(prefix)}/{filename}"
+
+
+def get_tracks_manifest_object_name(prefix):
+    return f"{prefix}/{TRACKS_MANIFEST_NAME}"
+
+
+def get_upload_output_object_name(upload_id):
+    return f"{upload_id}/{UPLOAD_OUTPUT_NAME}"
+
+
+def create_output(prefix, manifest=None):
+    """Describes where practice tracks are stored (this is the result of the tasks that create them)
+
+    Args:
+        prefix (str): the output prefix
+        manifest (dict, optional): the manifest of the practice tracks, if they are stored in the "tracks" layout (see create_tracks_manifest)
+
+    Returns:
+        dict: with the keys outputPrefix and zip (name of the zip file) or tracks (like in the manifest)
+    """
+    if manifest is not None:
+        return {"outputPrefix": prefix, **manifest}
+    return {"outputPrefix": prefix, "zip": get_output_zip_object_name(prefix)}
+
+
+def get_output_urls(output):
+    """Creates presigned URLs for practice tracks, which are only valid for a while (so they are created whenever they are requested)
+
+    Args:
+        output (dict): where the practice tracks are stored (see create_output)
+
+    Returns:
+        dict: with the key url (presigned URL of the zip file) or tracks (name and presigned URL of every track, see get_track_urls)
+    """
+    from .s3 import create_presigned_s3_url
+
+    if "tracks" in output:
+        return {"tracks": get_track_urls(output)}
+    return {"url": create_presigned_s3_url(output["zip"])}
+
+
+def create_tracks_manifest(prefix, filenames):
+    """Creates the manifest of the practice tracks in the "tracks" layout
+
+    Args:
+        prefix (str): the output prefix
+        filenames (list): file names of the practice tracks
+
+    Returns:
+        dict: the manifest (to be stored as JSON)
+    """
+    return {
+        "tracks": [
+            {"name": filename, "object": get_track_object_name(prefix, filename)}
+            for filename in filenames
+        ]
+    }
+
+
+def get_track_urls(manifest):
+    """Creates presigned URLs for all practice tracks in a manifest
+
+    Args:
+        manifest (dict): the manifest (see create_tracks_manifest)
+
+    Returns:
+        list: dicts with the keys name and url
+    """
+    from .s3 import create_presigned_s3_url
+
+    return [
+        {"name": track["name"], "url": create_presigned_s3_url(track["object"])}
+        for track in manifest["tracks"]
+    ]
@@ -0,0 +1,114 @@
+import json
+import hashlib
+import logging
+from datetime import datetime, timezone
+
+from .settings import RESULT_CACHE_TTL
+from .s3 import (
+    get_s3_file_info,
+    remove_file_from_s3,
+    download_json_from_s3,
+)
+from .outputs import (
+    create_output,
+    get_tracks_manifest_object_name,
+)
+
+# results of the practice track creation are stored under this prefix in the S3 bucket, keyed by their inputs
+RESULT_CACHE_PREFIX = "results"
+
+
+def get_result_key(file_hashes, mixing_params):
+    """Computes the key under which the result for the given inputs is stored
+
+    Args:
+        file_hashes (dict): SHA-256 of each input file's content, by file name (the file names end up in the result)
+        mixing_params (dict): parameters that influence the result (e.g. other_tracks_volume)
+
+    Returns:
+        str: the key (a SHA-256 as hex string)
+    """
+    key_data = json.dumps(
+        {"files": sorted(file_hashes.items()), "params": mixing_params},
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+def get_result_prefix(result_key):
+    """Returns the prefix of the result with the given key in the S3 bucket (see shared.outputs for the layout below it)"""
+    return f"{RESULT_CACHE_PREFIX}/{result_key}"
+
+
+def get_output_prefix(upload_id, result_key=None):
+    """Returns the prefix below which the practice tracks of an upload are stored
+
+    Args:
+        upload_id (str): ID of the upload
+        result_key (str, optional): if given, the practice tracks are stored in the result cache under this key
+
+    Returns:
+        str: the prefix
+    """
+    return get_result_prefix(result_key) if result_key is not None else str(upload_id)
+
+
+def get_cached_output(result_key, output_layout):
+    """Looks up a previously created result
+
+    Results that are older than RESULT_CACHE_TTL (in seconds) are considered stale and removed.
+    The key does not depend on the output layout, both layouts of the same result are stored side by side.
+
+    Args:
+        result_key (str): key of the result (see get_result_key)
+        output_layout (str): the output layout of the result (see shared.outputs)
+
+    Returns:
+        dict: where the result is stored (see shared.outputs.create_output), or None if there is no (fresh) result for the key
+    """
+    prefix = get_result_prefix(result_key)
+    if output_layout == "tracks":
+        object_name = get_tracks_manifest_object_name(prefix)
+        if not _is_fresh(object_name):
+            return None
+        manifest = download_json_from_s3(object_name)
+        if manifest is None:
+            return None
+        output = create_output(prefix, manifest)
+    else:
+        output = create_output(prefix)
+        object_name = output["zip"]
+        if not _is_fresh(object_name):
+            return None
+
+    logging.info(f"Found cached result {object_name}")
+    return output
+
+
+def _is_fresh(object_name):
+    info = get_s3_file_info(object_name)
+    if info is None:
+        return False
+
+    age = (datetime.now(timezone.utc) - info["LastModified"]).total_seconds()
+    if age > RESULT_CACHE_TTL:
+        logging.info(f"Removing stale result {object_name} (age: {age:.0f}s)")
+        # the tracks of a stale manifest are left to the bucket's lifecycle rule, they are overwritten by the next identical upload anyway
+        remove_file_from_s3(object_name)
+        return False
+    return True
+
+
+def get_result_cache_lifecycle_rule():
+    """Returns an S3 lifecycle rule that lets the bucket expire results that were not looked up in time
+
+    Returns:
+        dict: the rule (as expected by put_bucket_lifecycle_configuration)
+    """
+    return {
+        "ID": "expire-cached-results",
+        "Filter": {"Prefix": f"{RESULT_CACHE_PREFIX}/"},
+        "Status": "Enabled",
+        # S3 only supports expiration in whole days
+        "Expiration": {"Days": max(1, -(-RESULT_CACHE_TTL // (24 * 60 * 60)))},
+    }
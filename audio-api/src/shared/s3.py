@@ -1,7 +1,11 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import logging
 import os
+import json
+import threading
 from .settings import (
     S3_KEY,
     S3_SECRET,
@@ -11,25 +15,81 @@ from .settings import (
     LOCAL_S3_KEY,
     LOCAL_S3_SECRET,
     LOCAL_S3_ENDPOINT,
+    S3_MAX_POOL_CONNECTIONS,
+    S3_MAX_ATTEMPTS,
+    S3_TRANSFER_CONCURRENCY,
 )
 
-# cloud storage that is hosted somewhere online (e.g. AWS or alternative providers like Wasabi)
-remote_s3 = boto3.client(
-    "s3",
-    aws_access_key_id=S3_KEY,
-    aws_secret_access_key=S3_SECRET,
-    region_name=S3_REGION,
-    endpoint_url=S3_ENDPOINT,
+# size of the parts of multipart uploads (S3 requires at least 5 MB for all parts except the last one)
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# shared by all threads of a process: every transfer may use several connections at once (see TRANSFER_CONFIG),
+# and adaptive retries back off (client-side) when S3 starts throttling
+CLIENT_CONFIG = Config(
+    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "adaptive"},
 )
 
-# cloud storage that is hosted locally (e.g. MinIO)
-local_s3 = boto3.client(
-    "s3",
-    aws_access_key_id=LOCAL_S3_KEY,
-    aws_secret_access_key=LOCAL_S3_SECRET,
-    endpoint_url=LOCAL_S3_ENDPOINT,
+# audio files are several megabytes large, so they are transferred in parts of MULTIPART_PART_SIZE, several parts at once
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_PART_SIZE,
+    multipart_chunksize=MULTIPART_PART_SIZE,
+    max_concurrency=S3_TRANSFER_CONCURRENCY,
 )
 
+# clients are created lazily, once per process: boto3 clients can be shared by threads, but not across fork()
+# (both the Celery worker and gunicorn fork their worker processes after importing this module)
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_s3_client(use_local_s3=False):
+    """Returns the S3 client of the current process
+
+    Args:
+        use_local_s3 (bool): If True, returns the client for the locally hosted storage (e.g. MinIO) instead of the
+            one hosted somewhere online (e.g. AWS or alternative providers like Wasabi).
+
+    Returns:
+        the boto3 S3 client
+    """
+    global _clients, _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients = {}
+            _clients_pid = os.getpid()
+        if use_local_s3 not in _clients:
+            # sessions aren't thread-safe, so every client gets its own one
+            session = boto3.session.Session()
+            if use_local_s3:
+                _clients[use_local_s3] = session.client(
+                    "s3",
+                    aws_access_key_id=LOCAL_S3_KEY,
+                    aws_secret_access_key=LOCAL_S3_SECRET,
+                    endpoint_url=LOCAL_S3_ENDPOINT,
+                    config=CLIENT_CONFIG,
+                )
+            else:
+                _clients[use_local_s3] = session.client(
+                    "s3",
+                    aws_access_key_id=S3_KEY,
+                    aws_secret_access_key=S3_SECRET,
+                    region_name=S3_REGION,
+                    endpoint_url=S3_ENDPOINT,
+                    config=CLIENT_CONFIG,
+                )
+        return _clients[use_local_s3]
+
+
+def __getattr__(name):
+    # remote_s3 and local_s3 used to be module-level clients, keep them available for scripts
+    if name == "remote_s3":
+        return get_s3_client()
+    if name == "local_s3":
+        return get_s3_client(use_local_s3=True)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def download_file_from_s3(
     object_name, file_path, bucket_name=S3_BUCKET, use_local_s3=False
@@ -44,9 +104,11 @@ def download_file_from_s3(
     Returns:
         bool: True if file was downloaded, else False
     """
-    s3 = local_s3 if use_local_s3 else remote_s3
+    s3 = get_s3_client(use_local_s3)
     try:
-        result = s3.download_file(bucket_name, object_name, file_path)
+        result = s3.download_file(
+            bucket_name, object_name, file_path, Config=TRANSFER_CONFIG
+        )
         logging.debug(f"Downloaded file from S3: {result}")
     except Exception as e:
         logging.error(f"Could not download '{object_name}' from S3")
@@ -56,7 +118,11 @@ def download_file_from_s3(
 
 
 def upload_file_to_s3(
-    file_path, object_name=None, bucket_name=S3_BUCKET, use_local_s3=False
+    file_path,
+    object_name=None,
+    bucket_name=S3_BUCKET,
+    use_local_s3=False,
+    callback=None,
 ):
     """Upload a file to an S3 bucket
 
@@ -64,11 +130,12 @@ def upload_file_to_s3(
         file_path (str): Path to the file to upload
         object_name (str, optional): Name to save the file as in the bucket. Defaults to None (i.e. use the file's name).
         bucket_name (str): Name of the bucket to upload to. Defaults to the configured bucket name from settings.py.
+        callback (callable, optional): Called with the number of bytes transferred since the last call (possibly from another thread).
 
     Returns:
         bool: True if file was uploaded, else False
     """
-    s3 = local_s3 if use_local_s3 else remote_s3
+    s3 = get_s3_client(use_local_s3)
 
     if object_name is None:
         object_name = os.path.basename(file_path)
@@ -76,7 +143,13 @@ def upload_file_to_s3(
         logging.debug(
             f"Uploading local file '{file_path}' to S3 ({object_name}, bucket: {bucket_name})"
         )
-        s3.upload_file(file_path, bucket_name, object_name)
+        s3.upload_file(
+            file_path,
+            bucket_name,
+            object_name,
+            Callback=callback,
+            Config=TRANSFER_CONFIG,
+        )
         logging.debug(f"Uploaded file to S3 ({object_name}, bucket: {bucket_name})")
     except Exception as e:
         logging.error(f"Could not upload '{file_path}' to S3 ({object_name})")
@@ -94,7 +167,7 @@ def create_presigned_s3_url(object_name, bucket_name=S3_BUCKET, expiration=3600)
     :return: Presigned URL as string. If error, returns None.
     """
     try:
-        response = remote_s3.generate_presigned_url(
+        response = get_s3_client().generate_presigned_url(
             "get_object",
             Params={"Bucket": bucket_name, "Key": object_name},
             ExpiresIn=expiration,
@@ -108,6 +181,115 @@ def create_presigned_s3_url(object_name, bucket_name=S3_BUCKET, expiration=3600)
     return response
 
 
+def create_multipart_upload(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
+    """Start a multipart upload, whose parts can then be uploaded by clients (see create_presigned_upload_part_url)
+
+    Args:
+        object_name (str): Name to save the file as in the bucket
+        bucket_name (str): Name of the bucket to upload to. Defaults to the configured bucket name from settings.py.
+
+    Returns:
+        str: The ID of the multipart upload, or None if it could not be started
+    """
+    s3 = get_s3_client(use_local_s3)
+    try:
+        return s3.create_multipart_upload(Bucket=bucket_name, Key=object_name)[
+            "UploadId"
+        ]
+    except Exception as e:
+        logging.error(f"Could not start multipart upload of '{object_name}'")
+        logging.exception(e)
+        return None
+
+
+def create_presigned_upload_part_url(
+    object_name, upload_id, part_number, bucket_name=S3_BUCKET, expiration=3600
+):
+    """Generate a presigned URL to upload a part of a multipart upload (with a PUT request)
+
+    :param upload_id: ID of the multipart upload (see create_multipart_upload)
+    :param part_number: number of the part (starting at 1)
+    :param expiration: Time in seconds for the presigned URL to remain valid
+    :return: Presigned URL as string. If error, returns None.
+    """
+    try:
+        return get_s3_client().generate_presigned_url(
+            "upload_part",
+            Params={
+                "Bucket": bucket_name,
+                "Key": object_name,
+                "UploadId": upload_id,
+                "PartNumber": part_number,
+            },
+            ExpiresIn=expiration,
+        )
+    except ClientError as e:
+        logging.error(f"Could not generate presigned upload URL for '{object_name}'")
+        logging.exception(e)
+        return None
+
+
+def complete_multipart_upload(
+    object_name, upload_id, bucket_name=S3_BUCKET, use_local_s3=False
+):
+    """Complete a multipart upload with all parts that were uploaded so far (e.g. by a client, via presigned URLs)
+
+    Args:
+        object_name (str): Name of the file in the bucket
+        upload_id (str): ID of the multipart upload
+        bucket_name (str): Name of the bucket. Defaults to the configured bucket name from settings.py.
+
+    Returns:
+        bool: True if the upload was completed, else False (e.g. if no parts were uploaded or parts are too small)
+    """
+    s3 = get_s3_client(use_local_s3)
+    try:
+        parts = [
+            {"PartNumber": part["PartNumber"], "ETag": part["ETag"]}
+            for page in s3.get_paginator("list_parts").paginate(
+                Bucket=bucket_name, Key=object_name, UploadId=upload_id
+            )
+            for part in page.get("Parts", [])
+        ]
+        if not parts:
+            logging.error(f"No parts of '{object_name}' were uploaded")
+            return False
+        s3.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=object_name,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        logging.debug(
+            f"Completed multipart upload of '{object_name}' ({len(parts)} parts)"
+        )
+    except Exception as e:
+        logging.error(f"Could not complete multipart upload of '{object_name}'")
+        logging.exception(e)
+        return False
+    return True
+
+
+def abort_multipart_upload(
+    object_name, upload_id, bucket_name=S3_BUCKET, use_local_s3=False
+):
+    """Abort a multipart upload, discarding all parts that were uploaded so far
+
+    Returns:
+        bool: True if the upload was aborted, else False
+    """
+    s3 = get_s3_client(use_local_s3)
+    try:
+        s3.abort_multipart_upload(
+            Bucket=bucket_name, Key=object_name, UploadId=upload_id
+        )
+    except Exception as e:
+        logging.error(f"Could not abort multipart upload of '{object_name}'")
+        logging.exception(e)
+        return False
+    return True
+
+
 def remove_file_from_s3(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
     """Remove a file from an S3 bucket
 
@@ -118,7 +300,7 @@ def remove_file_from_s3(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
     Returns:
         bool: True if file was removed, else False
     """
-    s3 = local_s3 if use_local_s3 else remote_s3
+    s3 = get_s3_client(use_local_s3)
     try:
         result = s3.delete_object(Bucket=bucket_name, Key=object_name)
         logging.debug(f"Removed file from S3: {result}")
@@ -127,3 +309,171 @@ def remove_file_from_s3(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
         logging.exception(e)
         return False
     return True
+
+
+def get_s3_file_info(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
+    """Get the metadata of a file in an S3 bucket
+
+    Args:
+        object_name (str): Name of the file
+        bucket_name (str): Name of the bucket. Defaults to the configured bucket name from settings.py.
+
+    Returns:
+        dict: The metadata of the file (e.g. ContentLength, LastModified), or None if it does not exist
+    """
+    s3 = get_s3_client(use_local_s3)
+    try:
+        return s3.head_object(Bucket=bucket_name, Key=object_name)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            logging.error(f"Could not get info for '{object_name}' from S3")
+            logging.exception(e)
+        return None
+
+
+def upload_json_to_s3(data, object_name, bucket_name=S3_BUCKET, use_local_s3=False):
+    """Upload JSON-serializable data to an S3 bucket
+
+    Args:
+        data: The data to upload (e.g. a dict)
+        object_name (str): Name to save the data as in the bucket
+        bucket_name (str): Name of the bucket to upload to. Defaults to the configured bucket name from settings.py.
+
+    Returns:
+        bool: True if the data was uploaded, else False
+    """
+    s3 = get_s3_client(use_local_s3)
+    try:
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=object_name,
+            Body=json.dumps(data).encode("utf-8"),
+            ContentType="application/json",
+        )
+        logging.debug(f"Uploaded JSON to S3 ({object_name}, bucket: {bucket_name})")
+    except Exception as e:
+        logging.error(f"Could not upload JSON to S3 ({object_name})")
+        logging.exception(e)
+        return False
+    return True
+
+
+def download_json_from_s3(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
+    """Download JSON data from an S3 bucket
+
+    Args:
+        object_name (str): Name of the file to download
+        bucket_name (str): Name of the bucket to download from. Defaults to the configured bucket name from settings.py.
+
+    Returns:
+        The parsed JSON data, or None if the file does not exist or could not be downloaded
+    """
+    s3 = get_s3_client(use_local_s3)
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=object_name)
+        return json.loads(response["Body"].read())
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            logging.error(f"Could not download '{object_name}' from S3")
+            logging.exception(e)
+    except Exception as e:
+        logging.error(f"Could not download '{object_name}' from S3")
+        logging.exception(e)
+    return None
+
+
+class S3MultipartWriter:
+    """Writable, file-like object that streams everything written to it into an S3 object (using a multipart upload)
+
+    Only up to one part (part_size bytes) is kept in memory, so data of any (unknown) size can be uploaded
+    without writing it to a local file first. The object is only created in S3 once the writer is closed.
+    When used as context manager, the upload is aborted if an exception is raised inside the with block.
+    """
+
+    def __init__(
+        self,
+        object_name,
+        bucket_name=S3_BUCKET,
+        part_size=MULTIPART_PART_SIZE,
+        use_local_s3=False,
+    ):
+        self.object_name = object_name
+        self.bucket_name = bucket_name
+        self.part_size = part_size
+        self._s3 = get_s3_client(use_local_s3)
+        self._upload_id = self._s3.create_multipart_upload(
+            Bucket=bucket_name, Key=object_name
+        )["UploadId"]
+        self._parts = []
+        self._buffer = bytearray()
+        self._position = 0
+        self.closed = False
+        logging.debug(
+            f"Started multipart upload to S3 ({object_name}, bucket: {bucket_name})"
+        )
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        # parts are uploaded as soon as they are complete, the rest has to wait for close()
+        pass
+
+    def close(self):
+        """Uploads the remaining data and completes the upload"""
+        if self.closed:
+            return
+        if self._buffer or not self._parts:
+            self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+        self._s3.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.object_name,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+        self.closed = True
+        logging.debug(
+            f"Uploaded file to S3 ({self.object_name}, bucket: {self.bucket_name}, {self._position} bytes)"
+        )
+
+    def abort(self):
+        """Aborts the upload, discarding all parts that were uploaded so far"""
+        if self.closed:
+            return
+        try:
+            self._s3.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.object_name, UploadId=self._upload_id
+            )
+        except Exception as e:
+            logging.error(f"Could not abort multipart upload of '{self.object_name}'")
+            logging.exception(e)
+        self.closed = True
+
+    def _upload_part(self, data):
+        part_number = len(self._parts) + 1
+        response = self._s3.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.object_name,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        self._parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,249 @@
+# asyncio variants of the functions in s3.py, for code that runs in an event loop (e.g. the ASGI app of the API)
+# botocore only does blocking I/O, so the requests to S3 are made from a thread pool (using the pooled clients from s3.py);
+# a thread is only occupied while a request to S3 is in flight, not for the whole duration of e.g. an upload that is received slowly
+import asyncio
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import s3
+from .s3 import MULTIPART_PART_SIZE, get_s3_client
+from .settings import S3_BUCKET, S3_MAX_POOL_CONNECTIONS
+
+# more threads than connections in the pool of the client would only wait for a connection
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # like the clients, the thread pool can't be shared across fork()
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=S3_MAX_POOL_CONNECTIONS, thread_name_prefix="s3"
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """Runs a blocking function (e.g. one of the functions in s3.py) in the thread pool used for requests to S3
+
+    Returns:
+        the return value of the function
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+async def download_file_from_s3(
+    object_name, file_path, bucket_name=S3_BUCKET, use_local_s3=False
+):
+    """Download a file from an S3 bucket (see s3.download_file_from_s3)
+
+    Returns:
+        bool: True if file was downloaded, else False
+    """
+    return await run_in_executor(
+        s3.download_file_from_s3, object_name, file_path, bucket_name, use_local_s3
+    )
+
+
+async def upload_file_to_s3(
+    file_path,
+    object_name=None,
+    bucket_name=S3_BUCKET,
+    use_local_s3=False,
+    callback=None,
+):
+    """Upload a file to an S3 bucket (see s3.upload_file_to_s3)
+
+    Returns:
+        bool: True if file was uploaded, else False
+    """
+    return await run_in_executor(
+        s3.upload_file_to_s3,
+        file_path,
+        object_name,
+        bucket_name,
+        use_local_s3,
+        callback,
+    )
+
+
+async def create_presigned_s3_url(object_name, bucket_name=S3_BUCKET, expiration=3600):
+    """Generate a presigned URL to share an S3 object (see s3.create_presigned_s3_url)
+
+    URLs are signed locally, without a request to S3, so this doesn't need the thread pool.
+
+    Returns:
+        Presigned URL as string. If error, returns None.
+    """
+    return s3.create_presigned_s3_url(object_name, bucket_name, expiration)
+
+
+async def remove_file_from_s3(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
+    """Remove a file from an S3 bucket (see s3.remove_file_from_s3)
+
+    Returns:
+        bool: True if file was removed, else False
+    """
+    return await run_in_executor(
+        s3.remove_file_from_s3, object_name, bucket_name, use_local_s3
+    )
+
+
+async def get_s3_file_info(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
+    """Get the metadata of a file in an S3 bucket (see s3.get_s3_file_info)
+
+    Returns:
+        dict: The metadata of the file (e.g. ContentLength, LastModified), or None if it does not exist
+    """
+    return await run_in_executor(
+        s3.get_s3_file_info, object_name, bucket_name, use_local_s3
+    )
+
+
+async def upload_json_to_s3(
+    data, object_name, bucket_name=S3_BUCKET, use_local_s3=False
+):
+    """Upload JSON-serializable data to an S3 bucket (see s3.upload_json_to_s3)
+
+    Returns:
+        bool: True if the data was uploaded, else False
+    """
+    return await run_in_executor(
+        s3.upload_json_to_s3, data, object_name, bucket_name, use_local_s3
+    )
+
+
+async def download_json_from_s3(object_name, bucket_name=S3_BUCKET, use_local_s3=False):
+    """Download JSON data from an S3 bucket (see s3.download_json_from_s3)
+
+    Returns:
+        The parsed JSON data, or None if the file does not exist or could not be downloaded
+    """
+    return await run_in_executor(
+        s3.download_json_from_s3, object_name, bucket_name, use_local_s3
+    )
+
+
+class AsyncS3MultipartWriter:
+    """Like s3.S3MultipartWriter, but the parts are uploaded without blocking the event loop
+
+    write() only buffers the data, so that the writer can still be used by synchronous code (e.g. ZipFile).
+    The buffered parts are uploaded by drain(), which should be awaited regularly (e.g. after every chunk of a request body).
+    The multipart upload is only started once the first part is uploaded.
+    When used as async context manager, the upload is aborted if an exception is raised inside the with block.
+    """
+
+    def __init__(
+        self,
+        object_name,
+        bucket_name=S3_BUCKET,
+        part_size=MULTIPART_PART_SIZE,
+        use_local_s3=False,
+    ):
+        self.object_name = object_name
+        self.bucket_name = bucket_name
+        self.part_size = part_size
+        self._s3 = get_s3_client(use_local_s3)
+        self._upload_id = None
+        self._parts = []
+        self._buffer = bytearray()
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        # parts are uploaded by drain()
+        pass
+
+    async def drain(self):
+        """Uploads all complete parts that were written so far"""
+        while len(self._buffer) >= self.part_size:
+            data = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            await self._upload_part(data)
+
+    async def close(self):
+        """Uploads the remaining data and completes the upload"""
+        if self.closed:
+            return
+        await self.drain()
+        if self._buffer or not self._parts:
+            await self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+        await run_in_executor(
+            self._s3.complete_multipart_upload,
+            Bucket=self.bucket_name,
+            Key=self.object_name,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+        self.closed = True
+        logging.debug(
+            f"Uploaded file to S3 ({self.object_name}, bucket: {self.bucket_name}, {self._position} bytes)"
+        )
+
+    async def abort(self):
+        """Aborts the upload, discarding all parts that were uploaded so far"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._upload_id is None:
+            return
+        try:
+            await run_in_executor(
+                self._s3.abort_multipart_upload,
+                Bucket=self.bucket_name,
+                Key=self.object_name,
+                UploadId=self._upload_id,
+            )
+        except Exception as e:
+            logging.error(f"Could not abort multipart upload of '{self.object_name}'")
+            logging.exception(e)
+
+    async def _upload_part(self, data):
+        if self._upload_id is None:
+            response = await run_in_executor(
+                self._s3.create_multipart_upload,
+                Bucket=self.bucket_name,
+                Key=self.object_name,
+            )
+            self._upload_id = response["UploadId"]
+            logging.debug(
+                f"Started multipart upload to S3 ({self.object_name}, bucket: {self.bucket_name})"
+            )
+        part_number = len(self._parts) + 1
+        response = await run_in_executor(
+            self._s3.upload_part,
+            Bucket=self.bucket_name,
+            Key=self.object_name,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        self._parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
@@ -1,4 +1,7 @@
-from decouple import config
+from decouple import config, Choices
+
+from .outputs import OUTPUT_LAYOUTS
+from .uploads import INPUT_LAYOUTS
 
 DEBUG = config("DEBUG", default=False, cast=bool)
 
@@ -13,6 +16,52 @@ S3_ENDPOINT = config("S3_ENDPOINT")
 LOCAL_S3_KEY = config("LOCAL_S3_KEY")
 LOCAL_S3_SECRET = config("LOCAL_S3_SECRET")
 LOCAL_S3_BUCKET = config("LOCAL_S3_BUCKET")
+LOCAL_S3_ENDPOINT = config("LOCAL_S3_ENDPOINT", default=None)
 
 # Celery (Task Queue for background jobs)
 BROKER_URL = config("BROKER_URL")
+
+# Cache for the analysis results (volume, duration etc.) of input files, keyed by the SHA-256 of the file content
+ANALYSIS_CACHE_DIR = config("ANALYSIS_CACHE_DIR", default="cache/analysis")
+ANALYSIS_CACHE_MAX_BYTES = config(
+    "ANALYSIS_CACHE_MAX_BYTES", default=16 * 1024 * 1024, cast=int
+)
+# if enabled, analysis results are also stored in (and looked up from) the S3 bucket
+ANALYSIS_CACHE_S3_MIRROR = config("ANALYSIS_CACHE_S3_MIRROR", default=False, cast=bool)
+
+# time (in seconds) after which results of previous uploads with the same inputs are no longer reused
+RESULT_CACHE_TTL = config("RESULT_CACHE_TTL", default=7 * 24 * 60 * 60, cast=int)
+
+# how the API stores uploaded files in S3 (see shared/uploads.py): "zip" or "objects"
+INPUT_LAYOUT = config("INPUT_LAYOUT", default="objects", cast=Choices(INPUT_LAYOUTS))
+
+# if enabled, the practice tracks of an upload are created by separate Celery tasks (that can run on different workers)
+# only applies to uploads stored as separate objects (see INPUT_LAYOUT)
+DISTRIBUTED_MIXING = config("DISTRIBUTED_MIXING", default=False, cast=bool)
+
+# number of CPU cores the Celery worker (all of its processes together) may use for audio processing (0: all cores)
+WORKER_CPU_BUDGET = config("WORKER_CPU_BUDGET", default=0, cast=int)
+# maximum size (in bytes) of the decoded samples a task keeps in memory; tracks that don't fit anymore are written to disk
+# and memory-mapped from there (mixes are streamed block by block, so they hardly need any memory on top of that)
+JOB_MEMORY_LIMIT_BYTES = config(
+    "JOB_MEMORY_LIMIT_BYTES", default=1024 * 1024 * 1024, cast=int
+)
+# number of threads of each ffmpeg process
+FFMPEG_THREADS = config("FFMPEG_THREADS", default=1, cast=int)
+
+# minimum time (in seconds) between two progress updates of a task in the result backend
+PROGRESS_REPORT_INTERVAL = config("PROGRESS_REPORT_INTERVAL", default=1.0, cast=float)
+
+# if set, the Celery worker sends per-stage metrics of its tasks to this StatsD server (via UDP)
+STATSD_HOST = config("STATSD_HOST", default=None)
+STATSD_PORT = config("STATSD_PORT", default=8125, cast=int)
+STATSD_PREFIX = config("STATSD_PREFIX", default="audio_api")
+
+# how the worker stores the practice tracks in S3 by default (see shared/outputs.py): "zip" or "tracks"
+OUTPUT_LAYOUT = config("OUTPUT_LAYOUT", default="zip", cast=Choices(OUTPUT_LAYOUTS))
+
+# S3 client tuning: connections per process (shared by all threads), attempts per request (with adaptive retries),
+# and parts transferred concurrently per upload/download
+S3_MAX_POOL_CONNECTIONS = config("S3_MAX_POOL_CONNECTIONS", default=50, cast=int)
+S3_MAX_ATTEMPTS = config("S3_MAX_ATTEMPTS", default=5, cast=int)
+S3_TRANSFER_CONCURRENCY = config("S3_TRANSFER_CONCURRENCY", default=8, cast=int)
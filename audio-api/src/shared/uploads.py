@@ -0,0 +1,57 @@
+import os
+
+# storage layout of uploaded input files in the S3 bucket
+# - "zip": all input files are bundled in {upload_id}/input_files.zip
+# - "objects": every input file is a separate object under {upload_id}/inputs/, listed in {upload_id}/manifest.json
+#   (allows the worker to download the files concurrently and start decoding as soon as the first one is available)
+# files that clients upload directly to S3 are stored in the "objects" layout as well; until the upload is committed,
+# the files that are expected (and their multipart uploads) are listed in {upload_id}/pending_upload.json
+INPUT_LAYOUTS = ("zip", "objects")
+
+INPUT_ZIP_NAME = "input_files.zip"
+INPUTS_PREFIX = "inputs"
+MANIFEST_NAME = "manifest.json"
+PENDING_UPLOAD_NAME = "pending_upload.json"
+
+# file extensions of the audio files that are accepted as input (the worker decodes them natively with ffmpeg)
+INPUT_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a")
+
+
+def get_track_name(filename):
+    """
+    Returns the name of the file without extension, which has to be unique within an upload
+    (the practice tracks are named after the input files, but they are all mp3 files)
+    """
+    return os.path.splitext(filename)[0].lower()
+
+
+def get_input_zip_object_name(upload_id):
+    return f"{upload_id}/{INPUT_ZIP_NAME}"
+
+
+def get_input_object_name(upload_id, filename):
+    return f"{upload_id}/{INPUTS_PREFIX}/{filename}"
+
+
+def get_manifest_object_name(upload_id):
+    return f"{upload_id}/{MANIFEST_NAME}"
+
+
+def get_pending_upload_object_name(upload_id):
+    return f"{upload_id}/{PENDING_UPLOAD_NAME}"
+
+
+def create_manifest(file_hashes):
+    """Creates the manifest for an upload in the "objects" layout
+
+    Args:
+        file_hashes (dict): SHA-256 of each input file by file name
+
+    Returns:
+        dict: the manifest (to be stored as JSON)
+    """
+    return {
+        "files": [
+            {"name": name, "sha256": sha256} for name, sha256 in file_hashes.items()
+        ]
+    }
@@ -1,6 +1,16 @@
 import zipfile
+import hashlib
 
 
 def unzip_file(zip_file_path, extract_to_path):
     with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
         zip_ref.extractall(extract_to_path)
+
+
+def hash_file(path):
+    """Computes the SHA-256 of a file's content (as hex string)"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
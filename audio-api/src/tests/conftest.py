@@ -0,0 +1,60 @@
+import pytest
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    """
+    Replaces S3 with moto (which only intercepts requests to AWS endpoints) and creates the bucket from the settings
+    """
+    moto = pytest.importorskip("moto")
+    from shared import s3
+    from shared.settings import S3_BUCKET, S3_REGION
+
+    monkeypatch.setattr(s3, "S3_ENDPOINT", f"https://s3.{S3_REGION}.amazonaws.com")
+    # clients that were created before point to the configured endpoint
+    monkeypatch.setattr(s3, "_clients", {})
+    with moto.mock_s3():
+        s3.get_s3_client().create_bucket(
+            Bucket=S3_BUCKET,
+            **(
+                {"CreateBucketConfiguration": {"LocationConstraint": S3_REGION}}
+                if S3_REGION != "us-east-1"
+                else {}
+            ),
+        )
+        yield S3_BUCKET
+
+
+@pytest.fixture
+def started_tasks(monkeypatch):
+    """
+    Records the tasks the API starts instead of sending them to the broker
+    """
+    import flask_app
+
+    tasks = []
+
+    class FakeSignature:
+        def __init__(self, name, kwargs):
+            self.name = name
+            self.kwargs = kwargs
+
+        def apply_async(self, task_id):
+            tasks.append({"name": self.name, "task_id": task_id, **self.kwargs})
+
+    monkeypatch.setattr(flask_app.celery_app, "signature", FakeSignature)
+    return tasks
+
+
+@pytest.fixture
+def list_objects(s3_bucket):
+    """
+    Returns a function that lists the names of the objects in the bucket (below a prefix)
+    """
+    from shared.s3 import get_s3_client
+
+    def list_objects(prefix=""):
+        response = get_s3_client().list_objects_v2(Bucket=s3_bucket, Prefix=prefix)
+        return sorted(item["Key"] for item in response.get("Contents", []))
+
+    return list_objects
@@ -0,0 +1,99 @@
+import os
+import shutil
+import pytest
+from celery_worker import analysis
+from celery_worker.analysis import load_cached_analysis, store_analysis
+from celery_worker.audio import DecodedTrack
+from celery_worker.tasks import practice_tracks
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(analysis, "ANALYSIS_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(analysis, "ANALYSIS_CACHE_S3_MIRROR", False)
+    return cache_dir
+
+
+@pytest.fixture
+def decoder_runs(monkeypatch):
+    runs = []
+
+    def fake_decode_track(
+        path, pcm_dir, duration=None, on_progress=None, analyze=False, input_format=None
+    ):
+        runs.append({"path": path, "analyze": analyze, "input_format": input_format})
+        result = {"mean_volume": -20.0, "format": "mp3"} if analyze else None
+        return DecodedTrack(path, None, result)
+
+    monkeypatch.setattr(practice_tracks, "decode_track", fake_decode_track)
+    return runs
+
+
+def test_analysis_is_cached_by_content(tmp_path, cache_dir, decoder_runs):
+    first = tmp_path / "first.mp3"
+    copy = tmp_path / "copy.mp3"
+    first.write_bytes(b"some audio")
+    copy.write_bytes(b"some audio")
+
+    first_track = practice_tracks.load_track(str(first), str(tmp_path))
+    copy_track = practice_tracks.load_track(str(copy), str(tmp_path))
+
+    assert first_track.analysis == {"mean_volume": -20.0, "format": "mp3"}
+    assert copy_track.analysis == first_track.analysis
+    # the copy is only decoded, with the format from the cached analysis
+    assert decoder_runs == [
+        {"path": str(first), "analyze": True, "input_format": None},
+        {"path": str(copy), "analyze": False, "input_format": "mp3"},
+    ]
+
+
+def test_least_recently_used_entries_are_evicted(cache_dir, monkeypatch):
+    monkeypatch.setattr(analysis, "ANALYSIS_CACHE_MAX_BYTES", 100)
+    for i in range(5):
+        store_analysis(f"hash_{i}", {"mean_volume": -20.0})
+        # make sure that modification times differ between entries
+        for entry in os.scandir(cache_dir):
+            os.utime(entry.path, (entry.stat().st_mtime - 1,) * 2)
+
+    assert sum(entry.stat().st_size for entry in os.scandir(cache_dir)) <= 100
+    # the most recent entry is still cached, the oldest one was evicted
+    assert load_cached_analysis("hash_4") == {"mean_volume": -20.0}
+    assert load_cached_analysis("hash_0") is None
+
+
+def test_entries_from_s3_mirror_are_evicted_too(cache_dir, s3_bucket, monkeypatch):
+    monkeypatch.setattr(analysis, "ANALYSIS_CACHE_MAX_BYTES", 100)
+    monkeypatch.setattr(analysis, "ANALYSIS_CACHE_S3_MIRROR", True)
+    for i in range(5):
+        store_analysis(f"hash_{i}", {"mean_volume": -20.0})
+    # another worker's local cache
+    shutil.rmtree(cache_dir)
+
+    for i in range(5):
+        assert load_cached_analysis(f"hash_{i}") == {"mean_volume": -20.0}
+        for entry in os.scandir(cache_dir):
+            os.utime(entry.path, (entry.stat().st_mtime - 1,) * 2)
+
+    assert sum(entry.stat().st_size for entry in os.scandir(cache_dir)) <= 100
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_analysis_while_decoding(tmp_path):
+    from celery_worker.audio import decode_track
+
+    path = str(tmp_path / "sine.wav")
+    os.system(
+        f'ffmpeg -loglevel error -f lavfi -i "sine=frequency=440:duration=2" -ac 2 "{path}"'
+    )
+
+    result = decode_track(path, str(tmp_path), analyze=True).analysis
+
+    # the mean volume of a sine wave is 3dB below its peak
+    assert result["mean_volume"] == pytest.approx(result["max_volume"] - 3, abs=0.2)
+    assert result["max_volume"] == pytest.approx(-21.1, abs=0.2)
+    assert result["duration"] == pytest.approx(2)
+    assert result["sample_rate"] == 44100
+    assert result["channel_layout"] == "stereo"
+    assert result["format"] == "wav"
+    assert result["true_peak"] == pytest.approx(result["max_volume"], abs=0.1)
@@ -0,0 +1,107 @@
+import json
+import asyncio
+import hashlib
+import pytest
+import flask_app
+from flask_app import asgi
+from shared.s3 import download_json_from_s3
+from shared.uploads import get_input_zip_object_name
+
+BOUNDARY = "boundary"
+FILES = {"soprano.mp3": b"soprano" * 1000, "alto.mp3": b"alto" * 1000}
+
+
+@pytest.fixture(params=["zip", "objects"])
+def input_layout(request, monkeypatch):
+    monkeypatch.setattr(flask_app, "INPUT_LAYOUT", request.param)
+    monkeypatch.setattr(asgi, "INPUT_LAYOUT", request.param)
+    return request.param
+
+
+def create_body(files, fields):
+    body = b""
+    for name, value in fields.items():
+        body += (
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n"
+        ).encode()
+    for filename, data in files.items():
+        body += (
+            (
+                f"--{BOUNDARY}\r\n"
+                f'Content-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+                "Content-Type: audio/mpeg\r\n\r\n"
+            ).encode()
+            + data
+            + b"\r\n"
+        )
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def post(body, chunk_size=1000):
+    """Sends a POST /practice_tracks request to the ASGI app (in chunks) and returns the response status and body"""
+    chunks = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/practice_tracks",
+        "headers": [
+            (b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())
+        ],
+    }
+    asyncio.run(asgi.app(scope, receive, send))
+    start, response = sent
+    return start["status"], json.loads(response["body"])
+
+
+def test_upload(input_layout, list_objects, started_tasks):
+    status, body = post(create_body(FILES, {"output": "tracks"}))
+
+    assert status == 202
+    upload_id = body["uploadId"]
+    if input_layout == "zip":
+        assert list_objects() == [get_input_zip_object_name(upload_id)]
+    else:
+        assert list_objects() == [
+            f"{upload_id}/inputs/alto.mp3",
+            f"{upload_id}/inputs/soprano.mp3",
+            f"{upload_id}/manifest.json",
+        ]
+        assert download_json_from_s3(f"{upload_id}/manifest.json") == {
+            "files": [
+                {"name": name, "sha256": hashlib.sha256(data).hexdigest()}
+                for name, data in FILES.items()
+            ]
+        }
+    (task,) = started_tasks
+    assert task["task_id"] == upload_id
+    assert task["output_layout"] == "tracks"
+
+
+def test_invalid_upload_is_removed(input_layout, list_objects, started_tasks):
+    status, body = post(create_body(FILES, {"encoding": "lossless"}))
+
+    assert status == 400
+    assert "encoding" in body["error"]
+    assert list_objects() == []
+    assert started_tasks == []
+
+
+def test_invalid_files_are_rejected(input_layout, list_objects, started_tasks):
+    status, body = post(create_body({"soprano.mp3": b"soprano"}, {}))
+
+    assert status == 400
+    assert list_objects() == []
+    assert started_tasks == []
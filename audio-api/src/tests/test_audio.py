@@ -0,0 +1,289 @@
+import shutil
+import numpy as np
+import pytest
+from celery_worker.audio import (
+    CHANNELS,
+    DecodedTrack,
+    decode_track,
+    encode_mixes,
+    iter_mixes,
+    mix_mean_volumes,
+    get_pan_gains,
+)
+from celery_worker.loudness import to_db
+
+
+def mean_volume(samples):
+    # reference implementation of the mean volume of PCM samples (as measured by ffmpeg's volumedetect filter)
+    return to_db(np.mean(np.square(samples, dtype=np.float64)))
+
+
+def encode_samples(samples, out_path, gain=1.0, **kwargs):
+    # a single "mix" of a single track is encoded exactly like the track's samples
+    encode_mixes([DecodedTrack(out_path, samples)], [[gain]], [out_path], **kwargs)
+
+
+def test_mix_pads_shorter_tracks():
+    long_track = DecodedTrack("long.mp3", np.ones((5, CHANNELS), dtype=np.float32))
+    short_track = DecodedTrack("short.mp3", np.ones((3, CHANNELS), dtype=np.float32))
+
+    blocks = [
+        block.copy()
+        for block in iter_mixes(
+            [long_track, short_track], [[0.5, 0.25]], block_frames=2
+        )
+    ]
+
+    assert [block.shape for block in blocks] == [(1, 2, CHANNELS)] * 2 + [
+        (1, 1, CHANNELS)
+    ]
+    mix = np.concatenate(blocks, axis=1)[0]
+    np.testing.assert_allclose(mix[:, 0], [0.75, 0.75, 0.75, 0.5, 0.5])
+
+
+def test_mixes_are_rows_of_gain_matrix():
+    rng = np.random.default_rng(0)
+    tracks = [
+        DecodedTrack(f"{i}.mp3", rng.uniform(-0.5, 0.5, (frames, CHANNELS)))
+        for i, frames in enumerate((100_000, 150_000, 70_000))
+    ]
+    gain_matrix = [[1.0, 0.3, 0.3], [0.3, 1.0, 0.3], [0.0, 0.5, 2.0]]
+
+    mixes = np.concatenate(
+        [block.copy() for block in iter_mixes(tracks, gain_matrix)], axis=1
+    )
+
+    assert mixes.shape == (3, 150_000, CHANNELS)
+    padded = [
+        np.pad(track.samples, ((0, 150_000 - len(track.samples)), (0, 0)))
+        for track in tracks
+    ]
+    for mix, gains in zip(mixes, gain_matrix):
+        expected = sum(gain * samples for gain, samples in zip(gains, padded))
+        np.testing.assert_allclose(mix, expected, atol=1e-6)
+
+
+def test_mix_mean_volumes():
+    rng = np.random.default_rng(0)
+    tracks = [
+        DecodedTrack(f"{i}.mp3", rng.uniform(-0.5, 0.5, (frames, CHANNELS)))
+        for i, frames in enumerate((100_000, 150_000))
+    ]
+    mix = np.zeros((150_000, CHANNELS))
+    mix[:100_000] += 0.5 * tracks[0].samples
+    mix += 2 * tracks[1].samples
+
+    volumes = mix_mean_volumes(tracks, [[0.5, 2], [1, 0]])
+
+    assert volumes[0] == pytest.approx(mean_volume(mix), abs=1e-4)
+    assert volumes[1] == pytest.approx(
+        mean_volume(tracks[0].samples) + 10 * np.log10(100_000 / 150_000), abs=1e-4
+    )
+
+
+def test_mean_volume_of_single_track():
+    # a full scale square wave has a mean volume of 0dB, halving the amplitude reduces it by ~6dB
+    square_wave = np.tile([[1.0], [-1.0]], (1000, CHANNELS)).astype(np.float32)
+    tracks = [
+        DecodedTrack("square.mp3", square_wave),
+        DecodedTrack("silence.mp3", np.zeros((10, CHANNELS), dtype=np.float32)),
+    ]
+
+    volumes = mix_mean_volumes(tracks, [[1, 0], [0.5, 0], [0, 1]])
+
+    assert volumes[0] == pytest.approx(0)
+    assert volumes[1] == pytest.approx(-6.02, abs=0.01)
+    assert volumes[2] == -91
+
+
+def test_pan_gains():
+    np.testing.assert_allclose(
+        get_pan_gains([-1, 0, 0.5, 1]), [[1, 0], [1, 1], [0.5, 1], [0, 1]]
+    )
+
+
+def test_mixes_with_gains_per_channel():
+    rng = np.random.default_rng(0)
+    tracks = [
+        DecodedTrack(f"{i}.mp3", rng.uniform(-0.5, 0.5, (frames, CHANNELS)))
+        for i, frames in enumerate((100_000, 70_000))
+    ]
+    # the first track on the left, the second one on the right
+    gain_matrix = [[[1.0, 0.0], [0.0, 0.5]]]
+
+    (mix,) = np.concatenate(
+        [block.copy() for block in iter_mixes(tracks, gain_matrix)], axis=1
+    )
+
+    np.testing.assert_allclose(mix[:, 0], tracks[0].samples[:, 0], atol=1e-6)
+    np.testing.assert_allclose(
+        mix[:70_000, 1], 0.5 * tracks[1].samples[:, 1], atol=1e-6
+    )
+    assert mix_mean_volumes(tracks, gain_matrix)[0] == pytest.approx(
+        mean_volume(mix), abs=1e-4
+    )
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_encode_and_decode_track(tmp_path):
+    # one second of a 440 Hz sine wave
+    t = np.arange(44100) / 44100
+    sine = np.sin(2 * np.pi * 440 * t).astype(np.float32) * 0.5
+    samples = np.stack([sine] * CHANNELS, axis=1)
+
+    out_path = str(tmp_path / "sine.mp3")
+    encode_samples(samples, out_path)
+    track = decode_track(out_path, str(tmp_path))
+
+    assert track.samples.shape[1] == CHANNELS
+    # mp3 encoding adds some padding at the beginning and the end
+    assert abs(len(track.samples) - len(samples)) < 4096
+    assert np.abs(track.samples).max() == pytest.approx(0.5, abs=0.05)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_encode_and_decode_track_report_progress(tmp_path):
+    samples = np.zeros((5 * 44100, CHANNELS), dtype=np.float32)
+    encoding_progress = []
+    decoding_progress = []
+
+    out_path = str(tmp_path / "silence.mp3")
+    encode_samples(samples, out_path, on_progress=encoding_progress.append)
+    decode_track(out_path, str(tmp_path), 5.0, decoding_progress.append)
+
+    for progress in (encoding_progress, decoding_progress):
+        assert progress == sorted(progress)
+        assert progress[-1] == pytest.approx(1, abs=0.05)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_decode_track_analyzes_while_decoding(tmp_path):
+    t = np.arange(3 * 44100) / 44100
+    sine = np.sin(2 * np.pi * 440 * t).astype(np.float32) * 0.25
+    out_path = str(tmp_path / "sine.mp3")
+    encode_samples(np.stack([sine] * CHANNELS, axis=1), out_path)
+
+    track = decode_track(out_path, str(tmp_path), analyze=True)
+    decoded = decode_track(out_path, str(tmp_path))
+
+    # the analysis measures exactly the samples that are decoded
+    np.testing.assert_array_equal(track.samples, decoded.samples)
+    assert track.analysis["mean_volume"] == pytest.approx(
+        mean_volume(track.samples), abs=0.01
+    )
+    assert track.analysis["max_volume"] == pytest.approx(
+        20 * np.log10(np.abs(track.samples).max()), abs=0.1
+    )
+    assert track.analysis["duration"] == pytest.approx(3, abs=0.1)
+    assert track.analysis["sample_rate"] == 44100
+    assert track.analysis["channel_layout"] == "stereo"
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_tracks_beyond_memory_budget_are_memory_mapped(tmp_path):
+    from celery_worker.execution import memory_budget
+
+    samples = np.random.default_rng(0).uniform(-0.5, 0.5, (2 * 44100, CHANNELS))
+    out_path = str(tmp_path / "noise.mp3")
+    encode_samples(samples.astype(np.float32), out_path)
+    (tmp_path / "in_memory").mkdir()
+    (tmp_path / "memory_mapped").mkdir()
+
+    # the budget has room for one decoded track
+    with memory_budget(1_000_000) as budget:
+        in_memory = decode_track(out_path, str(tmp_path / "in_memory"))
+        memory_mapped = decode_track(out_path, str(tmp_path / "memory_mapped"))
+
+    assert not isinstance(in_memory.samples, np.memmap)
+    assert isinstance(memory_mapped.samples, np.memmap)
+    assert in_memory.samples.nbytes <= budget.reserved_bytes <= budget.limit_bytes
+    np.testing.assert_array_equal(memory_mapped.samples, in_memory.samples)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_encode_mixes(tmp_path):
+    samples = np.random.default_rng(0).uniform(-0.25, 0.25, (3 * 44100, CHANNELS))
+    tracks = [
+        DecodedTrack("a.mp3", samples.astype(np.float32)),
+        DecodedTrack("b.mp3", np.zeros((44100, CHANNELS), dtype=np.float32)),
+    ]
+    mix_paths = [str(tmp_path / "mix_1.mp3"), str(tmp_path / "mix_2.mp3")]
+    expected_path = str(tmp_path / "expected.mp3")
+    progress = []
+    encoded = []
+
+    encode_mixes(
+        tracks,
+        [[2.0, 1.0], [0.5, 1.0]],
+        mix_paths,
+        on_progress=progress.append,
+        # every mix is complete when it is reported
+        on_encoded=lambda i: encoded.append(decode_track(mix_paths[i], str(tmp_path))),
+    )
+    encode_samples(samples.astype(np.float32), expected_path, gain=2.0)
+
+    # the mixes are encoded exactly like the mixed samples would be
+    mixes = [decode_track(path, str(tmp_path), analyze=True) for path in mix_paths]
+    expected = decode_track(expected_path, str(tmp_path))
+    np.testing.assert_allclose(mixes[0].samples, expected.samples, atol=1e-6)
+    assert mixes[0].analysis["mean_volume"] - mixes[1].analysis[
+        "mean_volume"
+    ] == pytest.approx(12.04, abs=0.1)
+    assert progress[-1] == 1.0
+    assert [len(track.samples) for track in encoded] == [
+        len(mix.samples) for mix in mixes
+    ]
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_encode_with_profile(tmp_path):
+    t = np.arange(10 * 44100) / 44100
+    sine = np.sin(2 * np.pi * 440 * t).astype(np.float32) * 0.5
+    samples = np.stack([sine] * CHANNELS, axis=1)
+
+    standard_path = tmp_path / "standard.mp3"
+    rehearsal_path = tmp_path / "rehearsal.mp3"
+    encode_samples(samples, str(standard_path))
+    encode_samples(samples, str(rehearsal_path), profile="rehearsal")
+    track = decode_track(str(rehearsal_path), str(tmp_path), analyze=True)
+
+    assert track.analysis["sample_rate"] == 22050
+    assert track.analysis["channel_layout"] == "mono"
+    # decoded tracks always have the same layout, no matter how they were encoded
+    assert track.samples.shape[1] == CHANNELS
+    assert rehearsal_path.stat().st_size < standard_path.stat().st_size / 2
+
+    with pytest.raises(ValueError):
+        encode_samples(samples, str(tmp_path / "invalid.mp3"), profile="invalid")
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+@pytest.mark.parametrize("extension", ["wav", "flac", "ogg", "m4a"])
+def test_decode_track_supports_other_formats(tmp_path, extension):
+    import wave
+    import ffmpeg
+
+    t = np.arange(2 * 48000) / 48000
+    sine = (np.sin(2 * np.pi * 440 * t) * 0.5 * 32767).astype(np.int16)
+    wav_path = str(tmp_path / "sine.wav")
+    with wave.open(wav_path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(48000)
+        f.writeframes(sine.tobytes())
+    path = str(tmp_path / f"input.{extension}")
+    ffmpeg.input(wav_path).output(path).global_args("-loglevel", "error").run()
+
+    track = decode_track(path, str(tmp_path), analyze=True)
+    # decoding with the format from the analysis skips probing the file, with the same result
+    track_with_format = decode_track(
+        path, str(tmp_path), input_format=track.analysis["format"]
+    )
+
+    assert track.analysis["sample_rate"] == 48000
+    assert track.analysis["channel_layout"] == "mono"
+    assert track.analysis["duration"] == pytest.approx(2, abs=0.1)
+    # inputs are resampled to the common PCM layout
+    assert track.samples.shape[1] == CHANNELS
+    assert len(track.samples) == pytest.approx(2 * 44100, abs=4096)
+    np.testing.assert_array_equal(track.samples, track_with_format.samples)
@@ -0,0 +1,37 @@
+import pytest
+from flask_app.direct_upload import MAX_FILE_SIZE, _validate_files
+from flask_app.streaming_upload import UploadError
+
+SHA256 = "ab" * 32
+
+
+def test_files_are_validated():
+    files = _validate_files(
+        [
+            {"name": "../Soprano 1.mp3", "size": 10, "sha256": SHA256.upper()},
+            {"name": "alto.flac", "size": MAX_FILE_SIZE, "sha256": SHA256},
+        ]
+    )
+
+    assert files == [
+        {"name": "Soprano_1.mp3", "size": 10, "sha256": SHA256},
+        {"name": "alto.flac", "size": MAX_FILE_SIZE, "sha256": SHA256},
+    ]
+
+
+@pytest.mark.parametrize(
+    "file",
+    [
+        {"name": "alto.aiff", "size": 10, "sha256": SHA256},
+        {"name": "alto.mp3", "size": 0, "sha256": SHA256},
+        {"name": "alto.mp3", "size": MAX_FILE_SIZE + 1, "sha256": SHA256},
+        {"name": "alto.mp3", "size": "10", "sha256": SHA256},
+        {"name": "alto.mp3", "size": 10, "sha256": "not a hash"},
+        {"name": "soprano.mp3", "size": 10, "sha256": SHA256},
+        # the practice track would have the same name
+        {"name": "Soprano.flac", "size": 10, "sha256": SHA256},
+    ],
+)
+def test_invalid_files_are_rejected(file):
+    with pytest.raises(UploadError):
+        _validate_files([{"name": "soprano.mp3", "size": 10, "sha256": SHA256}, file])
@@ -0,0 +1,111 @@
+import io
+import os
+import shutil
+import pytest
+from zipfile import ZipFile
+from celery_worker import analysis
+from celery_worker.tasks import practice_tracks
+from shared.mixing import parse_mixes
+from shared.outputs import get_upload_output_object_name
+from shared.s3 import (
+    download_json_from_s3,
+    get_s3_client,
+    upload_file_to_s3,
+    upload_json_to_s3,
+)
+from shared.uploads import (
+    create_manifest,
+    get_input_object_name,
+    get_manifest_object_name,
+)
+from shared.utils import hash_file
+
+DISTRIBUTED_OUTPUTS = f"upload/{practice_tracks.DISTRIBUTED_OUTPUTS_PREFIX}/"
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg is not installed"
+)
+
+
+@pytest.fixture
+def eager_workflow(tmp_path, monkeypatch):
+    from celery_worker import app
+
+    # the tasks of the workflow run in this process, one after the other
+    monkeypatch.setattr(app.conf, "task_always_eager", True)
+    monkeypatch.setattr(app.conf, "result_backend", "cache+memory://")
+    monkeypatch.setattr(practice_tracks, "DISTRIBUTED_MIXING", True)
+    monkeypatch.setattr(analysis, "ANALYSIS_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(analysis, "ANALYSIS_CACHE_S3_MIRROR", False)
+    # the tasks create their temporary files in the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def upload_stems(tmp_path, upload_id, names):
+    import ffmpeg
+
+    hashes = {}
+    for i, name in enumerate(names):
+        path = str(tmp_path / name)
+        (
+            ffmpeg.input(f"sine=frequency={220 * (i + 1)}:duration=1", format="lavfi")
+            .output(path, ac=2)
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        upload_file_to_s3(path, get_input_object_name(upload_id, name))
+        hashes[name] = hash_file(path)
+    upload_json_to_s3(create_manifest(hashes), get_manifest_object_name(upload_id))
+
+
+def test_tracks_are_rendered_and_bundled(
+    tmp_path, s3_bucket, list_objects, eager_workflow
+):
+    upload_stems(tmp_path, "upload", ["soprano.mp3", "alto.mp3"])
+
+    result = practice_tracks.create.apply(
+        kwargs={"upload_id": "upload", "output_layout": "zip"}
+    )
+
+    assert result.get() == {
+        "outputPrefix": "upload",
+        "zip": "upload/practice_tracks.zip",
+    }
+    assert download_json_from_s3(get_upload_output_object_name("upload")) == (
+        result.get()
+    )
+    body = get_s3_client().get_object(Bucket=s3_bucket, Key=result.get()["zip"])
+    with ZipFile(io.BytesIO(body["Body"].read())) as zip_file:
+        assert sorted(zip_file.namelist()) == ["all.mp3", "alto.mp3", "soprano.mp3"]
+    # the tracks rendered by the individual tasks are removed once they are bundled
+    assert list_objects(DISTRIBUTED_OUTPUTS) == []
+    assert not os.path.exists(tmp_path / "tmp") or os.listdir(tmp_path / "tmp") == []
+
+
+def test_tracks_are_rendered_and_published(tmp_path, list_objects, eager_workflow):
+    upload_stems(tmp_path, "upload", ["soprano.mp3", "alto.mp3"])
+
+    result = practice_tracks.create.apply(
+        kwargs={
+            "upload_id": "upload",
+            "output_layout": "tracks",
+            "custom_mixes": parse_mixes(
+                [{"name": "soprano solo", "mute": ["alto"]}], ["soprano", "alto"]
+            ),
+        }
+    )
+
+    output = result.get()
+    assert output["outputPrefix"] == "upload"
+    assert {track["name"] for track in output["tracks"]} == {
+        "all.mp3",
+        "alto.mp3",
+        "soprano.mp3",
+        "soprano solo.mp3",
+    }
+    assert download_json_from_s3(get_upload_output_object_name("upload")) == output
+    # the tracks are rendered to their final location right away, there is nothing to clean up
+    assert list_objects("upload/tracks/") == sorted(
+        track["object"] for track in output["tracks"]
+    )
+    assert list_objects(DISTRIBUTED_OUTPUTS) == []
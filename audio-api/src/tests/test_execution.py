@@ -0,0 +1,204 @@
+import os
+import time
+import threading
+import contextvars
+import multiprocessing
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from celery_worker import execution
+from celery_worker.execution import (
+    JobGroup,
+    MemoryBudget,
+    cpu_slots,
+    get_memory_budget,
+    memory_budget,
+)
+
+# child processes have to share the slots with the tests, like the pool processes of the worker do
+fork = multiprocessing.get_context("fork")
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    monkeypatch.setattr(execution, "CPU_SLOTS", 2)
+    owners = multiprocessing.Array("i", 2)
+    monkeypatch.setattr(execution, "_cpu_slot_owners", owners)
+    monkeypatch.setattr(
+        execution, "_multi_slot_owner", multiprocessing.Value("i", 0, lock=False)
+    )
+    monkeypatch.setattr(execution, "CPU_SLOT_POLL_INTERVAL", 0.01)
+    return owners
+
+
+def run_in_threads(fn, count):
+    threads = [threading.Thread(target=fn) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_cpu_bound_jobs_are_limited_to_the_slots(slots):
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def job():
+        with cpu_slots():
+            with lock:
+                running.append(1)
+                max_running.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+    run_in_threads(job, 6)
+
+    assert max(max_running) == 2
+    assert list(slots) == [0, 0]
+
+
+def test_jobs_that_need_several_slots_do_not_deadlock(slots):
+    done = []
+
+    def job():
+        # more slots than there are, i.e. all of them
+        with cpu_slots(3):
+            assert list(slots) == [os.getpid()] * 2
+            time.sleep(0.01)
+        done.append(1)
+
+    run_in_threads(job, 4)
+
+    assert len(done) == 4
+    assert list(slots) == [0, 0]
+
+
+def test_slots_of_killed_processes_are_reclaimed(slots):
+    def hold_slots_and_die():
+        with cpu_slots(2):
+            os._exit(1)
+
+    process = fork.Process(target=hold_slots_and_die)
+    process.start()
+    process.join()
+    assert list(slots) == [process.pid] * 2
+
+    with cpu_slots(2):
+        assert list(slots) == [os.getpid()] * 2
+    assert list(slots) == [0, 0]
+
+
+def test_jobs_run_without_slots_while_lock_is_held(slots, monkeypatch):
+    monkeypatch.setattr(execution, "CPU_SLOT_LOCK_TIMEOUT", 0.1)
+    locked = fork.Event()
+    release = fork.Event()
+
+    def hold_lock():
+        with slots.get_lock():
+            locked.set()
+            release.wait(timeout=10)
+
+    process = fork.Process(target=hold_lock)
+    process.start()
+    try:
+        assert locked.wait(timeout=10)
+        with cpu_slots():
+            # (reading the slots through the wrapper would wait for the lock, too)
+            assert list(slots.get_obj()) == [0, 0]
+        # the lock still belongs to the other process
+        assert not slots.get_lock().acquire(block=False)
+    finally:
+        release.set()
+        process.join()
+
+    with cpu_slots(2):
+        assert list(slots) == [os.getpid()] * 2
+    assert list(slots) == [0, 0]
+
+
+def test_jobs_run_without_slots_if_lock_holder_was_killed(slots, monkeypatch):
+    monkeypatch.setattr(execution, "CPU_SLOT_LOCK_TIMEOUT", 0.1)
+
+    def hold_lock_and_die():
+        slots.get_lock().acquire()
+        os._exit(1)
+
+    process = fork.Process(target=hold_lock_and_die)
+    process.start()
+    process.join()
+
+    with cpu_slots(2):
+        assert list(slots.get_obj()) == [0, 0]
+
+
+def test_slots_are_released_if_waiting_fails(slots, monkeypatch):
+    slots[0] = os.getppid()
+
+    def interrupt(_):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(execution.time, "sleep", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        with cpu_slots(2):
+            pass
+
+    assert list(slots) == [os.getppid(), 0]
+
+
+def test_jobs_run_in_the_context_of_the_submitter():
+    variable = contextvars.ContextVar("variable", default=None)
+    variable.set("task")
+
+    with JobGroup() as jobs:
+        results = list(jobs.map(lambda i: (i, variable.get()), range(3)))
+
+    assert results == [(0, "task"), (1, "task"), (2, "task")]
+
+
+def test_pending_jobs_are_cancelled_on_error(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(execution, "get_executor", lambda: executor)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(timeout=10)
+
+    with pytest.raises(RuntimeError):
+        with JobGroup() as jobs:
+            first = jobs.submit(block)
+            second = jobs.submit(lambda: None)
+            started.wait(timeout=10)
+            # the running job finishes after the pending one was cancelled
+            threading.Timer(0.1, release.set).start()
+            raise RuntimeError("job failed")
+
+    assert first.done() and not first.cancelled()
+    assert second.cancelled()
+    executor.shutdown()
+
+
+def test_memory_budget():
+    budget = MemoryBudget(100)
+
+    assert budget.try_reserve(60)
+    assert not budget.try_reserve(50)
+    budget.release(60)
+    assert budget.try_reserve(100)
+    assert budget.reserved_bytes == 100
+
+
+def test_jobs_share_the_memory_budget_of_their_task():
+    with memory_budget(100) as budget:
+        with JobGroup() as jobs:
+            reservations = list(
+                jobs.map(lambda _: get_memory_budget().try_reserve(40), range(3))
+            )
+
+    assert sorted(reservations) == [False, True, True]
+    assert budget.reserved_bytes == 80
+    # outside of tasks, every call returns a separate budget
+    assert get_memory_budget() is not get_memory_budget()
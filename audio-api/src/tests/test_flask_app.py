@@ -0,0 +1,298 @@
+import io
+import json
+import hashlib
+import pytest
+import flask_app
+from flask_app.streaming_upload import UploadError
+from shared.outputs import (
+    create_output,
+    create_tracks_manifest,
+    get_upload_output_object_name,
+)
+from shared.result_cache import get_result_prefix
+from shared.uploads import get_input_object_name, get_pending_upload_object_name
+from shared.s3 import upload_json_to_s3, download_json_from_s3, get_s3_client
+
+
+class FakeAsyncResult:
+    """Stand-in for Celery's AsyncResult, with the states set by the tests (unknown tasks are PENDING)"""
+
+    states = {}
+
+    def __init__(self, task_id, app=None):
+        states = self.states.get(task_id, [("PENDING", None)])
+        # tasks with several states move on to the next one whenever their state is requested
+        self.state, self.result = states[0] if len(states) == 1 else states.pop(0)
+        self.info = self.result
+
+
+@pytest.fixture
+def task_states(monkeypatch):
+    FakeAsyncResult.states = {}
+    monkeypatch.setattr(flask_app, "AsyncResult", FakeAsyncResult)
+    return FakeAsyncResult.states
+
+
+@pytest.fixture
+def client():
+    return flask_app.app.test_client()
+
+
+def put_object(bucket, object_name, body=b"audio"):
+    get_s3_client().put_object(Bucket=bucket, Key=object_name, Body=body)
+
+
+def test_status_of_running_task(client, task_states):
+    task_states["upload"] = [("PROGRESS", {"progress": 0.5})]
+
+    response = client.get("/practice_tracks/upload")
+
+    assert response.json == {"uploadId": "upload", "state": "PROGRESS", "progress": 0.5}
+
+
+def test_errors_of_failed_task_are_not_shown(client, task_states):
+    task_states["upload"] = [
+        ("FAILURE", FileNotFoundError("/srv/worker/tmp/upload/inputs/alto.mp3"))
+    ]
+
+    response = client.get("/practice_tracks/upload")
+
+    assert response.json == {
+        "uploadId": "upload",
+        "state": "FAILURE",
+        "progress": 0,
+        "error": "Something went wrong",
+    }
+
+
+def test_urls_are_presigned_when_requested(client, task_states, s3_bucket):
+    task_states["upload"] = [("SUCCESS", create_output("results/key"))]
+
+    response = client.get("/practice_tracks/upload")
+
+    assert response.json["state"] == "SUCCESS"
+    assert response.json["progress"] == 1
+    assert "/results/key/practice_tracks.zip?" in response.json["url"]
+
+
+def test_tracks_of_expired_task_are_found_in_s3(client, task_states, s3_bucket):
+    manifest = create_tracks_manifest("results/key", ["soprano.mp3", "all.mp3"])
+    upload_json_to_s3(manifest, "results/key/tracks.json")
+    upload_json_to_s3(
+        create_output("results/key", manifest), get_upload_output_object_name("upload")
+    )
+
+    response = client.get("/practice_tracks/upload")
+
+    assert response.json["state"] == "SUCCESS"
+    assert [track["name"] for track in response.json["tracks"]] == [
+        "soprano.mp3",
+        "all.mp3",
+    ]
+    assert "/results/key/tracks/soprano.mp3?" in response.json["tracks"][0]["url"]
+
+
+def test_removed_outputs_of_expired_task_are_not_found(client, task_states, s3_bucket):
+    upload_json_to_s3(create_output("upload"), get_upload_output_object_name("upload"))
+
+    assert client.get("/practice_tracks/upload").json["state"] == "PENDING"
+
+    put_object(s3_bucket, "upload/practice_tracks.zip")
+    assert client.get("/practice_tracks/upload").json["state"] == "SUCCESS"
+
+
+def test_events_are_sent_until_task_is_done(
+    client, task_states, s3_bucket, monkeypatch
+):
+    monkeypatch.setattr(flask_app, "SSE_POLL_INTERVAL", 0)
+    task_states["upload"] = [
+        ("PENDING", None),
+        ("PROGRESS", {"progress": 0.5}),
+        ("PROGRESS", {"progress": 0.5}),
+        ("SUCCESS", create_output("upload")),
+    ]
+
+    response = client.get("/practice_tracks/upload/events")
+
+    assert response.mimetype == "text/event-stream"
+    events = [
+        json.loads(line[len("data: ") :])
+        for line in response.get_data(as_text=True).splitlines()
+        if line.startswith("data: ")
+    ]
+    # unchanged states are only sent once
+    assert [(event["state"], event["progress"]) for event in events] == [
+        ("PENDING", 0),
+        ("PROGRESS", 0.5),
+        ("SUCCESS", 1),
+    ]
+    assert "/upload/practice_tracks.zip?" in events[-1]["url"]
+
+
+def test_zip_of_expired_task_is_found_in_s3(client, task_states, s3_bucket):
+    manifest = create_tracks_manifest("upload", ["soprano.mp3", "all.mp3"])
+    upload_json_to_s3(manifest, "upload/tracks.json")
+    upload_json_to_s3(
+        create_output("upload", manifest), get_upload_output_object_name("upload")
+    )
+    put_object(s3_bucket, "upload/practice_tracks.zip")
+
+    response = client.post("/practice_tracks/upload/zip")
+
+    assert response.status_code == 200
+    assert response.json["state"] == "SUCCESS"
+    assert "/upload/practice_tracks.zip?" in response.json["url"]
+
+
+def test_upload_in_objects_layout(client, list_objects, started_tasks, monkeypatch):
+    monkeypatch.setattr(flask_app, "INPUT_LAYOUT", "objects")
+    files = {"soprano.mp3": b"soprano", "alto.mp3": b"alto"}
+
+    response = client.post(
+        "/practice_tracks",
+        data={
+            "files": [(io.BytesIO(data), name) for name, data in files.items()],
+            "output": "tracks",
+        },
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 202
+    upload_id = response.json["uploadId"]
+    # every file is a separate object, listed in the manifest with its SHA-256
+    assert list_objects() == [
+        f"{upload_id}/inputs/alto.mp3",
+        f"{upload_id}/inputs/soprano.mp3",
+        f"{upload_id}/manifest.json",
+    ]
+    assert download_json_from_s3(f"{upload_id}/manifest.json") == {
+        "files": [
+            {"name": name, "sha256": hashlib.sha256(data).hexdigest()}
+            for name, data in files.items()
+        ]
+    }
+    (task,) = started_tasks
+    assert task["name"] == "practice_tracks.create"
+    assert task["task_id"] == upload_id
+    assert task["output_layout"] == "tracks"
+
+
+def test_invalid_upload_in_objects_layout_is_removed(
+    client, list_objects, started_tasks, monkeypatch
+):
+    monkeypatch.setattr(flask_app, "INPUT_LAYOUT", "objects")
+
+    response = client.post(
+        "/practice_tracks",
+        data={
+            "files": [
+                (io.BytesIO(b"soprano"), "soprano.mp3"),
+                (io.BytesIO(b"alto"), "alto.mp3"),
+            ],
+            # not an encoding profile
+            "encoding": "lossless",
+        },
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 400
+    assert list_objects() == []
+    assert started_tasks == []
+
+
+def test_zip_of_cached_tracks_can_be_requested(
+    client, task_states, s3_bucket, started_tasks, monkeypatch
+):
+    monkeypatch.setattr(flask_app, "INPUT_LAYOUT", "objects")
+    monkeypatch.setattr(flask_app, "get_result_key", lambda *args: "key")
+    manifest = create_tracks_manifest(
+        get_result_prefix("key"), ["soprano.mp3", "alto.mp3", "all.mp3"]
+    )
+    upload_json_to_s3(manifest, f"{get_result_prefix('key')}/tracks.json")
+
+    response = client.post(
+        "/practice_tracks",
+        data={
+            "files": [
+                (io.BytesIO(b"soprano"), "soprano.mp3"),
+                (io.BytesIO(b"alto"), "alto.mp3"),
+            ],
+            "output": "tracks",
+        },
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 200
+    assert len(response.json["tracks"]) == 3
+    assert started_tasks == []
+    upload_id = response.json["uploadId"]
+    # the upload resolves to the cached tracks
+    assert client.get(f"/practice_tracks/{upload_id}").json["state"] == "SUCCESS"
+
+    response = client.post(f"/practice_tracks/{upload_id}/zip")
+
+    assert response.status_code == 202
+    (task,) = started_tasks
+    assert task["name"] == "practice_tracks.zip_tracks"
+    assert task["output_prefix"] == get_result_prefix("key")
+
+
+def test_direct_uploads_do_not_get_cached_results(
+    client, s3_bucket, started_tasks, monkeypatch
+):
+    monkeypatch.setattr(flask_app, "get_result_key", lambda *args: "key")
+    upload_json_to_s3(
+        create_tracks_manifest(get_result_prefix("key"), ["soprano.mp3", "all.mp3"]),
+        f"{get_result_prefix('key')}/tracks.json",
+    )
+    # the client claims to upload files with the hashes of the cached result
+    files = {"soprano.mp3": b"not soprano", "alto.mp3": b"not alto"}
+    response = client.post(
+        "/practice_tracks/uploads",
+        json={
+            "files": [
+                {"name": name, "size": len(data), "sha256": "ab" * 32}
+                for name, data in files.items()
+            ]
+        },
+    )
+    assert response.status_code == 201
+    upload_id = response.json["uploadId"]
+    pending_upload = download_json_from_s3(get_pending_upload_object_name(upload_id))
+    for file in pending_upload["files"]:
+        get_s3_client().upload_part(
+            Bucket=s3_bucket,
+            Key=get_input_object_name(upload_id, file["name"]),
+            UploadId=file["uploadId"],
+            PartNumber=1,
+            Body=files[file["name"]],
+        )
+
+    response = client.post(
+        f"/practice_tracks/{upload_id}/commit", json={"output": "tracks"}
+    )
+
+    assert response.status_code == 202
+    assert "tracks" not in response.json
+    # the worker creates the practice tracks, after checking the hashes
+    (task,) = started_tasks
+    assert task["task_id"] == upload_id
+    assert task["result_key"] == "key"
+
+
+@pytest.mark.parametrize("pan", ["split", {"alto": -0.5}])
+def test_panned_mixes_are_rejected_with_mono_encoding(pan):
+    fields = {
+        "mixes": [{"name": "panned", "main": "soprano", "pan": pan}],
+        "encoding": "rehearsal",
+    }
+
+    with pytest.raises(UploadError, match="stereo"):
+        flask_app.parse_upload_fields(fields, ["soprano.mp3", "alto.mp3"])
+
+    # in the center, tracks are the same in mono
+    fields["mixes"][0]["pan"] = {"alto": 0}
+    flask_app.parse_upload_fields(fields, ["soprano.mp3", "alto.mp3"])
+    fields["mixes"][0]["pan"] = pan
+    fields["encoding"] = "standard"
+    flask_app.parse_upload_fields(fields, ["soprano.mp3", "alto.mp3"])
@@ -0,0 +1,52 @@
+import sys
+import subprocess
+from celery_worker import instrumentation, statsd
+from celery_worker.execution import JobGroup
+from celery_worker.instrumentation import collect_metrics, stage, wait_for_process
+
+
+def test_stages_of_jobs_are_accounted_to_the_task(monkeypatch):
+    sent = []
+    monkeypatch.setattr(instrumentation, "send_metrics", sent.extend)
+
+    def job():
+        with stage("decoding"):
+            process = subprocess.Popen(
+                [sys.executable, "-c", "print('done')"], stdout=subprocess.PIPE
+            )
+            stdout, _ = wait_for_process(process)
+        assert stdout.strip() == b"done"
+        assert process.returncode == 0
+
+    with collect_metrics("create") as metrics:
+        metrics.voices = 3
+        with JobGroup() as executor:
+            for _ in range(3):
+                executor.submit(job)
+
+    decoding = metrics.as_dict()["stages"]["decoding"]
+    assert decoding["count"] == 3
+    assert decoding["processes"] == 3
+    assert decoding["process_cpu_time_s"] > 0
+    assert decoding["process_max_rss_bytes"] > 0
+    assert "create.succeeded:1|c" in sent
+    assert any(
+        line.startswith("create.voices_3.stage.decoding.wall_time:") for line in sent
+    )
+
+
+def test_stages_outside_of_tasks_are_ignored():
+    with stage("decoding"):
+        process = subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"])
+        wait_for_process(process)
+    assert process.returncode == 3
+
+
+def test_statsd_lines_are_batched():
+    lines = [f"stage.{i}.wall_time:{i}|ms" for i in range(200)]
+
+    batches = list(statsd._batch(lines))
+
+    assert len(batches) > 1
+    assert all(len(batch) <= statsd.MAX_DATAGRAM_SIZE for batch in batches)
+    assert "\n".join(batches).split("\n") == lines
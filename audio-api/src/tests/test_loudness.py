@@ -0,0 +1,138 @@
+import re
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from celery_worker.loudness import (
+    ABSOLUTE_GATE_LUFS,
+    SILENCE_DB,
+    LoudnessMeter,
+    get_normalization_gains,
+)
+
+SAMPLE_RATE = 44100
+
+
+def sine(frequency, amplitude, duration, phase=0.0):
+    t = np.arange(int(duration * SAMPLE_RATE)) / SAMPLE_RATE
+    wave = amplitude * np.sin(2 * np.pi * frequency * t + phase)
+    return np.stack([wave] * 2, axis=1).astype(np.float32)
+
+
+def measure(samples, block_frames=64 * 1024):
+    meter = LoudnessMeter(SAMPLE_RATE, 2)
+    for start in range(0, len(samples), block_frames):
+        meter.add(samples[start : start + block_frames])
+    return meter.result()
+
+
+def test_sine_wave():
+    # a 997 Hz sine wave at -20 dBFS in both channels has a loudness of -20 LUFS (see ITU-R BS.1770-4)
+    result = measure(sine(997, 0.1, 5))
+
+    assert result["integrated_loudness"] == pytest.approx(-20, abs=0.05)
+    assert result["max_volume"] == pytest.approx(-20, abs=0.01)
+    assert result["mean_volume"] == pytest.approx(-23.01, abs=0.01)
+
+
+def test_result_does_not_depend_on_block_size():
+    samples = sine(440, 0.5, 3) + sine(5000, 0.2, 3, phase=1)
+
+    expected = measure(samples, len(samples))
+    for block_frames in (1000, 4410, 70000):
+        assert measure(samples, block_frames) == pytest.approx(expected)
+
+
+def test_quiet_parts_are_gated():
+    loud = sine(997, 0.1, 5)
+    samples = np.concatenate([loud, loud * 0.001, loud])
+
+    # (without gating, it would be ~-21.8 LUFS; only the blocks that overlap both parts lower the loudness a bit)
+    assert measure(samples)["integrated_loudness"] == pytest.approx(-20, abs=0.2)
+
+
+def test_true_peak_between_samples():
+    # at a quarter of the sample rate, with this phase, all samples are at 1/sqrt(2) of the actual peak
+    samples = sine(SAMPLE_RATE / 4, 1.0, 1, phase=np.pi / 4)
+    result = measure(samples)
+
+    assert result["max_volume"] == pytest.approx(-3.01, abs=0.01)
+    assert result["true_peak"] == pytest.approx(0, abs=0.1)
+
+
+def test_silence():
+    result = measure(np.zeros((SAMPLE_RATE, 2), dtype=np.float32))
+
+    assert result == {
+        "mean_volume": SILENCE_DB,
+        "max_volume": SILENCE_DB,
+        "integrated_loudness": ABSOLUTE_GATE_LUFS,
+        "true_peak": SILENCE_DB,
+    }
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_matches_ffmpeg(tmp_path):
+    from celery_worker.audio import decode_track
+
+    # pink noise plus a sine wave, with a quiet part in between
+    path = str(tmp_path / "noise.wav")
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "anoisesrc=d=10:c=pink:a=0.3:seed=1",
+            "-f",
+            "lavfi",
+            "-i",
+            "sine=f=220:d=10",
+            "-filter_complex",
+            "[0][1]amerge=inputs=2,volume=enable='between(t,3,5)':volume=0.05",
+            path,
+        ],
+        check=True,
+    )
+    output = subprocess.run(
+        ["ffmpeg", "-nostats", "-i", path]
+        + ["-af", "ebur128=peak=true,volumedetect", "-f", "null", "-"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    # the ebur128 filter logs the momentary values as well, the results are in the summary at the end
+    output = output[output.rindex("Summary:") :]
+
+    result = decode_track(path, str(tmp_path), analyze=True).analysis
+
+    assert result["integrated_loudness"] == pytest.approx(
+        float(re.search(r"I:\s+(\S+) LUFS", output).group(1)), abs=0.1
+    )
+    # (ffmpeg uses a different interpolation filter, and both only approximate the peak of the continuous signal)
+    assert result["true_peak"] == pytest.approx(
+        float(re.search(r"Peak:\s+(\S+) dBFS", output).group(1)), abs=0.2
+    )
+    assert result["mean_volume"] == pytest.approx(
+        float(re.search(r"mean_volume: (\S+) dB", output).group(1)), abs=0.1
+    )
+
+
+def test_normalization_gains():
+    # a track at -30 LUFS and one at -20 LUFS, the second one 6 dB quieter than the first one in the mix
+    gains = get_normalization_gains([-30.0, -20.0], [1.0, 0.5], -18.0)
+
+    # each track on its own would be at -18 LUFS + its relative gain, together they add up to -18 LUFS
+    mix_energy = sum(
+        (gain * 10 ** (loudness / 20)) ** 2
+        for gain, loudness in zip(gains, [-30.0, -20.0])
+    )
+    assert 10 * np.log10(mix_energy) == pytest.approx(-18.0)
+    assert gains[0] / gains[1] == pytest.approx(2 * 10 ** (10 / 20))
+    # silent tracks are mixed as they are
+    assert get_normalization_gains([-30.0, ABSOLUTE_GATE_LUFS], [1.0, 1.0], -30.0) == [
+        pytest.approx(1.0),
+        pytest.approx(1.0),
+    ]
@@ -0,0 +1,69 @@
+import pytest
+from shared.mixing import parse_mixes, parse_volume
+
+
+def test_parse_volume():
+    assert parse_volume("0dB") == pytest.approx(1)
+    assert parse_volume("-20dB") == pytest.approx(0.1)
+    assert parse_volume("0.5") == pytest.approx(0.5)
+    assert parse_volume(0.5) == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize("volume", ["loud", "-0.5", "", None, True, "infdB"])
+def test_invalid_volumes_are_rejected(volume):
+    with pytest.raises(ValueError):
+        parse_volume(volume)
+
+
+def test_parse_mixes():
+    mixes = parse_mixes(
+        '[{"name": "low voices", "volumes": {"Tenor": "0dB", "bass": 1}, "default_volume": "-20dB"},'
+        ' {"name": "soprano left", "main": "Soprano", "pan": "split", "mute": ["alto"]}]',
+        ["soprano", "alto", "tenor", "bass"],
+    )
+
+    assert mixes == [
+        {
+            "name": "low voices",
+            "main": None,
+            "default_volume": pytest.approx(0.1),
+            "volumes": {"tenor": 1.0, "bass": 1.0},
+            "mute": [],
+            "pan": {},
+        },
+        {
+            "name": "soprano left",
+            "main": "soprano",
+            "default_volume": None,
+            "volumes": {},
+            "mute": ["alto"],
+            "pan": "split",
+        },
+    ]
+    assert parse_mixes([]) == []
+
+
+@pytest.mark.parametrize(
+    "mixes",
+    [
+        "not json",
+        {"name": "mix"},
+        [{"volumes": {}}],
+        [{"name": "../mix"}],
+        [{"name": "mix", "gain": 1}],
+        [{"name": "mix"}, {"name": "Mix"}],
+        # names of the practice tracks and the balanced mix are taken
+        [{"name": "soprano"}],
+        [{"name": "all"}],
+        [{"name": "mix", "volumes": {"soprano": "loud"}}],
+        [{"name": "mix", "volumes": {"piano": "0dB"}}],
+        [{"name": "mix", "mute": "alto"}],
+        [{"name": "mix", "main": "alto", "mute": ["alto"]}],
+        [{"name": "mix", "pan": "split"}],
+        [{"name": "mix", "pan": {"alto": 2}}],
+        [{"name": f"mix {i}"} for i in range(17)],
+    ],
+)
+def test_invalid_mixes_are_rejected(mixes):
+    with pytest.raises(ValueError):
+        parse_mixes(mixes, ["soprano", "alto"])
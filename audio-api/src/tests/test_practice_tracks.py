@@ -0,0 +1,208 @@
+import io
+import numpy as np
+import pytest
+from zipfile import ZipFile
+from celery_worker.tasks import practice_tracks
+from celery_worker.tasks.practice_tracks import open_output_zip, add_to_output_zip
+from shared.mixing import TARGET_LOUDNESS
+
+
+class FakeS3MultipartWriter:
+    """Unseekable in-memory stand-in for S3MultipartWriter"""
+
+    uploads = {}
+
+    def __init__(self, object_name):
+        self.object_name = object_name
+        self.buffer = io.BytesIO()
+        self.aborted = False
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def tell(self):
+        return self.buffer.tell()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.aborted:
+            self.uploads[self.object_name] = self.buffer.getvalue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.aborted = True
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    FakeS3MultipartWriter.uploads = {}
+    monkeypatch.setattr(practice_tracks, "S3MultipartWriter", FakeS3MultipartWriter)
+    return FakeS3MultipartWriter.uploads
+
+
+def test_tracks_are_streamed_into_zip_file(tmp_path, uploads):
+    paths = []
+    for name in ("soprano.mp3", "all.mp3"):
+        (tmp_path / name).write_bytes(name.encode() * 1000)
+        paths.append(str(tmp_path / name))
+
+    with open_output_zip("upload/practice_tracks.zip") as zip_file:
+        for path in paths:
+            add_to_output_zip(zip_file, path)
+
+    with ZipFile(io.BytesIO(uploads["upload/practice_tracks.zip"])) as zip_file:
+        assert zip_file.namelist() == ["soprano.mp3", "all.mp3"]
+        assert zip_file.read("all.mp3") == b"all.mp3" * 1000
+
+
+def test_zip_file_is_not_created_if_a_track_fails(tmp_path, uploads):
+    (tmp_path / "soprano.mp3").write_bytes(b"audio")
+
+    with pytest.raises(RuntimeError):
+        with open_output_zip("upload/practice_tracks.zip") as zip_file:
+            add_to_output_zip(zip_file, str(tmp_path / "soprano.mp3"))
+            raise RuntimeError("encoding failed")
+
+    assert uploads == {}
+
+
+def test_loudness_normalization():
+    from celery_worker.audio import CHANNELS, DecodedTrack, iter_mixes
+    from celery_worker.loudness import LoudnessMeter
+    from celery_worker.tasks.practice_tracks import Mix, get_gain_matrix
+
+    def measure(blocks):
+        meter = LoudnessMeter(44100, CHANNELS)
+        for block in blocks:
+            meter.add(block)
+        return meter.result()
+
+    # uncorrelated stems with very different levels
+    rng = np.random.default_rng(0)
+    tracks = []
+    for i, level in enumerate((0.3, 0.01, 0.05)):
+        samples = (rng.standard_normal((5 * 44100, CHANNELS)) * level).astype(
+            np.float32
+        )
+        tracks.append(DecodedTrack(f"{i}.mp3", samples, measure([samples])))
+
+    (gains,) = get_gain_matrix(tracks, [Mix("mix.mp3", [1.0, 0.5, 0.5], 1)], "loudness")
+
+    mix = (block[0] for block in iter_mixes(tracks, [gains]))
+    assert measure(mix)["integrated_loudness"] == pytest.approx(
+        TARGET_LOUDNESS, abs=0.2
+    )
+
+
+def test_mix_batches(monkeypatch):
+    monkeypatch.setattr(practice_tracks, "CPU_SLOTS", 4)
+    assert practice_tracks.get_mix_batches(3) == [[0, 1, 2]]
+    assert practice_tracks.get_mix_batches(5) == [[0, 2, 4], [1, 3]]
+
+    monkeypatch.setattr(practice_tracks, "CPU_SLOTS", 1)
+    assert practice_tracks.get_mix_batches(3) == [[0], [1], [2]]
+
+
+def test_mean_volume_normalization():
+    from celery_worker.audio import (
+        CHANNELS,
+        DecodedTrack,
+        iter_mixes,
+        mix_mean_volumes,
+    )
+    from celery_worker.tasks.practice_tracks import (
+        get_balanced_mix,
+        get_gain_matrix,
+        get_practice_track_mix,
+    )
+
+    rng = np.random.default_rng(0)
+    tracks = []
+    for i, level in enumerate((0.3, 0.1)):
+        samples = rng.uniform(-level, level, (44100, CHANNELS)).astype(np.float32)
+        (volume,) = mix_mean_volumes([DecodedTrack("", samples)], [[1.0]])
+        tracks.append(DecodedTrack(f"{i}.mp3", samples, {"mean_volume": volume}))
+    mixes = [
+        get_practice_track_mix(tracks, 0, "-10dB"),
+        get_practice_track_mix(tracks, 1, "-10dB"),
+        get_balanced_mix(tracks),
+    ]
+
+    gain_matrix = get_gain_matrix(tracks, mixes, "mean_volume")
+
+    # every mix gets the mean volume of its reference track
+    mixed = np.concatenate(
+        [block.copy() for block in iter_mixes(tracks, gain_matrix)], axis=1
+    )
+    volumes = mix_mean_volumes(
+        [DecodedTrack(mix.filename, samples) for mix, samples in zip(mixes, mixed)],
+        np.eye(len(mixes)),
+    )
+    for mix, volume in zip(mixes, volumes):
+        assert volume == pytest.approx(
+            tracks[mix.reference].analysis["mean_volume"], abs=1e-3
+        )
+    assert [mix.filename for mix in mixes] == ["0.mp3", "1.mp3", "all.mp3"]
+
+
+def test_custom_mix():
+    from celery_worker.audio import CHANNELS, DecodedTrack
+    from celery_worker.tasks.practice_tracks import get_custom_mix, get_gain_matrix
+    from shared.mixing import parse_mixes
+
+    rng = np.random.default_rng(0)
+    tracks = [
+        DecodedTrack(
+            f"/tmp/{name}.mp3",
+            rng.uniform(-0.5, 0.5, (44100, CHANNELS)).astype(np.float32),
+            {"integrated_loudness": -20.0},
+        )
+        for name in ("Soprano", "alto", "tenor")
+    ]
+    (spec,) = parse_mixes(
+        [{"name": "soprano left", "main": "soprano", "pan": "split", "mute": ["tenor"]}]
+    )
+
+    mix = get_custom_mix(tracks, spec, "-20dB")
+
+    assert mix.filename == "soprano left.mp3"
+    assert mix.gains == [1.0, pytest.approx(0.1), 0.0]
+    assert mix.pan == [-1.0, 1.0, 1.0]
+    assert mix.reference == 0
+
+    (gains,) = get_gain_matrix(tracks, [mix], "loudness")
+    # the soprano only on the left, the alto only on the right (20dB quieter), the tenor not at all
+    assert gains[0, 1] == gains[2, 0] == gains[2, 1] == 0
+    assert gains[1, 0] == 0
+    assert gains[1, 1] / gains[0, 0] == pytest.approx(0.1)
+
+    (spec,) = parse_mixes([{"name": "mix", "volumes": {"bass": "0dB"}}])
+    with pytest.raises(ValueError):
+        get_custom_mix(tracks, spec, "-20dB")
+
+
+def test_custom_mix_without_main_track_gets_volume_of_loudest_track():
+    from celery_worker.audio import CHANNELS, DecodedTrack
+    from celery_worker.tasks.practice_tracks import get_custom_mix
+    from shared.mixing import parse_mixes
+
+    tracks = [
+        DecodedTrack(f"/tmp/{name}.mp3", np.zeros((10, CHANNELS), dtype=np.float32))
+        for name in ("soprano", "alto", "tenor")
+    ]
+    muted, turned_down = parse_mixes(
+        [
+            {"name": "no soprano", "mute": ["soprano"]},
+            {"name": "tenor", "volumes": {"tenor": "0dB"}, "default_volume": "-12dB"},
+        ]
+    )
+
+    assert get_custom_mix(tracks, muted, "-10dB").reference == 1
+    assert get_custom_mix(tracks, turned_down, "-10dB").reference == 2
@@ -0,0 +1,65 @@
+import threading
+from celery_worker import progress as progress_module
+from celery_worker.progress import ProgressTracker, bytes_callback
+
+
+def test_progress_is_aggregated_across_stages_and_jobs():
+    tracker = ProgressTracker(lambda progress: None)
+    tracker.add_stage("decoding", 0.4, job_count=2)
+    tracker.add_stage("encoding", 0.6)
+
+    tracker.update("decoding", 0.5, job=0)
+    tracker.complete("decoding", job=1)
+    assert tracker.progress == 0.4 * 0.75
+
+    tracker.update("encoding", 0.5)
+    # jobs can't go backwards
+    tracker.update("encoding", 0.2)
+    assert tracker.progress == 0.4 * 0.75 + 0.6 * 0.5
+
+
+def test_reports_are_rate_limited(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(progress_module.time, "monotonic", lambda: now[0])
+    reports = []
+    tracker = ProgressTracker(reports.append, interval=1.0)
+    tracker.add_stage("encoding", 1.0, job_count=1)
+
+    for i in range(1, 101):
+        now[0] += 0.1
+        tracker.update("encoding", i / 100)
+
+    # 10 seconds of updates, at most one report per second
+    assert 10 <= len(reports) <= 11
+    assert reports == sorted(reports)
+
+
+def test_progress_is_reported_without_blocking_other_jobs():
+    reports = []
+
+    def report(progress):
+        # e.g. waiting for the result backend, while other jobs keep updating their progress
+        assert not tracker._lock.locked()
+        updater = threading.Thread(target=tracker.update, args=("encoding", 0.5, 1))
+        updater.start()
+        updater.join(timeout=1)
+        assert not updater.is_alive()
+        reports.append(progress)
+
+    tracker = ProgressTracker(report, interval=60.0)
+    tracker.add_stage("encoding", 1.0, job_count=2)
+
+    tracker.complete("encoding", job=0)
+
+    assert tracker.progress == 0.75
+    assert reports == [0.5]
+
+
+def test_bytes_callback_accumulates_transferred_bytes():
+    fractions = []
+    callback = bytes_callback(fractions.append, 200)
+
+    callback(50)
+    callback(150)
+
+    assert fractions == [0.25, 1.0]
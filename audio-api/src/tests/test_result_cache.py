@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+from shared import result_cache
+from shared.outputs import create_output, create_tracks_manifest
+from shared.result_cache import (
+    get_result_key,
+    get_cached_output,
+    get_output_prefix,
+)
+
+
+def test_result_key_does_not_depend_on_file_order():
+    params = {"other_tracks_volume": "-10dB"}
+    key = get_result_key({"a.mp3": "1", "b.mp3": "2"}, params)
+
+    assert key == get_result_key({"b.mp3": "2", "a.mp3": "1"}, params)
+    assert key != get_result_key({"a.mp3": "1", "b.mp3": "3"}, params)
+    assert key != get_result_key({"a.mp3": "2", "b.mp3": "1"}, params)
+    assert key != get_result_key(
+        {"a.mp3": "1", "b.mp3": "2"}, {"other_tracks_volume": "-5dB"}
+    )
+
+
+def test_stale_results_are_removed(monkeypatch):
+    removed = []
+    last_modified = datetime.now(timezone.utc)
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_TTL", 60)
+    monkeypatch.setattr(
+        result_cache,
+        "get_s3_file_info",
+        lambda object_name: {"LastModified": last_modified},
+    )
+    monkeypatch.setattr(result_cache, "remove_file_from_s3", removed.append)
+
+    assert get_cached_output("key", "zip") == create_output("results/key")
+
+    last_modified -= timedelta(seconds=61)
+    assert get_cached_output("key", "zip") is None
+    assert removed == ["results/key/practice_tracks.zip"]
+
+
+def test_cached_tracks_are_found_via_their_manifest(monkeypatch):
+    manifest = create_tracks_manifest("results/key", ["a.mp3", "all.mp3"])
+    monkeypatch.setattr(
+        result_cache,
+        "get_s3_file_info",
+        lambda object_name: {"LastModified": datetime.now(timezone.utc)},
+    )
+    monkeypatch.setattr(
+        result_cache,
+        "download_json_from_s3",
+        lambda object_name: (
+            manifest if object_name == "results/key/tracks.json" else None
+        ),
+    )
+
+    assert get_cached_output("key", "tracks") == create_output("results/key", manifest)
+
+
+def test_outputs_of_uncached_uploads_are_stored_below_the_upload():
+    assert get_output_prefix("upload") == "upload"
+    assert get_output_prefix("upload", "key") == "results/key"
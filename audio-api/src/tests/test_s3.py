@@ -19,3 +19,16 @@ def test_s3():
     print(create_presigned_s3_url("test.txt"))
     remove_file_from_s3("test.txt")
     os.remove("test.txt")
+
+
+def test_clients_are_created_once_per_process(monkeypatch):
+    from shared import s3
+
+    client = s3.get_s3_client()
+    assert s3.get_s3_client() is client
+    assert s3.remote_s3 is client
+    assert s3.get_s3_client(use_local_s3=True) is not client
+
+    # e.g. in a forked Celery worker process
+    monkeypatch.setattr(s3.os, "getpid", lambda: -1)
+    assert s3.get_s3_client() is not client
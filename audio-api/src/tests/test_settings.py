@@ -0,0 +1,23 @@
+import importlib
+import pytest
+from shared import settings
+
+
+def test_invalid_input_layout_is_rejected(monkeypatch):
+    monkeypatch.setenv("INPUT_LAYOUT", "zipp")
+    try:
+        with pytest.raises(ValueError):
+            importlib.reload(settings)
+    finally:
+        monkeypatch.delenv("INPUT_LAYOUT")
+        importlib.reload(settings)
+
+
+def test_invalid_output_layout_is_rejected(monkeypatch):
+    monkeypatch.setenv("OUTPUT_LAYOUT", "track")
+    try:
+        with pytest.raises(ValueError):
+            importlib.reload(settings)
+    finally:
+        monkeypatch.delenv("OUTPUT_LAYOUT")
+        importlib.reload(settings)
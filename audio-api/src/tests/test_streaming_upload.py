@@ -0,0 +1,154 @@
+import io
+import asyncio
+import hashlib
+import zipfile
+from contextlib import contextmanager
+from zipfile import ZipFile
+
+import pytest
+from flask_app.streaming_upload import (
+    ALLOWED_EXTENSIONS,
+    UploadError,
+    _stream_files,
+    _stream_files_async,
+    stream_files_to_s3_zip,
+)
+from shared.s3 import MULTIPART_PART_SIZE, get_s3_client
+
+BOUNDARY = b"boundary"
+
+
+def create_body(files, fields):
+    body = b""
+    for name, value in fields.items():
+        body += (
+            b"--" + BOUNDARY + b"\r\n"
+            b'Content-Disposition: form-data; name="'
+            + name.encode()
+            + b'"\r\n\r\n'
+            + value.encode()
+            + b"\r\n"
+        )
+    for filename, data in files.items():
+        body += (
+            b"--" + BOUNDARY + b"\r\n"
+            b'Content-Disposition: form-data; name="files"; filename="'
+            + filename.encode()
+            + b'"\r\n'
+            b"Content-Type: audio/mpeg\r\n\r\n" + data + b"\r\n"
+        )
+    return body + b"--" + BOUNDARY + b"--\r\n"
+
+
+def stream_files(body, chunk_size=None):
+    """Parses the body with _stream_files (or _stream_files_async, if chunk_size is given) and returns the fields and files"""
+    files = {}
+
+    @contextmanager
+    def open_file(filename):
+        files[filename] = io.BytesIO()
+        yield files[filename]
+
+    if chunk_size is None:
+        fields, _ = _stream_files(
+            io.BytesIO(body), BOUNDARY, open_file, "files", ALLOWED_EXTENSIONS, 2
+        )
+    else:
+
+        async def chunks():
+            for start in range(0, len(body), chunk_size):
+                yield body[start : start + chunk_size]
+
+        async def after_chunk():
+            pass
+
+        fields, _ = asyncio.run(
+            _stream_files_async(
+                chunks(),
+                BOUNDARY,
+                open_file,
+                "files",
+                ALLOWED_EXTENSIONS,
+                2,
+                after_chunk,
+            )
+        )
+    return fields, {filename: file.getvalue() for filename, file in files.items()}
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 7, 100 * 1024, 10 * 1024 * 1024])
+def test_files_are_streamed_regardless_of_chunk_size(chunk_size):
+    files = {"soprano.mp3": bytes(range(256)) * 1000, "alto.wav": b"alto"}
+    body = create_body(files, {"output": "tracks"})
+
+    assert stream_files(body, chunk_size) == ({"output": "tracks"}, files)
+
+
+def test_incomplete_body_is_rejected():
+    body = create_body({"soprano.mp3": b"soprano", "alto.mp3": b"alto"}, {})
+
+    with pytest.raises(UploadError):
+        stream_files(body[:-30], chunk_size=10)
+
+
+@pytest.mark.parametrize("filename", ["alto.aiff", "soprano.flac"])
+def test_invalid_files_are_rejected(filename):
+    body = create_body({"soprano.mp3": b"soprano", filename: b"data"}, {})
+
+    with pytest.raises(UploadError):
+        stream_files(body)
+
+
+def test_files_are_streamed_into_zip_file_in_s3(s3_bucket):
+    # the zip file is uploaded in two parts
+    files = {
+        "soprano.mp3": bytes(range(256)) * (MULTIPART_PART_SIZE // 256 + 1000),
+        "alto.mp3": b"alto",
+    }
+    body = create_body(files, {"output": "tracks"})
+
+    fields, file_hashes = stream_files_to_s3_zip(
+        io.BytesIO(body), BOUNDARY, "upload/input_files.zip"
+    )
+
+    assert fields == {"output": "tracks"}
+    assert file_hashes == {
+        filename: hashlib.sha256(data).hexdigest() for filename, data in files.items()
+    }
+    zip_data = (
+        get_s3_client()
+        .get_object(Bucket=s3_bucket, Key="upload/input_files.zip")["Body"]
+        .read()
+    )
+    with ZipFile(io.BytesIO(zip_data)) as zip_file:
+        assert {name: zip_file.read(name) for name in zip_file.namelist()} == files
+
+
+def test_large_files_are_streamed_into_zip_file(s3_bucket, monkeypatch):
+    # files beyond this size need the zip64 format, which has to be chosen before the size of a file is known
+    monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 1000)
+    files = {"soprano.mp3": b"s" * 2000, "alto.mp3": b"alto"}
+
+    stream_files_to_s3_zip(
+        io.BytesIO(create_body(files, {})), BOUNDARY, "upload/input_files.zip"
+    )
+
+    zip_data = (
+        get_s3_client()
+        .get_object(Bucket=s3_bucket, Key="upload/input_files.zip")["Body"]
+        .read()
+    )
+    with ZipFile(io.BytesIO(zip_data)) as zip_file:
+        assert {name: zip_file.read(name) for name in zip_file.namelist()} == files
+
+
+def test_invalid_upload_leaves_nothing_in_s3(s3_bucket):
+    body = create_body({"soprano.mp3": b"soprano", "alto.aiff": b"alto"}, {})
+
+    with pytest.raises(UploadError):
+        stream_files_to_s3_zip(io.BytesIO(body), BOUNDARY, "upload/input_files.zip")
+
+    s3 = get_s3_client()
+    assert "Contents" not in s3.list_objects_v2(Bucket=s3_bucket)
+    # the multipart upload was aborted
+    assert "Uploads" not in s3.list_multipart_uploads(Bucket=s3_bucket)